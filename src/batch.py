@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from config import LOG_PATH, LLM_MAX_IN_FLIGHT, LLM_REQUESTS_PER_MINUTE
+
+# Manifest keys of a target and the settings in config.py they replace
+MANIFEST_KEYS = {
+    "crate_path": "CRATE_PATH",
+    "code_path": "CODE_PATH",
+    "cargo_path": "CARGO_PATH",
+    "build_cmd": "BUILD_CMD",
+    "check_cmd": "CHECK_CMD",
+    "test_cmd": "TEST_CMD",
+    "test_expected_output": "TEST_EXPECTED_OUTPUT",
+    "test_timeout": "TEST_TIMEOUT",
+    "test_failure_patterns": "TEST_FAILURE_PATTERNS",
+}
+REQUIRED_KEYS = {"name", "crate_path", "code_path", "build_cmd", "test_cmd", "test_expected_output"}
+# Seconds an interrupted target gets to revert its files before it is killed
+INTERRUPT_GRACE_PERIOD = 60
+
+
+def load_manifest(path):
+    """Targets of a manifest: a JSON list of objects with a name, the keys of MANIFEST_KEYS (cargo_path, check_cmd,
+    test_timeout and test_failure_patterns are optional) and optionally "config", other settings of config.py for
+    this target only. Paths are relative to the working directory, as in config.py. Test patterns are strings,
+    matched literally, or {"regex": "..."}."""
+    with open(path, "r", encoding="utf-8") as f:
+        targets = json.load(f)
+    if not isinstance(targets, list):
+        raise ValueError(f"{path}: expected a list of targets")
+    names = set()
+    for target in targets:
+        missing = REQUIRED_KEYS - target.keys()
+        if missing:
+            raise ValueError(f"{path}: target {target.get('name', '?')} is missing {', '.join(sorted(missing))}")
+        unknown = target.keys() - REQUIRED_KEYS - MANIFEST_KEYS.keys() - {"config"}
+        if unknown:
+            raise ValueError(f"{path}: target {target['name']} has unknown keys {', '.join(sorted(unknown))}")
+        unknown = {key for key in target.get("config", {}) if not (key.isupper() and hasattr(config, key))}
+        if unknown:
+            raise ValueError(f"{path}: target {target['name']} sets unknown settings {', '.join(sorted(unknown))}")
+        if not re.fullmatch(r"[\w.-]+", target["name"]) or target["name"] in names:
+            raise ValueError(f"{path}: target names must be unique and only use letters, digits, _, . and -")
+        names.add(target["name"])
+    return targets
+
+
+class BatchRunner:
+    """Runs the targets of a manifest, workers at a time, and tabulates the results.
+
+    Settings are read from config.py at import time, so each target runs as its own main.py process with the
+    target's settings in OXIDIZER_CONFIG, and its logs in LOG_PATH/batch/targets/<name>. The processes share the build
+    cache (and the LLM response cache, if LLM_CACHE_MODE turns it on), and split the LLM rate limits evenly between
+    the workers so the batch as a whole stays within them. Candidates are always evaluated in the target's own
+    scratch workspaces, never in its crate, as targets may share one.
+    """
+
+    def __init__(self, targets, workers, timeout=None):
+        self.targets = targets
+        self.workers = max(1, min(workers, len(targets)))
+        self.timeout = timeout
+        batch_path = os.path.join(LOG_PATH, "batch")
+        os.makedirs(batch_path, exist_ok=True)
+        run_dirs = [d for d in os.listdir(batch_path) if re.fullmatch(r"run\d{3}", d)]
+        self.run_dir = os.path.join(batch_path, f"run{max((int(d[3:]) for d in run_dirs), default=0) + 1:03d}")
+        os.makedirs(self.run_dir)
+        self.targets_path = os.path.join(batch_path, "targets")
+        self.lock = threading.Lock()
+
+    def target_config(self, target):
+        settings = {"TARGET": target["name"], "CARGO_PATH": None, "CHECK_CMD": None, "TEST_TIMEOUT": 15}
+        settings.update({MANIFEST_KEYS[key]: value for key, value in target.items() if key in MANIFEST_KEYS})
+        settings.update(
+            LOG_PATH=os.path.join(self.targets_path, target["name"]),
+            LLM_REQUESTS_PER_MINUTE=max(1, LLM_REQUESTS_PER_MINUTE // self.workers),
+            LLM_MAX_IN_FLIGHT=max(1, LLM_MAX_IN_FLIGHT // self.workers),
+        )
+        settings.update(target.get("config", {}))
+        # Targets may share a crate, so none is ever built in the crate itself
+        settings["ISOLATED_WORKSPACES"] = True
+        return settings
+
+    def run(self):
+        print(f"Running {len(self.targets)} targets, {self.workers} at a time. Output in {self.run_dir}")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self.run_target, self.targets))
+        table = format_results(results)
+        with open(os.path.join(self.run_dir, "results.json"), "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+        with open(os.path.join(self.run_dir, "results.txt"), "w", encoding="utf-8") as f:
+            f.write(table + "\n")
+        print(table)
+        return results
+
+    def run_target(self, target):
+        settings = self.target_config(target)
+        env = dict(os.environ, OXIDIZER_CONFIG=json.dumps(settings))
+        output_path = os.path.join(self.run_dir, f"{target['name']}.out")
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        self.log(f"Started {target['name']}")
+        start = time.time()
+        with open(output_path, "w", encoding="utf-8") as output:
+            process = subprocess.Popen(
+                [sys.executable, main_path], stdout=output, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env
+            )
+            try:
+                returncode = process.wait(timeout=self.timeout)
+                status = "finished" if returncode == 0 else f"crashed ({returncode})"
+            except subprocess.TimeoutExpired:
+                # An interrupt lets the run revert the target's files and write its logs
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(timeout=INTERRUPT_GRACE_PERIOD)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                status = "timed out"
+
+        result = {"name": target["name"], "status": status, "time": round(time.time() - start, 1), "output": output_path}
+        result.update(read_run_result(settings["LOG_PATH"]))
+        self.log(f"{status.capitalize()} {target['name']} in {result['time']:.0f}s")
+        return result
+
+    def log(self, message):
+        with self.lock:
+            print(message)
+            with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
+                f.write(message + "\n")
+
+
+def read_run_result(log_path):
+    """Unsafe line counts and strategy results of the latest run in log_path, from its checkpoint."""
+    run_dirs = [d for d in os.listdir(log_path) if re.fullmatch(r"run\d{3}", d)] if os.path.isdir(log_path) else []
+    if not run_dirs:
+        return {}
+    run_dir = os.path.join(log_path, max(run_dirs))
+    try:
+        with open(os.path.join(run_dir, "checkpoint.json"), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"run_dir": run_dir}
+    initial = checkpoint["initial_unsafe_lines"]
+    best = checkpoint["best_unsafe_lines"]
+    return {
+        "run_dir": run_dir,
+        "initial_unsafe_lines": initial,
+        "best_unsafe_lines": initial if best is None else best,
+        "strategies": len(checkpoint["strategies"]),
+        "successful_strategies": sum(1 for strategy in checkpoint["strategies"] if strategy["result"] == "SUCCESS"),
+    }
+
+
+def format_results(results):
+    lines = [f"{'Target':<24}{'Status':<16}{'Before':>8}{'After':>8}{'Strategies':>12}{'Time':>10}"]
+    for result in results:
+        strategies = f"{result['successful_strategies']}/{result['strategies']}" if "strategies" in result else "-"
+        lines.append(
+            f"{result['name']:<24}{result['status']:<16}{result.get('initial_unsafe_lines', '-'):>8}"
+            f"{result.get('best_unsafe_lines', '-'):>8}{strategies:>12}{int(result['time']) // 60:>7}:{int(result['time']) % 60:02d}"
+        )
+    before = sum(result.get("initial_unsafe_lines", 0) for result in results)
+    after = sum(result.get("best_unsafe_lines", result.get("initial_unsafe_lines", 0)) for result in results)
+    lines.append(f"{'Total':<40}{before:>8}{after:>8}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python src/batch.py targets.json --workers 4 --timeout 120
+    parser = argparse.ArgumentParser(description="Run the targets of a manifest and tabulate the results")
+    parser.add_argument("manifest", help="JSON list of targets")
+    parser.add_argument("--workers", type=int, default=2, help="targets run at the same time")
+    parser.add_argument("--timeout", type=float, help="minutes after which a target is stopped")
+    args = parser.parse_args()
+    try:
+        targets = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    BatchRunner(targets, args.workers, args.timeout * 60 if args.timeout else None).run()
@@ -0,0 +1,281 @@
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from utils.logger import Logger
+from utils.misc import apply_changes, count_unsafe
+from utils.unsafe_counter import UnsafeCounter
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "bench_baseline.json")
+CODE_SIZES = (100, 1_000, 10_000, 100_000)
+APPLY_CODE_SIZES = (1_000, 10_000, 100_000)
+REPLACEMENT_COUNTS = (1, 10, 100)
+LOG_MESSAGES = (1_000, 10_000)
+# A case runs at least REPEAT times and until MIN_SECONDS have passed (at most MAX_REPEAT times). The fastest run is
+# reported, since slower ones only measure interference from the rest of the machine. Each run is preceded by a fixed
+# calibration workload, and regressions are judged on time relative to it, which drifts much less with the machine's
+# load and clock speed than absolute time
+REPEAT = 5
+MIN_SECONDS = 1.0
+MAX_REPEAT = 200
+# A case is a regression if its time or peak memory exceeds the baseline by more than this fraction
+TOLERANCE = 0.25
+
+# Items of the synthetic Rust code, filled in with a unique number. Roughly a third of the lines are unsafe
+ITEM_TEMPLATES = (
+    """/// Sums the values of item {i}
+fn safe_{i}(values: &[u32]) -> u32 {{
+    let mut total = 0;
+    for value in values.iter() {{
+        total += *value;
+    }}
+    total
+}}
+""",
+    """unsafe fn raw_{i}(ptr: *mut u32, len: usize) -> u32 {{
+    let slice = std::slice::from_raw_parts_mut(ptr, len);
+    slice[0] = {i};
+    slice.iter().sum()
+}}
+""",
+    """pub fn mixed_{i}(data: &mut Vec<u32>) {{
+    let ptr = data.as_mut_ptr();
+    // not an unsafe {{ block }} in a comment
+    let label = "unsafe {{ {i} }}";
+    unsafe {{
+        *ptr.add(1) = label.len() as u32;
+    }}
+}}
+""",
+    """struct Thing{i} {{
+    field: *mut u8,
+    len: usize,
+}}
+
+unsafe impl Send for Thing{i} {{}}
+
+impl Thing{i} {{
+    fn get(&self, index: usize) -> u8 {{
+        unsafe {{ *self.field.add(index % self.len) }}
+    }}
+}}
+""",
+)
+
+
+def generate_code(num_lines, seed=0):
+    """Synthetic Rust code of about num_lines lines, made of uniquely numbered items."""
+    rng = random.Random(seed)
+    items = []
+    lines = 0
+    i = 0
+    while lines < num_lines:
+        item = rng.choice(ITEM_TEMPLATES).format(i=i)
+        items.append(item)
+        lines += item.count("\n") + 1
+        i += 1
+    return "\n".join(items)
+
+
+def generate_changes(code, num_changes, seed=0):
+    """num_changes non-overlapping replacements of whole items of code. Every other original has its whitespace
+    changed, as the LLM's originals often do."""
+    rng = random.Random(seed)
+    items = code.split("\n\n")
+    changes = []
+    for index, item in enumerate(rng.sample(range(len(items)), num_changes)):
+        original = items[item].strip()
+        if index % 2:
+            original = " ".join(original.split())
+        changes.append({"original": original, "new": f"// replaced item {item}\n{original}"})
+    return changes
+
+
+def calibration_workload():
+    words = {}
+    for i in range(20_000):
+        word = f"item{i % 1000}"
+        words[word] = words.get(word, 0) + len(word)
+    return words
+
+
+def time_once(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def measure(function):
+    """(fastest seconds, fastest seconds relative to the calibration workload, peak traced memory in KB) of
+    function(), after a warm-up run. Timed without tracing."""
+    function()
+    times, calibration_times = [], []
+    first_start = time.perf_counter()
+    while len(times) < MAX_REPEAT and (len(times) < REPEAT or time.perf_counter() - first_start < MIN_SECONDS):
+        calibration_times.append(time_once(calibration_workload))
+        times.append(time_once(function))
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), min(times) / min(calibration_times), peak / 1024
+
+
+def bench_count_unsafe(sizes):
+    for num_lines in sizes:
+        code = generate_code(num_lines)
+        seconds, relative, peak_kb = measure(lambda: count_unsafe(code))
+        yield f"count_unsafe/{num_lines}_lines", seconds, relative, peak_kb, num_lines / seconds, "lines/s"
+        # Recount after removing an unsafe keyword in the middle of the file, as a candidate's patch would
+        counter = UnsafeCounter(code)
+        position = code.index("unsafe {", len(code) // 2)
+        edits = [(position, position + len("unsafe {"), "{")]
+        seconds, relative, peak_kb = measure(lambda: counter.with_edits(edits))
+        yield f"count_unsafe/{num_lines}_lines/one_edit", seconds, relative, peak_kb, num_lines / seconds, "lines/s"
+
+
+def bench_apply_changes(sizes):
+    for num_lines in sizes:
+        code = generate_code(num_lines)
+        for num_changes in REPLACEMENT_COUNTS:
+            changes = generate_changes(code, num_changes)
+            seconds, relative, peak_kb = measure(lambda: apply_changes(code, changes))
+            name = f"apply_changes/{num_lines}_lines/{num_changes}_changes"
+            yield name, seconds, relative, peak_kb, num_lines / seconds, "lines/s"
+
+
+def bench_logger(message_counts):
+    """Time for the logging calls of a run to return (the loop's cost), and for the writer to get them to disk."""
+    directory = tempfile.mkdtemp(prefix="oxidizer-bench-")
+    try:
+        code_path = os.path.join(directory, "main.rs")
+        code = generate_code(1_000)
+        with open(code_path, "w", encoding="utf-8") as f:
+            f.write(code)
+        changes = generate_changes(code, 10)
+        new_code = apply_changes(code, changes)
+
+        for num_messages in message_counts:
+
+            def log_messages():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    logger = Logger(code_path=code_path, log_path=os.path.join(directory, "log"))
+                    atexit.unregister(logger.cleanup)
+                    logger.begin_run(0)
+                    logger.log_strategy("benchmark strategy")
+                    logger.log_prompt("benchmark prompt")
+                    start = time.perf_counter()
+                    for index in range(num_messages):
+                        logger.log_status(f"Status message {index}", 0.5)
+                    logger.log_generated_code(json.dumps(changes), new_code, None, 1, 0.5, code, None)
+                    enqueued = time.perf_counter() - start
+                    logger.writer.sync(wait=True)
+                    logger.cleanup()
+                return enqueued
+
+            enqueue_times = []
+            seconds, relative, peak_kb = measure(lambda: enqueue_times.append(log_messages()))
+            enqueued = min(enqueue_times)
+            name = f"logger/{num_messages}_messages"
+            yield f"{name}/enqueue", enqueued, relative * enqueued / seconds, None, num_messages / enqueued, "msgs/s"
+            yield f"{name}/total", seconds, relative, peak_kb, num_messages / seconds, "msgs/s"
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    """Names of the results that regressed against the baseline, with the reason."""
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reasons = []
+        for key, label in (("relative", "time"), ("peak_kb", "peak memory")):
+            old, new = baseline[name].get(key), result[key]
+            if old and new and new > old * (1 + tolerance):
+                reasons.append(f"{label} +{(new / old - 1) * 100:.0f}%")
+        if reasons:
+            regressions[name] = ", ".join(reasons)
+    return regressions
+
+
+def format_results(results, baseline, regressions):
+    """Table of the results. Baseline times are shown at this run's speed, as measured by the calibration workload."""
+    lines = [f"{'Benchmark':<46}{'time (ms)':>11}{'baseline':>10}{'peak (KB)':>11}{'throughput':>20}"]
+    for name, result in results.items():
+        old = baseline.get(name, {}).get("relative")
+        old = f"{result['seconds'] * old / result['relative'] * 1000:.2f}" if old else "-"
+        peak = f"{result['peak_kb']:.0f}" if result["peak_kb"] is not None else "-"
+        line = f"{name:<46}{result['seconds'] * 1000:>11.2f}{old:>10}{peak:>11}{result['throughput']:>14.0f} {result['unit']}"
+        if name in regressions:
+            line += f"  REGRESSION ({regressions[name]})"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python src/bench.py [--quick] [--only count_unsafe] [--save]
+    parser = argparse.ArgumentParser(description="Benchmark count_unsafe, apply_changes and the Logger")
+    parser.add_argument("--only", choices=("count_unsafe", "apply_changes", "logger"), action="append")
+    parser.add_argument("--quick", action="store_true", help="skip the 100k line inputs")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare against")
+    parser.add_argument("--save", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown, e.g. 0.25 for 25%%")
+    args = parser.parse_args()
+
+    sizes = tuple(size for size in CODE_SIZES if not (args.quick and size > 10_000))
+    apply_sizes = tuple(size for size in APPLY_CODE_SIZES if not (args.quick and size > 10_000))
+    suites = {
+        "count_unsafe": lambda: bench_count_unsafe(sizes),
+        "apply_changes": lambda: bench_apply_changes(apply_sizes),
+        "logger": lambda: bench_logger(LOG_MESSAGES),
+    }
+    results = {}
+    for suite, run in suites.items():
+        if args.only and suite not in args.only:
+            continue
+        for name, seconds, relative, peak_kb, throughput, unit in run():
+            print(f"{name}: {seconds * 1000:.2f}ms", file=sys.stderr)
+            results[name] = {
+                "seconds": seconds,
+                "relative": relative,
+                "peak_kb": peak_kb,
+                "throughput": throughput,
+                "unit": unit,
+            }
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    print(format_results(results, baseline, regressions))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**baseline, **results}, f, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+        sys.exit(0)
+    # Without a baseline nothing was checked, which mustn't pass for "no regressions"
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(
+            f"\nNo baseline for {len(missing)} of {len(results)} cases in {args.baseline} ({', '.join(missing[:3])}"
+            f"{', ...' if len(missing) > 3 else ''}). Run with --save to record one"
+        )
+        sys.exit(2)
+    if regressions:
+        print(f"\n{len(regressions)} regressions against {args.baseline}")
+        sys.exit(1)
@@ -1,22 +1,135 @@
+import json
+import os
+
 TARGET = "quicksort"
 
+# Number of candidate patches generated, built and tested concurrently per prompt (1 = serial)
+NUM_CANDIDATES = 1
+# Evaluate the candidate in a warm scratch workspace even when NUM_CANDIDATES is 1, so CRATE_PATH itself is never
+# written to (always on in batch runs, whose targets may share a crate)
+ISOLATED_WORKSPACES = False
+
+# LLM response cache: "off", "on" (reuse cached responses, store new ones) or "replay" (cached responses only, offline).
+# Requests are keyed by their prompt, so with "on" a rerun replays the earlier run's responses (and makes the same
+# choices) for as long as its prompts match. Off by default so every run explores afresh. Independently of this, each
+# run keeps its own responses in its log folder, and --resume replays them up to where the interrupted run stopped
+LLM_CACHE_MODE = "off"
+LLM_CACHE_MAX_SIZE_MB = 512
+LLM_CACHE_MAX_AGE_DAYS = 30
+
+# LLM client: concurrent requests, request rate limit, and retries on 429/5xx/connection errors
+LLM_MAX_IN_FLIGHT = 8
+LLM_REQUESTS_PER_MINUTE = 500
+LLM_MAX_RETRIES = 6
+
+# Stream patches from the LLM, locating each replacement as it arrives. The replacements that can't be found are
+# reported together once the response is complete, or once there are STREAM_PATCH_MAX_FAILURES of them, which cancels
+# the rest of the generation (None to always read the whole response)
+STREAM_PATCHES = True
+STREAM_PATCH_MAX_FAILURES = 3
+
+# Apply a replacement whose original isn't found at its best unique near-match with at least this similarity (None = off)
+FUZZY_MATCH_THRESHOLD = 0.9
+
+# Reuse build/test results for byte-identical code and Cargo.toml. Clear src/cache/build if other files change
+BUILD_CACHE = True
+BUILD_CACHE_MAX_SIZE_MB = 256
+BUILD_CACHE_MAX_AGE_DAYS = 7
+
+# Tiered validation: the delimiters of a candidate's code are checked in-process, then the crate is type checked with
+# the target's CHECK_CMD (e.g. `cargo check`, None to skip), and only then built with BUILD_CMD and tested. The first
+# tier that fails rejects the candidate with its diagnostics
+SYNTAX_CHECK = True
+
+# Send the LLM only the parts of the code relevant to the task (unsafe code and items it names), with the bodies of
+# other functions omitted. Files shorter than CONTEXT_SELECTION_MIN_LINES are always sent in full
+CONTEXT_SELECTION = True
+CONTEXT_SELECTION_MIN_LINES = 300
+
+# Show analysis prompts a unified diff (with this many lines of context) and the unsafe code that changed instead of
+# the original and generated code, unless the diff is longer than this fraction of the two files. Then both files are
+# shown: in full, or with CONTEXT_SELECTION on, with the bodies unrelated to the task and compiler errors omitted
+ANALYSIS_DIFFS = True
+ANALYSIS_DIFF_CONTEXT_LINES = 3
+ANALYSIS_DIFF_MAX_FRACTION = 0.5
+
+# Strategies requested per LLM call. They are queued, ranked by the unsafe lines they target, and a new batch is
+# requested in the background when the queue runs out
+STRATEGY_BATCH_SIZE = 5
+# The run stops after this many batches in a row that contain no strategy at all
+STRATEGY_MAX_EMPTY_BATCHES = 3
+# Strategies at least this similar (TF-IDF cosine) to a failed or queued one are skipped, and near-duplicate failures
+# are listed once. Prompts list at most FAILED_STRATEGY_HISTORY groups of failed strategies
+STRATEGY_DUPLICATE_THRESHOLD = 0.8
+FAILED_STRATEGY_HISTORY = 10
+
+# Whole-crate mode: optimize every .rs file under CRATE_PATH that contains unsafe code instead of only CODE_PATH, most
+# unsafe lines first and CRATE_PARALLEL_FILES files at a time. Candidates of all files share CRATE_BUILD_SLOTS warm
+# workspaces, and improvements are merged into one crate state
+CRATE_MODE = False
+CRATE_PARALLEL_FILES = 4
+CRATE_BUILD_SLOTS = 2
+
+# Test output that means the test failed, so it is stopped right away instead of running until TEST_TIMEOUT. Like
+# TEST_EXPECTED_OUTPUT (which may also be a list of alternatives), each is a literal string or a re.compile()d regex
+TEST_FAILURE_PATTERNS = ["panicked at", "test result: FAILED"]
+# Those of TEST_FAILURE_PATTERNS that mean the test harness or the machine failed rather than the code (a VM that did
+# not boot, say). Test results are cached per candidate, but failures matching these are run again next time
+TEST_HARNESS_FAILURE_PATTERNS = []
+# Adaptive test timeouts: once TEST_TIMEOUT_MIN_SAMPLES passing test runs of the target have been recorded, the test
+# is stopped after TEST_TIMEOUT_FACTOR times the TEST_TIMEOUT_PERCENTILE of their wall times (between TEST_TIMEOUT_MIN
+# and TEST_TIMEOUT seconds), or as hung after printing nothing for TEST_TIMEOUT_FACTOR times that percentile of their
+# longest silences. The last TEST_TIME_HISTORY passing runs are kept in src/cache/test_times
+ADAPTIVE_TEST_TIMEOUT = True
+TEST_TIMEOUT_PERCENTILE = 95
+TEST_TIMEOUT_FACTOR = 2.0
+TEST_TIMEOUT_MIN = 2
+TEST_TIMEOUT_MIN_SAMPLES = 5
+TEST_TIME_HISTORY = 100
+# Characters of test output kept for logs and prompts (the first and last half), however much the test prints
+TEST_OUTPUT_LIMIT = 64 * 1024
+
+# Folder for the logs of every run (original code, run folders, artifacts)
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "log")
+
 CARGO_PATH = None
+CHECK_CMD = None
 if TARGET == "theseus":
-    CODE_PATH = "/Users/addisongoolsbee/Desktop/TheseusM/kernel/e1000_old/src/lib.rs"
-    BUILD_CMD = "gmake iso -C ~/Desktop/TheseusM/ net=user"
-    TEST_CMD = "python3 src/examples/theseus_e1000/theseus.py"
+    CRATE_PATH = "/Users/addisongoolsbee/Desktop/TheseusM"
+    CODE_PATH = f"{CRATE_PATH}/kernel/e1000_old/src/lib.rs"
+    # No CHECK_CMD: Theseus crates only check with the custom target and build-std flags its Makefile sets up
+    BUILD_CMD = f"gmake iso -C {CRATE_PATH} net=user"
+    # Boots the ISO built by BUILD_CMD in QEMU directly, so it is the workspace's own ISO that is tested
+    TEST_CMD = f"python3 src/examples/theseus_e1000/theseus.py --iso {CRATE_PATH}/build/theseus-x86_64.iso"
     TEST_EXPECTED_OUTPUT = "2 packets transmitted, 2 packets num_received, 0.0% packet loss"
+    TEST_FAILURE_PATTERNS = [
+        "panicked at",
+        "QEMU failed to boot Theseus",
+        "shell did not show a prompt",
+        "100.0% packet loss",
+    ]
+    # QEMU or a shell that is slow to come up under load says nothing about the driver
+    TEST_HARNESS_FAILURE_PATTERNS = ["QEMU failed to boot Theseus", "shell did not show a prompt"]
     TEST_TIMEOUT = 15
 elif TARGET == "rfk":
+    CRATE_PATH = "src/examples/rfk"
     CODE_PATH = "src/examples/rfk/src/main.rs"
     CARGO_PATH = "src/examples/rfk/Cargo.toml"
+    CHECK_CMD = "cargo +nightly check --manifest-path src/examples/rfk/Cargo.toml --test test"
     BUILD_CMD = "cargo +nightly test --manifest-path src/examples/rfk/Cargo.toml --test test --no-run"
     TEST_CMD = "cargo +nightly test --manifest-path src/examples/rfk/Cargo.toml --test test"
     TEST_EXPECTED_OUTPUT = "test result: ok. 3 passed;"
     TEST_TIMEOUT = 15
 elif TARGET == "quicksort":
+    CRATE_PATH = "src/examples/quicksort"
     CODE_PATH = "src/examples/quicksort/src/main.rs"
+    CHECK_CMD = "cargo check --manifest-path src/examples/quicksort/Cargo.toml"
     BUILD_CMD = "cargo build --manifest-path src/examples/quicksort/Cargo.toml"
     TEST_CMD = "./src/examples/quicksort/target/debug/quicksort"
     TEST_EXPECTED_OUTPUT = "[1, 2, 3, 4, 7, 9]"
     TEST_TIMEOUT = 15
+
+# Set by the batch runner (src/batch.py) to run one target of its manifest: a JSON object of the settings above
+# (TARGET, CRATE_PATH, CODE_PATH, BUILD_CMD, ...) that replace the ones selected by TARGET
+if os.environ.get("OXIDIZER_CONFIG"):
+    globals().update(json.loads(os.environ["OXIDIZER_CONFIG"]))
@@ -1,162 +1,283 @@
 #!/usr/bin/env python3
-import select
+import argparse
+import codecs
+import os
+import pty
+import selectors
+import shutil
+import signal
+import socket
 import subprocess
-import re
+import sys
+import tempfile
 import threading
 import time
-import sys
-import os
-import signal
-import pexpect
-
-process = None
-debug_dev = None
-terminal_dev = None
-error_found = False
-ready_event = threading.Event()
+import tty
 
-SESSION = "theseus"
-BOOT_CMD = "gmake orun -C ~/Desktop/TheseusM/ net=user graphic=no SERIAL1=pty SERIAL2=pty"
+DEFAULT_ISO = os.path.expanduser("~/Desktop/TheseusM/build/theseus-x86_64.iso")
 UNIT_TEST_CMD = "ping 8.8.8.8 -t 2"
+# The shell's prompt ends with this, as the last thing printed
+PROMPT = ">"
+# Seconds to wait for the shell to show a prompt, asking again after PROMPT_POKE_INTERVAL seconds of silence
+BOOT_TIMEOUT = 30
+PROMPT_POKE_INTERVAL = 0.5
+# Seconds for a ping to return to the prompt, and tries if a ping returns without printing any statistics
+PING_TIMEOUT = 10
+PING_ATTEMPTS = 3
+# The flags `gmake orun net=user graphic=no` passes to QEMU, minus the gdb server on port 1234 (which would stop a
+# second VM from starting) and the serial ports, which are chardevs allocated per VM
+QEMU_FLAGS = [
+    "-no-reboot",
+    "-no-shutdown",
+    "-m", "512M",
+    "-smp", "4",
+    "-cpu", "Broadwell",
+    "-display", "none",
+    "-monitor", "none",
+    "-device", "e1000,netdev=network0",
+    "-netdev", "user,id=network0",
+]
+# serial0 (COM1) carries Theseus' log, serial1 (COM2) its terminal
+SERIAL_PORTS = ("serial0", "serial1")
+
+vms = []
+
+
+class TheseusVM:
+    """QEMU booting an already built Theseus ISO, with its serial ports on unix sockets (or ptys) that are allocated
+    here, in a temporary directory of its own, so any number of VMs can run side by side."""
+
+    def __init__(self, iso, serial="socket", qemu="qemu-system-x86_64", extra_flags=(), gdb_port=None):
+        self.iso = iso
+        self.serial = serial
+        self.qemu = qemu
+        self.extra_flags = list(extra_flags)
+        self.gdb_port = gdb_port
+        self.directory = tempfile.mkdtemp(prefix="theseus-vm-")
+        self.process = None
+        self.listeners = {}
+        self.fds = {}
+        # Our copies of the pty slaves, held open so reading a master doesn't fail before QEMU opens its slave
+        self.slaves = []
+
+    def chardev_flags(self):
+        """Create the endpoint of each serial port and return the QEMU flags that connect it."""
+        flags = []
+        for name in SERIAL_PORTS:
+            if self.serial == "pty":
+                master, slave = pty.openpty()
+                tty.setraw(slave)
+                self.fds[name] = master
+                self.slaves.append(slave)
+                flags += ["-chardev", f"serial,id={name},path={os.ttyname(slave)}"]
+            else:
+                # QEMU connects to our socket as a client, so nothing it prints before we accept is lost
+                path = os.path.join(self.directory, f"{name}.sock")
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                listener.bind(path)
+                listener.listen(1)
+                self.listeners[name] = listener
+                flags += ["-chardev", f"socket,id={name},path={path}"]
+            flags += ["-serial", f"chardev:{name}"]
+        return flags
+
+    def start(self, timeout=10):
+        """Launch QEMU and wait until every serial port is connected. Returns {port name: file descriptor}."""
+        if not os.path.isfile(self.iso):
+            raise FileNotFoundError(f"No ISO at {self.iso}, run the build command first")
+        cmd = [self.qemu, "-cdrom", self.iso, *QEMU_FLAGS, *self.chardev_flags(), *self.extra_flags]
+        if self.gdb_port:
+            cmd += ["-gdb", f"tcp::{self.gdb_port}"]
+        print(f"Running command: {' '.join(cmd)}\n", flush=True)
+        self.process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True
+        )
+        for name, listener in self.listeners.items():
+            listener.settimeout(timeout)
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                raise RuntimeError(f"QEMU did not connect {name}: {self.qemu_output()}") from None
+            self.fds[name] = connection.detach()
+            listener.close()
+        return self.fds
+
+    def qemu_output(self):
+        if self.process.poll() is None:
+            return "QEMU is still running"
+        return self.process.stdout.read().decode(errors="replace").strip()
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+        for fd in [*self.fds.values(), *self.slaves]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        for listener in self.listeners.values():
+            listener.close()
+        self.fds, self.listeners, self.slaves = {}, {}, []
+        shutil.rmtree(self.directory, ignore_errors=True)
 
 
 def cleanup(signum=None, frame=None):
-    global process
     print("Cleaning up Theseus", flush=True)
-    if process and process.poll() is None:
-        try:
-            os.killpg(process.pid, signal.SIGKILL)
-        except Exception:
-            pass
+    for vm in vms:
+        vm.stop()
     sys.exit(0)
 
 
-def capture_ttys():
-    global process, debug_dev, terminal_dev, error_found
-
-    print(f"Running command: {BOOT_CMD}\n", flush=True)
-
-    process = subprocess.Popen(
-        BOOT_CMD,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-        preexec_fn=os.setsid,
-    )
-
-    pattern = r"char device redirected to (/dev/ttys\d+) \(label (serial\d+-base)\)"
-
-    while process.poll() is None:
-        line = process.stdout.readline()
-        if not line:
-            break
-        # print(line, end="", flush=True)
-
-        match = re.search(pattern, line)
-        if match:
-            ttys_path = match.group(1)
-            label = match.group(2)
-            if label == "serial0-base":
-                debug_dev = ttys_path
-            elif label == "serial1-base":
-                terminal_dev = ttys_path
-            if debug_dev and terminal_dev:
-                break
-
-    end_time = time.time() + 0.3
-    while time.time() < end_time and process.poll() is None:
-        rlist, _, _ = select.select([process.stdout], [], [], 0.1)
-        if rlist:
-            line = process.stdout.readline()
-            if not line:
-                continue
-            # print(line, end="", flush=True)
-            if "gmake: *** [Makefile:997: orun] Error 1" in line:
-                error_found = True
-                break
-
-    if error_found:
-        print("❌ gmake failed inside bootTheseus!", flush=True)
-        cleanup()
-
-    ready_event.set()
-
-
-def wait_for_prompt(ser, prompt=b">", timeout=10):
-    start = time.time()
-    buffer = b""
-    while time.time() - start < timeout:
-        ser.write(b"\r")
-        time.sleep(0.2)
-        buffer += ser.read(1024)
-        if prompt in buffer:
-            # print(prompt.decode(), flush=True)
-            return True
-    return False
-
-
-def clean_ansi_and_control(output: str) -> str:
-    # Remove ANSI escape sequences
-    output = re.sub(r"\x1b\[[0-9;]*[A-Za-z]", "", output)
-    # Remove bell, carriage return, and vertical tab
-    output = re.sub(r"[\x07\r\v]", "", output)
-    # Handle backspace sequences like "a\b" → remove the character before
-    while "\b" in output:
-        output = re.sub(r".\x08", "", output)
-    return output
-
-
-def perform_unit_test(debug, terminal):
-    child = pexpect.spawn(f"screen -S {SESSION} {terminal}", encoding="utf-8")
-    time.sleep(0.1)
-
-    child.send("\r")
-    child.expect(">", timeout=5)
+class ConsoleFilter:
+    """Streaming, single-pass cleanup of serial console output: ANSI escape sequences, bells, carriage returns and
+    vertical tabs are dropped and backspaces erase the character before them. Escape sequences may be split across
+    chunks. feed() returns the lines it completed, and partial is the line still being printed."""
+
+    def __init__(self):
+        self.line = []
+        self.escape = None
+
+    def feed(self, text):
+        lines = []
+        for char in text:
+            if self.escape is not None:
+                # ESC [ parameters final byte, or ESC and one character
+                if self.escape == "[" and not "\x40" <= char <= "\x7e":
+                    continue
+                self.escape = "[" if self.escape == "" and char == "[" else None
+            elif char == "\x1b":
+                self.escape = ""
+            elif char == "\n":
+                lines.append("".join(self.line) + "\n")
+                self.line = []
+            elif char == "\b":
+                if self.line:
+                    self.line.pop()
+            elif char not in "\x07\r\v":
+                self.line.append(char)
+        return lines
+
+    @property
+    def partial(self):
+        return "".join(self.line)
+
+
+class Console:
+    """Client for a serial console on a socket or pty file descriptor, woken by a selector as data arrives."""
+
+    def __init__(self, fd, echo=True):
+        self.fd = fd
+        self.echo = echo
+        os.set_blocking(fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(fd, selectors.EVENT_READ)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.filter = ConsoleFilter()
+        self.lines = []
+        self.closed = False
+
+    def send(self, text):
+        os.write(self.fd, text.encode())
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for output and filter it. Returns whether any arrived."""
+        if self.closed or not self.selector.select(timeout):
+            return False
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        except OSError:
+            data = b""
+        if not data:
+            self.closed = True
+            return False
+        lines = self.filter.feed(self.decoder.decode(data))
+        self.lines += lines
+        if self.echo and lines:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+        return True
+
+    def at_prompt(self):
+        return self.filter.partial.rstrip().endswith(PROMPT)
+
+    def wait_for_prompt(self, timeout, poke=None):
+        """Read until the shell's prompt is the last thing printed, sending a carriage return after every poke
+        seconds without output (to ask a booting shell for a prompt). Returns whether the prompt appeared."""
+        deadline = time.monotonic() + timeout
+        while not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.read(min(remaining, poke or remaining)):
+                if self.at_prompt():
+                    return True
+            elif poke:
+                self.send("\r")
+        return False
+
+    def run(self, cmd, timeout):
+        """Run cmd in the shell. Returns (its output, whether the prompt came back)."""
+        first = len(self.lines)
+        self.send(cmd + "\r")
+        returned = self.wait_for_prompt(timeout)
+        return "".join(self.lines[first:]), returned
+
+
+def forward_log(fd):
+    """Copy Theseus' log to stdout, so kernel panics reach the test's failure patterns."""
+    console = Console(fd)
+    while not console.closed:
+        console.read(None)
+
+
+def perform_unit_test(terminal_fd):
+    """Wait for the shell and ping over the e1000, trying again if the ping printed no statistics. Returns the
+    ping's output, which has also been printed as it arrived."""
+    console = Console(terminal_fd)
+    if not console.wait_for_prompt(BOOT_TIMEOUT, poke=PROMPT_POKE_INTERVAL):
+        print(f"❌ Theseus' shell did not show a prompt within {BOOT_TIMEOUT} seconds", flush=True)
+        return ""
     print("Theseus booted successfully", flush=True)
 
-    child.send(UNIT_TEST_CMD + "\r")
-
     output = ""
-    while True:
-        try:
-            chunk = child.read_nonblocking(size=1024, timeout=2)
-            if ">" in chunk and len(output) > 40:
-                break
-            output += chunk
-            print(clean_ansi_and_control(chunk), end="", flush=True)
-        except pexpect.exceptions.TIMEOUT:
-            if len(output) < 50:
-                output = ""
-                child.send(UNIT_TEST_CMD + "\r")
-                continue
+    for _ in range(PING_ATTEMPTS):
+        output, returned = console.run(UNIT_TEST_CMD, PING_TIMEOUT)
+        if "packets transmitted" in output or not returned:
             break
-
-    clean_output = clean_ansi_and_control(output)
-
-    with open("temp.txt", "w") as f:
-        f.write(clean_output)
-
-    child.send("\x01" + "d")  # Ctrl-A D to detach
-    child.close()
-
-    subprocess.run(["screen", "-S", SESSION, "-X", "quit"])
+    return output
 
 
 if __name__ == "__main__":
+    # python3 src/examples/theseus_e1000/theseus.py --iso <Theseus>/build/theseus-x86_64.iso [--serial pty]
+    parser = argparse.ArgumentParser(description="Boot a built Theseus ISO in QEMU and ping over its e1000")
+    parser.add_argument("--iso", default=DEFAULT_ISO, help="ISO built by `gmake iso`")
+    parser.add_argument("--serial", choices=("socket", "pty"), default="socket", help="serial port backend")
+    parser.add_argument("--qemu", default="qemu-system-x86_64", help="QEMU binary")
+    parser.add_argument("--gdb-port", type=int, help="start a gdb server on this port")
+    parser.add_argument("--kvm", action="store_true", help="use KVM and the host CPU")
+    args = parser.parse_args()
+
     signal.signal(signal.SIGTERM, cleanup)
     signal.signal(signal.SIGINT, cleanup)
 
-    thread = threading.Thread(target=capture_ttys)
-    thread.start()
-
+    vm = TheseusVM(
+        args.iso, args.serial, args.qemu, ["-accel", "kvm", "-cpu", "host"] if args.kvm else [], args.gdb_port
+    )
+    vms.append(vm)
     print("Waiting for Theseus to boot...", flush=True)
-    ready_event.wait()
+    try:
+        fds = vm.start()
+    except (OSError, RuntimeError) as e:
+        print(f"❌ QEMU failed to boot Theseus: {e}", flush=True)
+        cleanup()
+    threading.Thread(target=forward_log, args=(fds["serial0"],), daemon=True).start()
 
-    if not error_found:
-        perform_unit_test(debug_dev, terminal_dev)
+    perform_unit_test(fds["serial1"])
 
     cleanup()
-
-    thread.join()
@@ -1,34 +1,65 @@
-import subprocess
+import argparse
+import contextvars
+import json
+import os
+import re
+import threading
 import time
 import traceback
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
 from utils.openai import (
     generate_test_analysis,
     generate_code,
     generate_build_analysis,
     generate_code_safety_analysis,
     generate_code_generation_failure_analysis,
+    record_run,
 )
-from utils.io import Timer, run_command_with_timeout
-from utils.logger import Logger
-from utils.misc import count_unsafe
+from utils.io import Timer, describe_patterns
+from utils.crate import Crate, discover_files, merge_text
+from utils.logger import Logger, LogWriter
+from utils.metrics import metrics
+from utils.unsafe_counter import UnsafeCounter
 from utils.strategizer import Strategizer, StrategyStatus
+from utils.workspace import Candidate, Workspace, WorkspacePool
 from config import *
 
 
+class BuildCommandError(Exception):
+    """The build analysis found that the build itself is broken (not the generated code), so no strategy can work."""
+
+
 class Oxidizer:
     MAX_GENERATION_RETRIES = 5
     MAX_PROMPTS = 10
 
-    def __init__(self):
-        self.logger = Logger()
+    def __init__(self, resume=None, code_path=CODE_PATH, crate=None, log_path=None, counter=None):
+        """In crate mode, one Oxidizer runs per file: code_path is the file, crate the shared Crate its improvements
+        are merged into, log_path the file's own log folder and counter the UnsafeCounter discover_files made for
+        the file. Its candidates are always evaluated in the crate's workspaces, never in CRATE_PATH itself."""
+        self.code_path = code_path
+        self.crate = crate
+        self.logger = Logger(resume, code_path, log_path)
+        if crate is None:
+            record_run(self.logger.run_dir, self.logger.resumed)
         self.strategizer = Strategizer(self.logger)
         self.best_code = None
         self.best_toml = None
+        self.unsafe_counter = counter
+        self.workspace = Workspace()
+        # Candidate of the attempt in progress, which keeps its pool workspace until the attempt is over
+        self.candidate = None
+        self.workspace_pool = crate.workspace_pool if crate else WorkspacePool(NUM_CANDIDATES)
+        if NUM_CANDIDATES > 1 or ISOLATED_WORKSPACES:
+            # Warm the build workers while the first prompts are generated
+            self.workspace_pool.start()
 
     def run(self):
-        with open(CODE_PATH, "r", encoding="utf-8") as f:
+        with open(self.code_path, "r", encoding="utf-8") as f:
             current_code = f.read()
-            self.current_unsafe_lines, _ = count_unsafe(current_code)
+            if self.unsafe_counter is None or self.unsafe_counter.code != current_code:
+                self.unsafe_counter = UnsafeCounter(current_code)
+            self.current_unsafe_lines = self.unsafe_counter.num_unsafe_lines
             self.best_code = current_code
 
         if CARGO_PATH:
@@ -37,16 +68,55 @@ class Oxidizer:
                 self.best_toml = cargo_toml
                 self.logger.log_to_run(f"Using Cargo.toml at {CARGO_PATH}")
 
-        self.logger.begin_run(self.current_unsafe_lines)
+        interrupted_strategy = None
+        if self.logger.resumed:
+            checkpoint = self.logger.load_checkpoint()
+            self.best_code = checkpoint["best_code"]
+            self.best_toml = checkpoint["best_toml"]
+            self.unsafe_counter = UnsafeCounter(self.best_code)
+            self.current_unsafe_lines = self.unsafe_counter.num_unsafe_lines
+            self.strategizer.restore(checkpoint["strategies"])
+            interrupted_strategy = checkpoint["strategy"]
+            self.logger.log_to_run(
+                f"\nResumed from checkpoint: {self.current_unsafe_lines} unsafe lines after "
+                f"{len(checkpoint['strategies'])} strategies"
+            )
+        else:
+            self.logger.begin_run(self.current_unsafe_lines)
 
         # Main loop:
         while True:
-            with Timer("Generating new strategy..."):
-                strategy_prompt = self.strategizer.generate_strategy(self.best_code, self.best_toml)
+            if interrupted_strategy:
+                strategy_prompt = interrupted_strategy["prompt"]
+                self.logger.resume_strategy(
+                    interrupted_strategy["num"], strategy_prompt, interrupted_strategy["num_attempts"]
+                )
+                resume_state = (
+                    interrupted_strategy["task_description"],
+                    interrupted_strategy["num_attempts"],
+                    interrupted_strategy["time_taken"],
+                )
+                interrupted_strategy = None
+            else:
+                if self.crate and self.crate.stopped.is_set():
+                    self.logger.log_status("The crate run was stopped. Exiting.")
+                    break
+                if self.crate:
+                    # Start from the Cargo.toml as merged with the other files' changes
+                    _, _, self.best_toml = self.crate.snapshot(self.code_path)
+                self.save_checkpoint()
+                with Timer("Generating new strategy..."), metrics.span("strategy_generation"):
+                    strategy_prompt = self.strategizer.generate_strategy(self.best_code, self.best_toml)
+                resume_state = ()
 
-            result, new_code, new_toml, attempts, time_taken = self.run_strategy(
-                strategy_prompt, self.best_code, self.best_toml
-            )
+            with metrics.span("strategy") as span:
+                try:
+                    result, new_code, new_toml, attempts, time_taken = self.run_strategy(
+                        strategy_prompt, self.best_code, self.best_toml, *resume_state
+                    )
+                finally:
+                    self.release_candidate(self.candidate)
+                span.set(outcome=result.name.lower(), attempts=attempts)
             self.strategizer.add_strategy(strategy_prompt, result, attempts, time_taken, self.current_unsafe_lines)
 
             if result == StrategyStatus.SUCCESS:
@@ -62,12 +132,40 @@ class Oxidizer:
                 self.logger.log_status("Encountered 10 consecutive failed strategies. Exiting due to lack of progress.")
                 break
 
-    def run_strategy(self, strategy_prompt, current_code, current_toml):
-        task_description = strategy_prompt
-        num_attempts = 0
-        strategy_start_time = time.time()
+        # Record the final state, for the batch runner's results and so a resumed run doesn't redo the last strategy
+        self.save_checkpoint()
+
+    def save_checkpoint(self, strategy=None):
+        """Checkpoint the loop. strategy is the state of the strategy in progress, if any. Checkpoints between
+        strategies are made durable right away, those within one only with the next sync."""
+        self.logger.save_checkpoint(
+            self.best_code,
+            self.best_toml,
+            sync=strategy is None,
+            unsafe_lines=self.current_unsafe_lines,
+            strategies=self.strategizer.get_state(),
+            strategy=strategy,
+        )
+
+    def run_strategy(
+        self, strategy_prompt, current_code, current_toml, task_description=None, num_attempts=0, time_taken=0.0
+    ):
+        """Run a strategy until it succeeds or is given up on. A resumed strategy passes the task description of
+        its next attempt, the number of attempts already made and the time they took."""
+        task_description = task_description or strategy_prompt
+        strategy_start_time = time.time() - time_taken
 
         while True:
+            self.release_candidate(self.candidate)
+            self.save_checkpoint(
+                {
+                    "num": self.logger.strategy_num,
+                    "prompt": strategy_prompt,
+                    "task_description": task_description,
+                    "num_attempts": num_attempts,
+                    "time_taken": time.time() - strategy_start_time,
+                }
+            )
             attempt_start_time = time.time()
             self.logger.log_prompt(task_description)
             num_attempts += 1
@@ -82,64 +180,72 @@ class Oxidizer:
 
             # Step 1: Generate new code via patch file
             step_start_time = time.time()
-            with Timer("Generating code..."):
-                break_loop = False
-                for generation_attempt in range(1, self.MAX_GENERATION_RETRIES + 1):
-                    try:
-                        replacements, new_code, new_toml = generate_code(task_description, current_code, current_toml, generation_attempt, self.logger)
-                        self.logger.log_generated_code(
-                            replacements, new_code, new_toml, generation_attempt, time.time() - step_start_time
-                        )
-                        break
-                    except Exception as e:
-                        print(f"\nError: {e} (Attempt {generation_attempt}/{self.MAX_GENERATION_RETRIES})")
-                        if generation_attempt == self.MAX_GENERATION_RETRIES:
-                            self.logger.log_status(
-                                "Max code generation retries reached. Aborting.", time.time() - step_start_time
-                            )
-                            analysis = generate_code_generation_failure_analysis(
-                                task_description,
-                                current_code,
-                                self.MAX_GENERATION_RETRIES,
-                                strategy_prompt,
-                            )
-                            task_description = analysis
-                            self.logger.log_status(f"Attempt took {time.time() - attempt_start_time:.2f}s")
-                            break_loop = True
-                            break
-
-                if break_loop:
-                    continue
+            if NUM_CANDIDATES > 1 or self.crate or ISOLATED_WORKSPACES:
+                with Timer(f"Generating and evaluating {NUM_CANDIDATES} candidates..."):
+                    candidate = self.run_candidates(task_description, current_code, current_toml)
+            else:
+                with Timer("Generating code..."):
+                    candidate = self.generate_candidate(task_description, current_code, current_toml)
+                if candidate:
+                    candidate.workspace = self.workspace
+            self.candidate = candidate
+
+            if candidate is None:
+                self.logger.log_status("Max code generation retries reached. Aborting.", time.time() - step_start_time)
+                with metrics.span("generation_failure_analysis"):
+                    analysis = generate_code_generation_failure_analysis(
+                        task_description,
+                        current_code,
+                        self.MAX_GENERATION_RETRIES,
+                        strategy_prompt,
+                    )
+                task_description = analysis
+                self.logger.log_status(f"Attempt took {time.time() - attempt_start_time:.2f}s")
+                continue
 
-            with open(CODE_PATH, "w", encoding="utf-8") as f:
-                f.write(new_code)
+            new_code, new_toml = candidate.new_code, candidate.new_toml
+            self.logger.log_generated_code(
+                candidate.replacements,
+                new_code,
+                new_toml,
+                candidate.generation_attempt,
+                time.time() - step_start_time,
+                current_code,
+                current_toml,
+                candidate.code_edits,
+            )
+            if candidate.workspace is self.workspace:
+                self.workspace.write(new_code, new_toml)
 
             # Step 2: Compile the code
             step_start_time = time.time()
             with Timer("Building..."):
-                process = subprocess.run(BUILD_CMD, shell=True, capture_output=True, text=True)
-            build_output = f"[Return code: {process.returncode}]\n {process.stderr}"
-            self.logger.log_verbose(f"Build output:\n{build_output}")
+                returncode, stderr = candidate.build(base_counter=self.unsafe_counter)
+            build_output = f"[Return code: {returncode}]\n {stderr}"
+            self.logger.log_verbose(
+                f"Build output ({candidate.build_tier}{', cached' if candidate.build_cached else ''}):\n{build_output}"
+            )
 
-            if process.returncode == 0 and process.stderr == "":
+            if returncode == 0 and stderr == "":
                 self.logger.log_status("Compilation ✅", time.time() - step_start_time)
             else:
-                with Timer("Analyzing compilation..."):
+                with Timer("Analyzing compilation..."), metrics.span("build_analysis"):
                     analysis = generate_build_analysis(
-                        task_description, new_code, build_output, strategy_prompt, current_code
+                        task_description, new_code, build_output, strategy_prompt, current_code, self.code_path
                     )
 
                 if analysis.lower().startswith("good"):
                     self.logger.log_status("Compilation ✅", time.time() - step_start_time)
                 elif analysis.lower().startswith("bad: "):
-                    self.logger.log_status("Compilation ❌", time.time() - step_start_time)
+                    tier = f" ({candidate.build_tier})" if candidate.build_tier != "build" else ""
+                    self.logger.log_status(f"Compilation ❌{tier}", time.time() - step_start_time)
                     task_description = analysis[5:]
                     self.logger.log_status(f"Attempt took {time.time() - attempt_start_time:.2f}s")
                     continue
                 elif analysis.lower().startswith("stop: "):
                     self.logger.log_status("Compilation ❌ (build command error)", time.time() - step_start_time)
                     self.logger.log_status(f"Build command error: {analysis[6:]}")
-                    exit(1)
+                    raise BuildCommandError(analysis[6:])
                 else:
                     self.logger.log_status("Analysis unsuccessful, retrying...", time.time() - step_start_time)
                     self.logger.log_status(f"Attempt took {time.time() - attempt_start_time:.2f}s")
@@ -148,21 +254,30 @@ class Oxidizer:
             # Step 3: Run a testing script to check if the code works
             step_start_time = time.time()
             with Timer("Running test script..."):
-                run_output = run_command_with_timeout(TEST_CMD, TEST_TIMEOUT, TEST_EXPECTED_OUTPUT)
+                test_result = candidate.test()
+            run_output = test_result.output
+            if candidate.test_cached:
+                self.logger.log_verbose("Test output served from cache")
+            else:
+                hang_timeout = f"{test_result.hang_timeout}s" if test_result.hang_timeout else "off"
+                self.logger.log_verbose(
+                    f"Test timeout {test_result.timeout}s, hang timeout {hang_timeout} ({test_result.timeout_basis}); "
+                    f"took {test_result.duration}s, longest silence {test_result.max_gap}s"
+                )
 
-            if TEST_EXPECTED_OUTPUT in run_output:
+            if test_result.passed:
                 self.logger.log_status("Test script ✅", time.time() - step_start_time)
             else:
-                self.logger.log_status("Test script ❌", time.time() - step_start_time)
-                self.logger.log_status(f"Expected output: {TEST_EXPECTED_OUTPUT}")
+                self.logger.log_status(f"Test script ❌ ({test_result.verdict})", time.time() - step_start_time)
+                self.logger.log_status(f"Expected output: {describe_patterns(TEST_EXPECTED_OUTPUT)}")
                 self.logger.log_status(f"Output: {run_output}")
                 step_start_time = time.time()
-                with Timer("Analyzing test script..."):
+                with Timer("Analyzing test script..."), metrics.span("test_analysis"):
                     analysis = generate_test_analysis(
                         task_description,
                         current_code,
                         new_code,
-                        f"The excpected output was:\n{TEST_EXPECTED_OUTPUT}\nThe output from running the program was:\n{run_output}",
+                        f"The excpected output was:\n{describe_patterns(TEST_EXPECTED_OUTPUT)}\nThe output from running the program was:\n{run_output}",
                         strategy_prompt,
                     )
                     task_description = analysis
@@ -173,13 +288,13 @@ class Oxidizer:
             # Step 4: Compare lines of unsafe code
             step_start_time = time.time()
             num_old_unsafe_lines = self.current_unsafe_lines
-            num_new_unsafe_lines, _ = count_unsafe(new_code)
+            num_new_unsafe_lines = candidate.count_unsafe(self.unsafe_counter)
             self.logger.log_status(
                 f"Result: {num_old_unsafe_lines} unsafe lines -> {num_new_unsafe_lines} unsafe lines"
             )
             if num_old_unsafe_lines <= num_new_unsafe_lines:
                 self.logger.log_status("Code safety improved ❌")
-                with Timer("Analyzing why new code is not safer..."):
+                with Timer("Analyzing why new code is not safer..."), metrics.span("safety_analysis"):
                     analysis = generate_code_safety_analysis(
                         task_description,
                         current_code,
@@ -215,8 +330,22 @@ class Oxidizer:
                             time.time() - strategy_start_time,
                         )
             else:
+                if self.crate:
+                    # Validating the merge takes a workspace of its own
+                    self.release_candidate(candidate)
+                    conflict, new_toml = self.crate.merge(self.code_path, candidate)
+                    if conflict:
+                        self.logger.log_status(f"Code safety improved ✅, but {conflict} ❌")
+                        return (
+                            StrategyStatus.MERGE_CONFLICT,
+                            new_code,
+                            new_toml,
+                            num_attempts,
+                            time.time() - strategy_start_time,
+                        )
                 self.logger.log_status("Code safety improved ✅")
                 self.current_unsafe_lines = num_new_unsafe_lines
+                self.unsafe_counter = candidate.unsafe_counter
                 return (
                     StrategyStatus.SUCCESS,
                     new_code,
@@ -225,13 +354,237 @@ class Oxidizer:
                     time.time() - strategy_start_time,
                 )
 
+    def generate_candidate(self, task_description, current_code, current_toml, label=None, cancel_event=None):
+        """Generate a patch, retrying up to MAX_GENERATION_RETRIES times. Returns None if every attempt failed, or
+        as soon as cancel_event is set."""
+        crate_state = {}
+        if self.crate:
+            crate_version, other_files, crate_toml = self.crate.snapshot(self.code_path)
+            crate_state = dict(
+                code_path=self.code_path, other_files=other_files, crate_version=crate_version, base_toml=crate_toml
+            )
+        for generation_attempt in range(1, self.MAX_GENERATION_RETRIES + 1):
+            if cancel_event and cancel_event.is_set():
+                return None
+            try:
+                with metrics.span("code_generation", attempt=generation_attempt, candidate=label):
+                    replacements, new_code, new_toml, code_edits = generate_code(
+                        task_description,
+                        current_code,
+                        current_toml,
+                        generation_attempt if label is None else f"{label}-{generation_attempt}",
+                        self.logger,
+                        cancel_event,
+                    )
+                if self.crate and CARGO_PATH:
+                    # Build with the Cargo.toml changes other files merged since this strategy started
+                    new_toml = merge_text(current_toml, new_toml, crate_toml)
+                    if new_toml is None:
+                        raise ValueError("Cargo.toml changes conflict with changes merged from other files")
+                return Candidate(replacements, new_code, new_toml, code_edits, generation_attempt, **crate_state)
+            except CancelledError:
+                return None
+            except Exception as e:
+                print(f"\nError: {e} (Attempt {generation_attempt}/{self.MAX_GENERATION_RETRIES})")
+        return None
+
+    def run_candidates(self, task_description, current_code, current_toml):
+        """Generate NUM_CANDIDATES patches for the same prompt and build/test each in a free warm workspace.
+
+        The first candidate that compiles, passes the test and reduces the unsafe count wins and the rest are
+        cancelled. If none does, the lowest-numbered candidate is returned so the attempt is analyzed the same
+        way as in the serial loop. The returned candidate keeps its workspace until release_candidate().
+        """
+        cancel_event = threading.Event()
+
+        def evaluate(index):
+            candidate = self.generate_candidate(
+                task_description, current_code, current_toml, label=f"c{index + 1}", cancel_event=cancel_event
+            )
+            if candidate is None or cancel_event.is_set():
+                return candidate, False
+            workspace = self.workspace_pool.acquire()
+            if cancel_event.is_set():
+                self.workspace_pool.release(workspace)
+                return candidate, False
+            try:
+                accepted = candidate.evaluate(workspace, self.unsafe_counter, cancel_event)
+            except BaseException:
+                self.workspace_pool.release(workspace)
+                raise
+            if accepted:
+                cancel_event.set()
+            return candidate, accepted
+
+        executor = ThreadPoolExecutor(max_workers=NUM_CANDIDATES)
+        # Each thread gets its own copy of the context so its spans are nested under the current strategy
+        futures = [executor.submit(contextvars.copy_context().run, evaluate, i) for i in range(NUM_CANDIDATES)]
+        chosen = None
+        try:
+            for future in as_completed(futures):
+                candidate, accepted = future.result()
+                if accepted:
+                    self.logger.log_verbose(f"Accepted candidate {futures.index(future) + 1}/{NUM_CANDIDATES}")
+                    chosen = candidate
+                    break
+            else:
+                chosen = next((future.result()[0] for future in futures if future.result()[0]), None)
+        finally:
+            # The other candidates abort their LLM requests, builds and tests, and are waited for so none of them logs
+            # under the next prompt or holds on to a workspace
+            cancel_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future in futures:
+                if future.cancelled() or future.exception() is not None:
+                    continue
+                candidate = future.result()[0]
+                if candidate is not chosen:
+                    self.release_candidate(candidate)
+        return chosen
+
+    def release_candidate(self, candidate):
+        """Return the pool workspace candidate was evaluated in, if it holds one."""
+        if candidate is None or candidate.workspace is None or candidate.workspace is self.workspace:
+            return
+        self.workspace_pool.release(candidate.workspace)
+        candidate.workspace = None
+
+
+class CrateOxidizer:
+    """Whole-crate mode: an Oxidizer per .rs file of CRATE_PATH that contains unsafe code, CRATE_PARALLEL_FILES at
+    a time and most unsafe lines first, all merging their improvements into one Crate.
+
+    Logs go to LOG_PATH/crate: each file has its own log folder under files/, and each crate run a folder with the
+    summary, the metrics trace and the merged best version of every changed file (best/).
+    """
+
+    def __init__(self):
+        self.log_path = os.path.join(LOG_PATH, "crate")
+        os.makedirs(self.log_path, exist_ok=True)
+        run_dirs = [d for d in os.listdir(self.log_path) if re.fullmatch(r"run\d{3}", d)]
+        self.run_dir = os.path.join(self.log_path, f"run{max((int(d[3:]) for d in run_dirs), default=0) + 1:03d}")
+        os.makedirs(self.run_dir)
+        self.writer = LogWriter()
+        metrics.open_trace(os.path.join(self.run_dir, "trace.jsonl"))
+
+        counters = discover_files()
+        self.files = [(path, counter.num_unsafe_lines) for path, counter in counters]
+        # Each file's counter until its Oxidizer takes it over
+        self.counters = dict(counters)
+        code = {path: counter.code for path, counter in counters}
+        toml = None
+        if CARGO_PATH:
+            with open(CARGO_PATH, "r", encoding="utf-8") as f:
+                toml = f.read()
+        self.crate = Crate(code, toml, self.writer, os.path.join(self.run_dir, "best"))
+        # Unsafe lines per file once its loop has finished (None if it crashed)
+        self.results = {}
+        # The BuildCommandError that stopped the crate run, if any
+        self.build_error = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        self.log(f"{len(self.files)} files with unsafe code in {CRATE_PATH}:")
+        for path, num_unsafe_lines in self.files:
+            self.log(f"  {num_unsafe_lines:>6}  {self.relpath(path)}")
+        self.crate.workspace_pool.start()
+
+        pending = list(reversed(self.files))
+        # Daemon threads rather than an executor, so an interrupt doesn't wait for every file's loop
+        threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run, args=(self.run_files, pending), name=f"file-{i}", daemon=True
+            )
+            for i in range(min(CRATE_PARALLEL_FILES, len(self.files)))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.finish()
+        if self.build_error:
+            raise self.build_error
+
+    def run_files(self, pending):
+        while True:
+            with self.lock:
+                if not pending:
+                    return
+                path, _ = pending.pop()
+                counter = self.counters.pop(path, None)
+            result = None
+            with metrics.span("file", path=self.relpath(path)):
+                try:
+                    oxidizer = Oxidizer(
+                        code_path=path,
+                        crate=self.crate,
+                        log_path=os.path.join(self.log_path, "files", self.relpath(path).replace(os.sep, "__")),
+                        counter=counter,
+                    )
+                    oxidizer.run()
+                    result = oxidizer.current_unsafe_lines
+                except BuildCommandError as e:
+                    # Every file shares the build, so no other file is started and those running stop after their
+                    # current strategy
+                    result = oxidizer.current_unsafe_lines
+                    self.log(f"\n{self.relpath(path)} stopped the crate run: build command error: {e}")
+                    with self.lock:
+                        self.build_error = self.build_error or e
+                        pending.clear()
+                    self.crate.stopped.set()
+                except Exception:
+                    self.log(f"\n{self.relpath(path)} crashed:\n{traceback.format_exc()}")
+                    traceback.print_exc()
+            with self.lock:
+                self.results[path] = result
+            self.log(f"\nFinished {self.relpath(path)}: {result} unsafe lines remaining")
+
+    def finish(self):
+        lines = [f"\n{'File':<60}{'before':>8}{'after':>8}"]
+        for path, num_unsafe_lines in self.files:
+            result = self.results.get(path)
+            lines.append(f"{self.relpath(path):<60}{num_unsafe_lines:>8}{'-' if result is None else result:>8}")
+        total_before = sum(num_unsafe_lines for _, num_unsafe_lines in self.files)
+        total_after = sum(
+            num_unsafe_lines if self.results.get(path) is None else self.results[path]
+            for path, num_unsafe_lines in self.files
+        )
+        lines.append(f"{'Total':<60}{total_before:>8}{total_after:>8}")
+        self.log("\n".join(lines))
+        print("\n".join(lines))
+        self.log(f"\nTiming by phase (seconds):\n{metrics.format_summary()}")
+        self.writer.write(os.path.join(self.run_dir, "metrics.json"), json.dumps(metrics.summary(), indent=4))
+        self.writer.close()
+        metrics.close()
+        print("Crate logs saved to ", self.run_dir)
+        if self.crate.version:
+            print("Merged best code saved to ", os.path.join(self.run_dir, "best"))
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.expanduser(path), os.path.expanduser(CRATE_PATH))
+
+    def log(self, message):
+        self.writer.append(os.path.join(self.run_dir, "summary.log"), message + "\n")
+
 
 if __name__ == "__main__":
-    oxidizer = Oxidizer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", metavar="runNNN", help="continue an interrupted run from its last checkpoint")
+    args = parser.parse_args()
+    if CRATE_MODE and args.resume:
+        parser.error("--resume is not supported in crate mode")
+    oxidizer = CrateOxidizer() if CRATE_MODE else Oxidizer(args.resume)
     try:
         oxidizer.run()
     except KeyboardInterrupt:
         print("\nExiting program via keyboard interrupt.")
+    except BuildCommandError as e:
+        print(f"\nStopped: build command error: {e}")
+        exit(1)
     except Exception as e:
         print("\nProgram crashed with exception:")
         traceback.print_exc()
+        # Lets the batch runner tell a crash from a finished run
+        exit(1)
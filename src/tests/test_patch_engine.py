@@ -0,0 +1,78 @@
+import json
+import random
+
+import pytest
+
+from utils import misc
+from utils.misc import PatchEngine, PatchError, patch_code
+from utils.patch_stream import StreamingPatcher
+
+CODE = "fn a() {\n    x();\n}\n\nfn b() {\n    y();\n}\n"
+RESPONSE = json.dumps(
+    {
+        "replacements": [
+            {"original": "missing();", "new": ""},
+            {"original": "x();", "new": "z();"},
+            {"original": "fn", "new": "pub fn"},
+            {"original": "fn a() {\n    x", "new": ""},
+        ]
+    }
+)
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 7, 1024])
+def test_to_original(monkeypatch, block_size):
+    monkeypatch.setattr(misc, "MAP_BLOCK_SIZE", block_size)
+    rng = random.Random(block_size)
+    for _ in range(200):
+        code = "".join(rng.choice(["a", "bc", " ", "  ", "\n", "\t\n", "        "]) for _ in range(rng.randint(0, 60)))
+        engine = PatchEngine(code)
+        non_whitespace = [offset for offset, c in enumerate(code) if not c.isspace()]
+        assert engine.normalized == "".join(code.split())
+        assert [engine.to_original(norm_pos) for norm_pos in range(len(non_whitespace))] == non_whitespace
+
+
+def test_whitespace_insensitive_replacement():
+    engine = patch_code(CODE, [{"original": "fn b(){ y(); }", "new": "fn b() {}"}])
+    assert engine.apply() == "fn a() {\n    x();\n}\n\nfn b() {}\n"
+
+
+def test_every_failure_reported():
+    with pytest.raises(PatchError) as error:
+        patch_code(CODE, json.loads(RESPONSE)["replacements"])
+    assert [(index, reason.split(" (")[0]) for index, _, reason in error.value.failures] == [
+        (0, "Replacement string not found in code"),
+        (2, "Replacement string not unique in code"),
+        (3, "Replacement overlaps another replacement"),
+    ]
+
+
+def test_streaming_failures_reported_together():
+    patcher = StreamingPatcher(CODE, None)
+    for start in range(0, len(RESPONSE), 5):
+        patcher.feed(RESPONSE[start : start + 5])
+    with pytest.raises(PatchError) as error:
+        patcher.check()
+    assert [index for index, _, _ in error.value.failures] == [0, 2, 3]
+
+
+def test_streaming_aborts_at_max_failures():
+    patcher = StreamingPatcher(CODE, None, max_failures=2)
+    with pytest.raises(PatchError) as error:
+        for start in range(0, len(RESPONSE), 5):
+            patcher.feed(RESPONSE[start : start + 5])
+    assert [index for index, _, _ in error.value.failures] == [0, 2]
+    assert "generation aborted after 2 failed and 1 applied replacements" in error.value.failures[-1][2]
+
+
+def test_fuzzy_match_recorded_only_when_applied():
+    code = "fn alpha() {\n    let value = compute(1);\n    other(value);\n}\n"
+    near_match = {"original": "let valeu = compute(1);\n    other(value);", "new": ""}
+    engine = PatchEngine(code, fuzzy_threshold=0.7)
+    assert engine.add(near_match) is None
+    assert [similarity > 0.9 for _, _, similarity in engine.fuzzy_matches] == [True]
+
+    engine = PatchEngine(code, fuzzy_threshold=0.7)
+    assert engine.add({"original": "let value = compute(1);", "new": ""}) is None
+    assert engine.add(near_match).startswith("Replacement overlaps another replacement")
+    assert engine.fuzzy_matches == []
@@ -0,0 +1,119 @@
+import os
+import random
+
+import pytest
+
+from utils.unsafe_counter import UnsafeCounter, lex
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(TESTS_DIR)
+
+# (unsafe lines, unsafe blocks). These differ from the old line scanner's counts where it was wrong: test4 (12 -> 9)
+# counted the commented-out unsafe blocks of lines 6-16 and 19-24 and missed lines of the block that the unclosed
+# unsafe { of line 18 runs into, and rfk (460 -> 453) counted the fn pointer type `Option<unsafe extern "C" fn(..)>` of
+# line 91 as an unsafe block, along with the struct after it
+EXPECTED_COUNTS = {
+    "tests/count_unsafe/test1.txt": (1, 1),
+    "tests/count_unsafe/test2.txt": (4, 3),
+    "tests/count_unsafe/test3.txt": (4, 3),
+    "tests/count_unsafe/test4.txt": (9, 2),
+    "examples/quicksort/src/main.rs": (24, 4),
+    "examples/rfk/src/main.rs": (453, 19),
+}
+
+# Fragments the random files are made of: item keywords, delimiters on their own and run together, every kind of
+# string, char, lifetime and comment (including unterminated ones), and the prefixes they share with identifiers
+FRAGMENTS = (
+    "unsafe", "fn", "impl", "trait", "extern", "auto", "struct", "let", "x", "y0", "r", "b", "c", "br",
+    " ", "  ", "\n", "\n    ", "\t", "{", "}", "(", ")", "[", "]", ";", ",", "=", "*", "/", "#", "<", ">", "'",
+    '"', "\\", "1", "2.5", "0x7f", "'a", "'x'", "b'\\n'", "'\\u{10FFFF}'", '"C"', '"s // t"', 'r#"raw "# str"#',
+    "r#ident", "// line comment", "/* block */", "/* nested /* block */ */", "/*", "*/",
+    "unsafe {", "unsafe fn f()", 'unsafe extern "C" {', 'unsafe extern "C" fn', "unsafe impl T for X {",
+    "unsafe auto trait T {}", "fn main() {", "}\n",
+)
+
+
+def random_code(rng, num_fragments):
+    return "".join(rng.choice(FRAGMENTS) for _ in range(num_fragments))
+
+
+def random_edits(rng, code, num_edits):
+    """Non-overlapping (start, end, new_text) replacements of random spans of code."""
+    offsets = sorted(rng.randint(0, len(code)) for _ in range(2 * num_edits))
+    return [
+        (offsets[i], offsets[i + 1] if rng.random() < 0.7 else offsets[i], random_code(rng, rng.randint(0, 6)))
+        for i in range(0, len(offsets), 2)
+    ]
+
+
+def apply_edits(code, edits):
+    for start, end, new_text in sorted(edits, reverse=True):
+        code = code[:start] + new_text + code[end:]
+    return code
+
+
+def assert_same_analysis(counter, expected):
+    assert counter.code == expected.code
+    assert list(counter.starts) == list(expected.starts)
+    assert list(counter.ends) == list(expected.ends)
+    assert counter.kinds == expected.kinds
+    assert list(counter.line_starts) == list(expected.line_starts)
+    assert list(counter.boundaries) == list(expected.boundaries)
+    assert counter.unsafe_lines == expected.unsafe_lines
+    assert counter.num_unsafe_blocks == expected.num_unsafe_blocks
+    assert [
+        (item.kind, item.start, item.end, item.start_line, item.end_line, item.num_lines, item.outermost)
+        for item in counter.items
+    ] == [
+        (item.kind, item.start, item.end, item.start_line, item.end_line, item.num_lines, item.outermost)
+        for item in expected.items
+    ]
+
+
+@pytest.mark.parametrize("path", sorted(EXPECTED_COUNTS))
+def test_counts(path):
+    with open(os.path.join(SRC_DIR, path), "r", encoding="utf-8") as f:
+        counter = UnsafeCounter(f.read())
+    assert (counter.num_unsafe_lines, counter.num_unsafe_blocks) == EXPECTED_COUNTS[path]
+
+
+def test_comment_markers_in_strings():
+    code = 'fn f() {\n    unsafe {\n        let s = "// not a comment";\n        let t = "/* nor this";\n    }\n}\n'
+    counter = UnsafeCounter(code)
+    assert counter.unsafe_lines == [3, 4]
+
+
+def test_fn_pointer_types_are_not_items():
+    code = 'type Handler = Option<unsafe extern "C" fn(i32)>;\nstruct S {\n    x: i32,\n}\n'
+    counter = UnsafeCounter(code)
+    assert (counter.num_unsafe_lines, counter.num_unsafe_blocks) == (0, 0)
+
+
+def test_lexing_from_a_token_boundary():
+    rng = random.Random(0)
+    for _ in range(500):
+        code = random_code(rng, rng.randint(0, 40))
+        tokens = list(lex(code))
+        for index in range(len(tokens)):
+            assert list(lex(code, tokens[index][0])) == tokens[index:]
+
+
+def test_with_edits_matches_full_analysis():
+    rng = random.Random(1)
+    for _ in range(2000):
+        code = random_code(rng, rng.randint(0, 60))
+        edits = random_edits(rng, code, rng.randint(1, 3))
+        new_code = apply_edits(code, edits)
+        assert_same_analysis(UnsafeCounter(code).with_edits(edits), UnsafeCounter(new_code))
+
+
+def test_with_code_matches_full_analysis():
+    rng = random.Random(2)
+    base = "".join(
+        f"fn safe_{i}() {{\n    let x = {i};\n}}\n\nunsafe fn raw_{i}(p: *mut u8) {{\n    *p = {i};\n}}\n"
+        for i in range(20)
+    )
+    counter = UnsafeCounter(base)
+    for _ in range(500):
+        new_code = apply_edits(base, random_edits(rng, base, rng.randint(1, 3)))
+        assert_same_analysis(counter.with_code(new_code), UnsafeCounter(new_code))
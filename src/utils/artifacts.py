@@ -0,0 +1,141 @@
+import difflib
+import hashlib
+import json
+import os
+import sys
+import threading
+import zlib
+
+# Deltas are resolved by walking up the parent chain, so a version this many deltas away from a full copy is stored
+# in full instead
+MAX_CHAIN_LENGTH = 32
+
+
+def line_edits(parent, text):
+    """(start, end, new) edits turning parent into text, found with a line diff."""
+    parent_lines = parent.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    offsets = [0]
+    for line in parent_lines:
+        offsets.append(offsets[-1] + len(line))
+    matcher = difflib.SequenceMatcher(None, parent_lines, lines, autojunk=False)
+    return [
+        (offsets[i1], offsets[i2], "".join(lines[j1:j2]))
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def apply_edits(parent, edits):
+    parts = []
+    pos = 0
+    for start, end, new in edits:
+        parts.append(parent[pos:start])
+        parts.append(new)
+        pos = end
+    parts.append(parent[pos:])
+    return "".join(parts)
+
+
+class ArtifactStore:
+    """Content-addressed store for the code, Cargo.toml and LLM responses produced during runs.
+
+    Every version is identified by the sha256 of its text, so identical versions are stored once. A version with a
+    known parent (e.g. a candidate and the code it was generated from) is stored as a zlib-compressed list of edits
+    against that parent, everything else as compressed full text. get() rebuilds any version from its chain.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.depths = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def read(self, key):
+        with open(self.path(key), "rb") as f:
+            return json.loads(zlib.decompress(f.read()))
+
+    def write(self, key, obj):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(json.dumps(obj).encode("utf-8")))
+        os.replace(tmp_path, path)
+
+    def depth(self, key):
+        if key not in self.depths:
+            self.depths[key] = self.read(key).get("depth", 0)
+        return self.depths[key]
+
+    def put(self, text, parent=None, edits=None):
+        """Store text, as a delta against parent if given (using edits if they are known to turn parent into text).
+        Returns its key."""
+        key = self.key(text)
+        with self.lock:
+            if key in self.depths or os.path.exists(self.path(key)):
+                return key
+        if parent is not None:
+            parent_key = self.put(parent)
+            with self.lock:
+                depth = self.depth(parent_key) + 1
+            if depth <= MAX_CHAIN_LENGTH:
+                if edits is None:
+                    edits = line_edits(parent, text)
+                obj = {"parent": parent_key, "depth": depth, "edits": [list(edit) for edit in edits]}
+                with self.lock:
+                    self.write(key, obj)
+                    self.depths[key] = depth
+                return key
+        with self.lock:
+            self.write(key, {"text": text})
+            self.depths[key] = 0
+        return key
+
+    def get(self, key):
+        chain = []
+        obj = self.read(key)
+        while "text" not in obj:
+            chain.append(obj["edits"])
+            obj = self.read(obj["parent"])
+        text = obj["text"]
+        for edits in reversed(chain):
+            text = apply_edits(text, edits)
+        return text
+
+    def export(self, strategy_dir, out_dir=None):
+        """Materialize the files listed in a strategy's artifacts.jsonl (code{N}.rs, toml{N}.toml,
+        replacements{N}.json and generation_attempts/{N}-{attempt}.json) into out_dir."""
+        out_dir = out_dir or strategy_dir
+        with open(os.path.join(strategy_dir, "artifacts.jsonl"), "r", encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f]
+        for entry in entries:
+            for name, key in entry["files"].items():
+                path = os.path.join(out_dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                text = self.get(key)
+                if name.endswith(".json"):
+                    try:
+                        text = json.dumps(json.loads(text), indent=4)
+                    except json.JSONDecodeError:
+                        # A generation attempt aborted mid-stream
+                        pass
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(text)
+
+
+if __name__ == "__main__":
+    # python src/utils/artifacts.py src/log/run001/strategy001 [out_dir]
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <strategy dir> [output dir]")
+        sys.exit(1)
+    strategy_dir = os.path.abspath(sys.argv[1])
+    store = ArtifactStore(os.path.join(os.path.dirname(os.path.dirname(strategy_dir)), "artifacts"))
+    store.export(strategy_dir, sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    """Persistent on-disk cache of LLM responses, one file per response, keyed by a hash of the request.
+
+    mode is "off" (always call the API), "on" (serve hits, store misses) or "replay" (serve hits, raise
+    CacheMissError on misses so a run can be reproduced offline). Entries not used for max_age_days are dropped,
+    and the least recently used entries are dropped once the cache grows past max_size_mb.
+    """
+
+    EVICT_EVERY = 50
+
+    def __init__(self, cache_dir, mode="off", max_size_mb=512, max_age_days=30):
+        if mode not in ("off", "on", "replay"):
+            raise ValueError(f"Invalid LLM cache mode: {mode}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.writes = 0
+        # The current run's own responses, whatever the mode (see record_run)
+        self.run_responses = None
+        if mode != "off":
+            os.makedirs(cache_dir, exist_ok=True)
+            self.evict()
+
+    @staticmethod
+    def key(model, prompt, schema=None, sample=0):
+        """sample distinguishes repeated requests for the same prompt (retries, parallel candidates)."""
+        request = json.dumps({"model": model, "prompt": prompt, "schema": schema, "sample": str(sample)}, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def record_run(self, run_dir, replay=False):
+        """Also keep every response in run_dir. With replay (a resumed run), the responses the interrupted run kept
+        there are served first, so the attempt it was in the middle of isn't paid for again."""
+        self.run_responses = RunResponses(run_dir, replay)
+
+    def get(self, key):
+        if self.run_responses:
+            response = self.run_responses.get(key)
+            if response is not None:
+                return response
+        if self.mode == "off":
+            return None
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+            os.utime(self.path(key))
+            return response
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            if self.mode == "replay":
+                raise CacheMissError(f"No cached LLM response for request {key} (replay mode)")
+            return None
+
+    def put(self, key, response):
+        if self.run_responses:
+            self.run_responses.put(key, response)
+        if self.mode == "off":
+            return
+        # Unique per process and thread, since batch runs share the cache between processes
+        tmp_path = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "response": response}, f)
+        os.replace(tmp_path, self.path(key))
+
+        with self.lock:
+            self.writes += 1
+            should_evict = self.writes % self.EVICT_EVERY == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(entry.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    # Evicted by another process sharing the cache
+                    pass
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+class RunResponses(ResponseCache):
+    """The LLM responses of one run, kept in its folder and never evicted. When replaying, they are served until the
+    first request that isn't among them: from then on the resumed run has diverged from the interrupted one, and
+    serving its old responses would only repeat its trajectory."""
+
+    def __init__(self, cache_dir, replay):
+        super().__init__(cache_dir, "on")
+        self.replaying = replay
+
+    def get(self, key):
+        if not self.replaying:
+            return None
+        response = super().get(key)
+        if response is None:
+            self.replaying = False
+        return response
+
+    def evict(self):
+        pass
+
+
+class BuildCache(ResponseCache):
+    """Build and test results keyed by a hash of the code, Cargo.toml and the commands that produced them.
+
+    Files other than CODE_PATH and CARGO_PATH (or, in crate mode, the files being optimized) are assumed not to
+    change; clear the cache if they do.
+    """
+
+    @staticmethod
+    def key(code, toml, *commands):
+        # default=str covers compiled test patterns
+        request = json.dumps({"code": code, "toml": toml, "commands": commands}, default=str)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
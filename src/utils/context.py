@@ -0,0 +1,222 @@
+import os
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+from utils.unsafe_counter import (
+    UnsafeCounter,
+    OPEN_BRACE,
+    CLOSE_BRACE,
+    OPEN_PAREN,
+    CLOSE_PAREN,
+    OPEN_BRACKET,
+    CLOSE_BRACKET,
+    SEMICOLON,
+    FN,
+    IMPL,
+    TRAIT,
+    EXTERN,
+    IDENT,
+)
+from config import CODE_PATH, CONTEXT_SELECTION, CONTEXT_SELECTION_MIN_LINES, CRATE_PATH
+
+OPENING = (OPEN_BRACE, OPEN_PAREN, OPEN_BRACKET)
+CLOSING = (CLOSE_BRACE, CLOSE_PAREN, CLOSE_BRACKET)
+ITEM_KEYWORDS = {"struct", "enum", "union", "mod", "static", "const", "type", "use", "macro_rules"}
+# Items that are cheap and almost always needed to understand the rest, so they are never elided
+ALWAYS_SHOWN = {"use", "static", "const", "type", "macro_rules", "other"}
+# Type definitions up to this many lines are shown in full even if nothing points at them
+SHORT_DEFINITION_LINES = 30
+CONTAINERS = {"impl", "trait", "mod", "extern"}
+OMITTED = "{ /* omitted */ }"
+IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+ERROR_LOCATION = re.compile(r"-->\s*([^\s:]+):(\d+):\d+")
+
+
+def error_lines(error_output, code_path=CODE_PATH):
+    """Sorted lines of code_path that the compiler messages in error_output point at. rustc prints paths relative to
+    where cargo ran or absolute ones (in a scratch workspace, say), so a location is code_path's if its path ends
+    with code_path relative to CRATE_PATH. Locations in other files are ignored."""
+    relative = os.path.normpath(os.path.relpath(os.path.expanduser(code_path), os.path.expanduser(CRATE_PATH)))
+    lines = set()
+    for path, line in ERROR_LOCATION.findall(error_output):
+        path = os.path.normpath(path)
+        if path == relative or path.endswith(os.sep + relative):
+            lines.add(int(line))
+    return sorted(lines)
+
+
+class CodeItem:
+    """A top-level item, or a member of an impl/trait/mod/extern block. start includes the comments and attributes
+    before it, body is the offset of its outermost opening brace (if any) and end is just past its last token."""
+
+    def __init__(self, kind, name, start, body, end, start_line, end_line):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.body = body
+        self.end = end
+        self.start_line = start_line
+        self.end_line = end_line
+        self.members = []
+
+    def __repr__(self):
+        return f"CodeItem({self.kind} {self.name}, lines {self.start_line}-{self.end_line})"
+
+
+class CodeIndex:
+    """Splits a Rust file into items (and the members of impl/trait/mod blocks) using the unsafe counter's tokens,
+    and renders the file with the bodies of items irrelevant to a query replaced by OMITTED.
+
+    An item is relevant if it contains unsafe code, is named in the query, or contains one of the given lines
+    (e.g. compiler error locations).
+    """
+
+    def __init__(self, code, counter=None):
+        self.code = code
+        self.counter = counter if counter is not None and counter.code == code else UnsafeCounter(code)
+        self.items = self.segment(0, len(self.counter.kinds), 0)
+
+    def token_text(self, index):
+        return self.code[self.counter.starts[index] : self.counter.ends[index]]
+
+    def segment(self, first, last, start):
+        """Items made of tokens first..last-1, which are at nesting depth 0 relative to each other. start is the
+        offset where the first item's leading comments begin."""
+        kinds = self.counter.kinds
+        items = []
+        depth = 0
+        item_first = first
+        assigned = False
+        for index in range(first, last):
+            kind = kinds[index]
+            if kind in OPENING:
+                depth += 1
+            elif kind in CLOSING:
+                depth -= 1
+            elif depth == 0 and kind != SEMICOLON and self.token_text(index) == "=":
+                # The braces of a struct expression in a static/const initializer don't end the item
+                assigned = True
+            if depth == 0 and (kind == SEMICOLON or (kind == CLOSE_BRACE and not assigned)):
+                items.append(self.make_item(item_first, index, start))
+                start = self.counter.ends[index]
+                item_first = index + 1
+                assigned = False
+        if item_first < last:
+            items.append(self.make_item(item_first, last - 1, start))
+        return items
+
+    def make_item(self, first, last, start):
+        kinds = self.counter.kinds
+        kind, name, body_token = "other", None, None
+        depth = 0
+        for index in range(first, last + 1):
+            token_kind = kinds[index]
+            if depth == 0 and kind == "other":
+                text = self.token_text(index)
+                if token_kind == EXTERN and FN in kinds[index + 1 : index + 3]:
+                    # extern "C" fn is a function, only extern blocks and crates are extern items
+                    pass
+                elif token_kind in (FN, IMPL, TRAIT, EXTERN) or text in ITEM_KEYWORDS:
+                    kind = text
+                    if index + 1 <= last and kinds[index + 1] == IDENT:
+                        name = self.token_text(index + 1)
+            if token_kind == OPEN_BRACE and depth == 0 and body_token is None:
+                body_token = index
+                break
+            if token_kind in OPENING:
+                depth += 1
+            elif token_kind in CLOSING:
+                depth -= 1
+        if kind == "impl" and body_token is not None:
+            # Name an impl block after the type it is for, i.e. its last identifier before the where clause/body
+            header = [self.token_text(i) for i in range(first, body_token) if kinds[i] == IDENT]
+            header = header[: header.index("where")] if "where" in header else header
+            name = header[-1] if header else None
+
+        counter = self.counter
+        end = counter.ends[last]
+        item = CodeItem(
+            kind,
+            name,
+            start,
+            counter.starts[body_token] if body_token is not None else None,
+            end,
+            counter.line_of(counter.starts[first]) + 1,
+            counter.line_of(end - 1) + 1,
+        )
+        if kind in CONTAINERS and body_token is not None and kinds[last] == CLOSE_BRACE:
+            item.members = self.segment(body_token + 1, last, counter.ends[body_token])
+        return item
+
+    def is_relevant(self, item, names, lines):
+        return item.name in names or any(
+            contains_line(sorted_lines, item.start_line, item.end_line)
+            for sorted_lines in (self.counter.unsafe_lines, lines)
+        )
+
+    def iter_items(self, items=None):
+        for item in self.items if items is None else items:
+            yield item
+            yield from self.iter_items(item.members)
+
+    def count_unsafe_lines(self, names):
+        """Number of unsafe lines in the items with one of the given names."""
+        lines = set()
+        for item in self.iter_items():
+            if item.name in names:
+                first = bisect_left(self.counter.unsafe_lines, item.start_line)
+                last = bisect_right(self.counter.unsafe_lines, item.end_line)
+                lines.update(self.counter.unsafe_lines[first:last])
+        return len(lines)
+
+    def render(self, items, names, lines, parts):
+        for item in items:
+            if item.body is None or item.kind in ALWAYS_SHOWN:
+                parts.append(self.code[item.start : item.end])
+            elif item.members:
+                parts.append(self.code[item.start : item.body + 1])
+                self.render(item.members, names, lines, parts)
+                parts.append(self.code[item.members[-1].end if item.members else item.body + 1 : item.end])
+            elif self.is_relevant(item, names, lines) or (
+                item.kind != "fn" and item.end_line - item.start_line < SHORT_DEFINITION_LINES
+            ):
+                parts.append(self.code[item.start : item.end])
+            else:
+                parts.append(self.code[item.start : item.body] + OMITTED)
+
+    def select(self, query="", error_output="", code_path=CODE_PATH):
+        names = set(IDENTIFIER.findall(query)) | set(IDENTIFIER.findall(error_output))
+        lines = error_lines(error_output, code_path)
+        parts = []
+        self.render(self.items, names, lines, parts)
+        last_end = self.items[-1].end if self.items else 0
+        parts.append(self.code[last_end:])
+        return "".join(parts)
+
+
+def contains_line(sorted_lines, first, last):
+    index = bisect_left(sorted_lines, first)
+    return index < len(sorted_lines) and sorted_lines[index] <= last
+
+
+@lru_cache(maxsize=4)
+def get_code_index(code):
+    return CodeIndex(code)
+
+
+def select_context(code, query="", error_output="", counter=None, code_path=CODE_PATH):
+    """The code (of the file at code_path) with the bodies of functions (and long type definitions) that aren't
+    relevant to query or error_output replaced by OMITTED. Short files, or all files if CONTEXT_SELECTION is off, are
+    returned as is."""
+    if not CONTEXT_SELECTION or code.count("\n") < CONTEXT_SELECTION_MIN_LINES:
+        return code
+    index = CodeIndex(code, counter) if counter is not None else get_code_index(code)
+    return index.select(query, error_output, code_path)
+
+
+def get_omitted_note(code, selected_code):
+    """Sentence telling the LLM that parts of the code were omitted, or "" if selected_code is the full code."""
+    if selected_code == code:
+        return ""
+    return f"(Bodies of code not relevant to the task are shown as {OMITTED}. Never use them in an \"original\" string.)"
@@ -0,0 +1,115 @@
+import os
+import threading
+
+from utils.artifacts import line_edits, apply_edits
+from utils.metrics import metrics
+from utils.unsafe_counter import UnsafeCounter
+from utils.workspace import SYNC_IGNORE, WorkspacePool
+from config import *
+
+
+def discover_files(crate_path=CRATE_PATH):
+    """(path, UnsafeCounter) of every .rs file under crate_path that contains unsafe code, most unsafe lines first.
+    The counters hold the files' code, so it needn't be read (or counted) again."""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(os.path.expanduser(crate_path)):
+        dirnames[:] = sorted(name for name in dirnames if name not in SYNC_IGNORE)
+        for filename in sorted(filenames):
+            if not filename.endswith(".rs"):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    counter = UnsafeCounter(f.read())
+            except UnicodeDecodeError:
+                continue
+            if counter.num_unsafe_lines:
+                files.append((path, counter))
+    return sorted(files, key=lambda file: -file[1].num_unsafe_lines)
+
+
+def merge_text(base, ours, theirs):
+    """Three-way merge of the line edits base -> ours and base -> theirs, or None if they touch the same or
+    adjacent lines."""
+    if ours == base or ours == theirs:
+        return theirs
+    if theirs == base:
+        return ours
+    edits = sorted(set(line_edits(base, ours)) | set(line_edits(base, theirs)))
+    for previous, edit in zip(edits, edits[1:]):
+        if edit[0] <= previous[1]:
+            return None
+    return apply_edits(base, edits)
+
+
+class Crate:
+    """The accepted code of every file being optimized in crate mode (and the Cargo.toml), shared by the per-file
+    loops along with CRATE_BUILD_SLOTS warm workspaces.
+
+    Each file is only changed by its own loop, but a change can still break other files, and every loop may edit
+    Cargo.toml. merge() therefore merges Cargo.toml edits three ways and, if anything else was accepted since the
+    candidate was evaluated, rebuilds and retests the combination before accepting it.
+    """
+
+    def __init__(self, files, toml, writer, best_dir):
+        self.files = files
+        self.toml = toml
+        self.version = 0
+        self.lock = threading.Lock()
+        # Held for a whole merge, so a merge is validated against the state it is applied to
+        self.merge_lock = threading.Lock()
+        self.workspace_pool = WorkspacePool(CRATE_BUILD_SLOTS)
+        # Set when the crate run is stopped, so every file's loop ends before its next strategy
+        self.stopped = threading.Event()
+        self.writer = writer
+        self.best_dir = best_dir
+
+    def snapshot(self, code_path):
+        """(version, accepted code of every file but code_path, accepted Cargo.toml)"""
+        with self.lock:
+            return self.version, {path: code for path, code in self.files.items() if path != code_path}, self.toml
+
+    def merge(self, code_path, candidate):
+        """Accept candidate as the new code of code_path. Returns (conflict, Cargo.toml), where conflict is None if
+        the candidate was merged and the reason if not."""
+        with self.merge_lock, metrics.span("merge") as span:
+            with self.lock:
+                version, files, toml = self.version, dict(self.files), self.toml
+            merged_toml = None
+            if CARGO_PATH:
+                merged_toml = merge_text(candidate.base_toml, candidate.new_toml, toml)
+                if merged_toml is None:
+                    span.set(outcome="conflict")
+                    return "its Cargo.toml changes overlap changes merged from other files", toml
+            files[code_path] = candidate.new_code
+            if (version != candidate.crate_version or merged_toml != candidate.new_toml) and not self.validate(
+                files, merged_toml
+            ):
+                span.set(outcome="conflict")
+                return "the crate no longer builds or passes the test with changes merged from other files", toml
+
+            with self.lock:
+                self.files = files
+                self.toml = merged_toml
+                self.version += 1
+            span.set(revalidated=version != candidate.crate_version)
+            self.writer.write(self.best_path(code_path), candidate.new_code)
+            if CARGO_PATH:
+                self.writer.write(self.best_path(CARGO_PATH), merged_toml)
+            return None, merged_toml
+
+    def validate(self, files, toml):
+        """Whether the crate builds and passes the test with files (and toml) in place."""
+        workspace = self.workspace_pool.acquire()
+        try:
+            with metrics.span("merge_validation") as span:
+                workspace.write_files({**files, CARGO_PATH: toml} if CARGO_PATH else files)
+                returncode, _ = workspace.build()
+                passed = returncode == 0 and workspace.test().passed
+                span.set(outcome="ok" if passed else "failed")
+                return passed
+        finally:
+            self.workspace_pool.release(workspace)
+
+    def best_path(self, path):
+        return os.path.join(self.best_dir, os.path.relpath(os.path.expanduser(path), os.path.expanduser(CRATE_PATH)))
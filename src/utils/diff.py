@@ -0,0 +1,163 @@
+import difflib
+from bisect import bisect_right
+
+from utils.context import error_lines, get_code_index, get_omitted_note, select_context
+from config import CODE_PATH, CONTEXT_SELECTION, ANALYSIS_DIFFS, ANALYSIS_DIFF_CONTEXT_LINES, ANALYSIS_DIFF_MAX_FRACTION
+
+
+def unified_diff(original_code, new_code, context_lines=ANALYSIS_DIFF_CONTEXT_LINES):
+    return "".join(
+        difflib.unified_diff(
+            original_code.splitlines(keepends=True),
+            new_code.splitlines(keepends=True),
+            "original.rs",
+            "generated.rs",
+            n=context_lines,
+        )
+    )
+
+
+def outermost_unsafe_items(counter):
+    items = []
+    outer_end = -1
+    for item in counter.items:
+        if item.start >= outer_end:
+            items.append(item)
+            outer_end = item.end
+    return items
+
+
+def hunk_starts(header):
+    """(original line, new line) of the first line of the hunk with the given @@ -a,b +c,d @@ header."""
+    starts = []
+    for line_range in header.split()[1:3]:
+        numbers = line_range[1:].split(",")
+        start, length = int(numbers[0]), int(numbers[1]) if len(numbers) > 1 else 1
+        # An empty range starts after the line it names
+        starts.append(start if length else start + 1)
+    return tuple(starts)
+
+
+def map_lines(diff):
+    """Function taking a line of the original code to the line it is at in the new code, or None if the diff removes
+    (or changes) it."""
+    removed = set()
+    # (original line, offset) from which on original lines are that many lines further down in the new code
+    offsets = [(1, 0)]
+    in_hunk = False
+    for line in diff.splitlines():
+        if line.startswith("@@"):
+            old_line, new_line = hunk_starts(line)
+            in_hunk = True
+        elif not in_hunk or line.startswith("\\"):
+            # File headers and "\ No newline at end of file"
+            continue
+        elif line.startswith("-"):
+            removed.add(old_line)
+            old_line += 1
+        elif line.startswith("+"):
+            new_line += 1
+        else:
+            old_line += 1
+            new_line += 1
+        if in_hunk and new_line - old_line != offsets[-1][1]:
+            offsets.append((old_line, new_line - old_line))
+
+    def map_line(line):
+        if line in removed:
+            return None
+        return line + offsets[bisect_right(offsets, (line, float("inf"))) - 1][1]
+
+    return map_line
+
+
+def get_changed_unsafe_spans(original_code, new_code, diff):
+    """One line per outermost unsafe item that exists in only one of the two versions. Items are matched by their
+    position (as mapped by diff) as well as their text, so identical items in different places are told apart."""
+    # original_code is the loop's best code, whose index is cached (and shared with the strategizer), so only the
+    # edited region of new_code is lexed
+    old_counter = get_code_index(original_code).counter
+    new_counter = old_counter.with_code(new_code)
+    map_line = map_lines(diff)
+
+    def key(counter, item, line):
+        column = item.start - counter.line_starts[item.start_line - 1]
+        return line, column, counter.code[item.start : item.end]
+
+    # Items the diff removes all map to line None, so the original ones are kept in a list rather than by key
+    old_items = [
+        (key(old_counter, item, map_line(item.start_line)), item) for item in outermost_unsafe_items(old_counter)
+    ]
+    new_items = {key(new_counter, item, item.start_line): item for item in outermost_unsafe_items(new_counter)}
+    old_keys = {item_key for item_key, _ in old_items}
+    lines = []
+    for item_key, item in old_items:
+        if item_key not in new_items:
+            lines.append(
+                f"- unsafe {item.kind} at original lines {item.start_line}-{item.end_line} "
+                f"({item.num_lines} unsafe lines) was removed or changed"
+            )
+    for item_key, item in new_items.items():
+        if item_key not in old_keys:
+            lines.append(
+                f"+ unsafe {item.kind} at generated lines {item.start_line}-{item.end_line} "
+                f"({item.num_lines} unsafe lines) was added or changed"
+            )
+    return "\n".join(lines) if lines else "None"
+
+
+def get_error_snippets(new_code, diff, error_output, code_path=CODE_PATH, context_lines=ANALYSIS_DIFF_CONTEXT_LINES):
+    """Numbered lines of new_code (the file at code_path) around compiler error locations in it that the diff
+    doesn't already show."""
+    shown = set()
+    for header in (line for line in diff.splitlines() if line.startswith("@@")):
+        # @@ -a,b +start,length @@
+        new_range = header.split()[2][1:].split(",")
+        start, length = int(new_range[0]), int(new_range[1]) if len(new_range) > 1 else 1
+        shown.update(range(start, start + length))
+
+    lines = new_code.split("\n")
+    snippets = []
+    for error_line in error_lines(error_output, code_path):
+        if error_line in shown or error_line > len(lines):
+            continue
+        first, last = max(1, error_line - context_lines), min(len(lines), error_line + context_lines)
+        snippets.append("\n".join(f"{line_num:>5} | {lines[line_num - 1]}" for line_num in range(first, last + 1)))
+        shown.update(range(first, last + 1))
+    return "\n...\n".join(snippets)
+
+
+def get_code_changes(
+    original_code,
+    new_code,
+    error_output="",
+    new_code_label="Here was the code you generated:",
+    code_path=CODE_PATH,
+    query="",
+):
+    """Prompt section showing how new_code (the file at code_path) differs from original_code: a unified diff plus
+    the unsafe items that changed (and code around compiler errors outside the diff), or both files if the diff isn't
+    much smaller. The files are sent in full unless CONTEXT_SELECTION is on, in which case the bodies that neither
+    query nor the compiler errors in new_code point at are omitted."""
+    diff = unified_diff(original_code, new_code) if ANALYSIS_DIFFS else None
+    if diff is None or len(diff) > ANALYSIS_DIFF_MAX_FRACTION * (len(original_code) + len(new_code)):
+        if not CONTEXT_SELECTION:
+            return f"Here was the original code:\n{original_code}\n\n{new_code_label}\n{new_code}"
+        # The error locations are lines of new_code, so only its selection uses them
+        original_context = select_context(original_code, query)
+        new_context = select_context(new_code, query, error_output, code_path=code_path)
+        note = get_omitted_note(original_code, original_context) or get_omitted_note(new_code, new_context)
+        return (
+            f"Here was the original code:\n{original_context}\n\n{new_code_label}\n{new_context}"
+            + (f"\n{note}" if note else "")
+        )
+
+    diff_text = diff.rstrip("\n") or "(no changes)"
+    section = (
+        f"Here is a unified diff from the original code to the code you generated:\n{diff_text}\n\n"
+        f"Unsafe code changed by the modification:\n{get_changed_unsafe_spans(original_code, new_code, diff)}"
+    )
+    snippets = get_error_snippets(new_code, diff, error_output, code_path) if error_output else ""
+    if snippets:
+        section += f"\n\nGenerated code around the compiler messages (outside the diff):\n{snippets}"
+    return section
@@ -0,0 +1,100 @@
+import re
+from collections import Counter
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+WHITESPACE = re.compile(r"\s+")
+# Lines shorter than this (after removing whitespace) such as "}" or "};" are too common to anchor on
+MIN_ANCHOR_LENGTH = 4
+# Prefix/suffix length used to anchor on lines the LLM changed slightly
+AFFIX_LENGTH = 16
+# Anchors occurring more often than this in the code are ignored
+MAX_ANCHOR_OCCURRENCES = 8
+MAX_ALIGNMENTS = 5
+
+
+def anchor_keys(normalized_line):
+    if len(normalized_line) < MIN_ANCHOR_LENGTH:
+        return []
+    keys = [("=", normalized_line)]
+    if len(normalized_line) >= AFFIX_LENGTH:
+        keys.append(("<", normalized_line[:AFFIX_LENGTH]))
+        keys.append((">", normalized_line[-AFFIX_LENGTH:]))
+    return keys
+
+
+class FuzzyIndex:
+    """Line-anchor index over one version of a file, used to find the best near-match for a replacement whose
+    original doesn't appear verbatim (after whitespace normalization).
+
+    Each line is indexed by its whitespace-free text and by its first and last few characters. A query votes for
+    alignments between its lines and the code's lines through these anchors, then scores the few best-supported
+    windows with difflib.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.line_starts = [0] + [m.end() for m in re.finditer(r"\n", code)]
+        self.lines = code.split("\n")
+        self.normalized_lines = [WHITESPACE.sub("", line) for line in self.lines]
+        self.anchors = {}
+        for line_num, normalized_line in enumerate(self.normalized_lines):
+            for key in anchor_keys(normalized_line):
+                self.anchors.setdefault(key, []).append(line_num)
+
+    def window_span(self, first_line, last_line):
+        """Offsets from the first non-whitespace character of first_line to the last one of last_line."""
+        start = self.line_starts[first_line]
+        start += len(self.lines[first_line]) - len(self.lines[first_line].lstrip())
+        end = self.line_starts[last_line] + len(self.lines[last_line].rstrip())
+        return start, end
+
+    def find(self, needle, threshold):
+        """Return (start, end, similarity) of the best unique near-match of needle scoring at least threshold,
+        or None."""
+        needle_lines = [WHITESPACE.sub("", line) for line in needle.strip().split("\n")]
+        normalized_needle = "".join(needle_lines)
+        if not normalized_needle:
+            return None
+
+        votes = Counter()
+        for needle_line_num, needle_line in enumerate(needle_lines):
+            for key in anchor_keys(needle_line):
+                occurrences = self.anchors.get(key, ())
+                if len(occurrences) <= MAX_ANCHOR_OCCURRENCES:
+                    votes.update(line_num - needle_line_num for line_num in occurrences)
+
+        matches = []
+        for alignment, _ in votes.most_common(MAX_ALIGNMENTS):
+            best = None
+            # The LLM may have dropped or added a line or two, so try a few window lengths
+            for extra_lines in (0, -1, 1, -2, 2):
+                first_line = max(alignment, 0)
+                last_line = min(alignment + len(needle_lines) + extra_lines, len(self.lines)) - 1
+                if last_line < first_line:
+                    continue
+                window = "".join(self.normalized_lines[first_line : last_line + 1])
+                matcher = SequenceMatcher(None, window, normalized_needle, autojunk=False)
+                # quick_ratio is a cheap upper bound on ratio
+                if matcher.quick_ratio() < threshold:
+                    continue
+                similarity = matcher.ratio()
+                if best is None or similarity > best[2]:
+                    best = (first_line, last_line, similarity)
+            if best and best[2] >= threshold:
+                matches.append(best)
+
+        matches.sort(key=lambda match: -match[2])
+        distinct = [
+            match for match in matches if match[1] < matches[0][0] or match[0] > matches[0][1] or match is matches[0]
+        ]
+        if len(distinct) != 1:
+            return None
+        first_line, last_line, similarity = distinct[0]
+        return (*self.window_span(first_line, last_line), similarity)
+
+
+@lru_cache(maxsize=4)
+def get_fuzzy_index(code):
+    """The index is built once per code version and shared by every generation attempt against it."""
+    return FuzzyIndex(code)
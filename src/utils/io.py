@@ -1,3 +1,5 @@
+import codecs
+import re
 import threading
 import time
 import sys
@@ -21,50 +23,258 @@ class Timer:
             time.sleep(0.1)
 
     def __enter__(self):
-        self.thread.start()
+        # Only the main thread animates, so concurrent per-file loops don't overwrite each other's line
+        if threading.current_thread() is threading.main_thread():
+            self.thread.start()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.done_flag.set()
-        self.thread.join()
-        print()
+        if self.thread.is_alive():
+            self.thread.join()
+            print()
 
 
-def run_command_with_timeout(run_cmd, run_timeout, expected_output=None):
+def kill_process_group(process, sig=signal.SIGTERM):
+    # Commands are started with os.setsid, so the group id is the pid, even after the process itself was reaped
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def run_build_command(build_cmd, env=None, cancel_event=None):
+    """Run a build command to completion, returning (return code, stderr). Killed early if cancel_event is set."""
     process = subprocess.Popen(
-        run_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, preexec_fn=os.setsid
+        build_cmd,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=env,
+        preexec_fn=os.setsid,
     )
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=0.1)
+            return process.returncode, stderr
+        except subprocess.TimeoutExpired:
+            if cancel_event and cancel_event.is_set():
+                kill_process_group(process)
+                _, stderr = process.communicate()
+                return process.returncode, stderr + "\nBuild cancelled"
+
+
+class CommandResult:
+    """Outcome of a test command. verdict is "passed" (a success pattern matched), "failed" (a failure pattern
+    matched), "exited" (the command ended without either matching), "timeout", "hung" (no output for hang_timeout
+    seconds) or "cancelled". pattern is the pattern that matched, output the command's output (truncated in the
+    middle if it was long) and max_gap the longest time in seconds it went without output."""
+
+    def __init__(
+        self,
+        verdict,
+        output,
+        pattern=None,
+        returncode=None,
+        duration=None,
+        max_gap=None,
+        timeout=None,
+        hang_timeout=None,
+        timeout_basis=None,
+    ):
+        self.verdict = verdict
+        self.output = output
+        self.pattern = pattern
+        self.returncode = returncode
+        self.duration = duration
+        self.max_gap = max_gap
+        self.timeout = timeout
+        self.hang_timeout = hang_timeout
+        # How timeout and hang_timeout were chosen, for the logs
+        self.timeout_basis = timeout_basis
+
+    @property
+    def passed(self):
+        return self.verdict == "passed"
+
+    def to_json(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+
+def pattern_list(patterns):
+    """A pattern or list of patterns as a list. Patterns are literal strings, re.compile()d regexes or
+    {"regex": "..."} (as written in a batch manifest)."""
+    if patterns is None:
+        return []
+    return [patterns] if isinstance(patterns, (str, re.Pattern, dict)) else list(patterns)
+
+
+def compile_pattern(pattern):
+    """(regex, text) of a pattern."""
+    if isinstance(pattern, re.Pattern):
+        return pattern, pattern.pattern
+    if isinstance(pattern, dict):
+        return re.compile(pattern["regex"]), pattern["regex"]
+    return re.compile(re.escape(pattern)), pattern
+
+
+def describe_patterns(patterns):
+    return " or ".join(compile_pattern(pattern)[1] for pattern in pattern_list(patterns))
 
-    output = ""
+
+class OutputMatcher:
+    """Matches success and failure patterns against output as it streams in.
+
+    Each chunk is searched together with the last WINDOW characters before it, so a pattern split across reads
+    still matches without rescanning the whole output. Only the first and last limit / 2 characters of the output
+    are kept.
+    """
+
+    WINDOW = 4096
+
+    def __init__(self, success_patterns, failure_patterns, limit):
+        # (regex, text, verdict if it matches)
+        self.patterns = [(*compile_pattern(pattern), "passed") for pattern in pattern_list(success_patterns)]
+        self.patterns += [(*compile_pattern(pattern), "failed") for pattern in pattern_list(failure_patterns)]
+        self.window_size = max([self.WINDOW] + [2 * len(text) for _, text, _ in self.patterns])
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.window = ""
+        self.limit = limit
+        self.head = ""
+        self.tail = ""
+        self.length = 0
+        self.verdict = None
+        self.pattern = None
+
+    def feed(self, data):
+        """Add output (bytes). Returns the verdict once a pattern has matched, otherwise None."""
+        return self.feed_text(self.decoder.decode(data))
+
+    def finish(self):
+        return self.feed_text(self.decoder.decode(b"", final=True))
+
+    def feed_text(self, text):
+        if self.verdict or not text:
+            return self.verdict
+        self.record(text)
+        search = self.window + text
+        best = None
+        for regex, pattern_text, verdict in self.patterns:
+            match = regex.search(search)
+            if match and (best is None or match.start() < best[0]):
+                best = (match.start(), pattern_text, verdict)
+        if best:
+            _, self.pattern, self.verdict = best
+        self.window = search[-self.window_size :]
+        return self.verdict
+
+    def record(self, text):
+        self.length += len(text)
+        if len(self.head) < self.limit // 2:
+            room = self.limit // 2 - len(self.head)
+            self.head += text[:room]
+            text = text[room:]
+        self.tail += text
+        # Trimmed only once it has doubled, so keeping the tail stays linear in the output's length
+        if len(self.tail) > self.limit:
+            self.tail = self.tail[-(self.limit // 2) :]
+
+    @property
+    def output(self):
+        tail = self.tail[-(self.limit // 2) :]
+        omitted = self.length - len(self.head) - len(tail)
+        if omitted > 0:
+            return f"{self.head}\n... [{omitted} characters omitted] ...\n{tail}"
+        return self.head + tail
+
+
+def run_command_with_timeout(
+    run_cmd,
+    run_timeout,
+    expected_output=None,
+    env=None,
+    cancel_event=None,
+    failure_patterns=None,
+    output_limit=65536,
+    hang_timeout=None,
+):
+    """Run a test command until its output matches expected_output (passed) or one of failure_patterns (failed),
+    it exits, run_timeout seconds pass, it prints nothing for hang_timeout seconds or cancel_event is set. The process
+    group is killed as soon as the verdict is known. Returns a CommandResult."""
+    process = subprocess.Popen(
+        run_cmd,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL,
+        env=env,
+        preexec_fn=os.setsid,
+    )
+    matcher = OutputMatcher(expected_output, failure_patterns, output_limit)
+    fd = process.stdout.fileno()
+    os.set_blocking(fd, False)
     sel = selectors.DefaultSelector()
-    sel.register(process.stdout, selectors.EVENT_READ)
+    sel.register(fd, selectors.EVENT_READ)
 
-    start = time.time()
+    start = last_output = time.monotonic()
+    max_gap = 0.0
+    verdict = None
     try:
-        while True:
-            if process.poll() is not None:
-                break
-            timeout_remaining = run_timeout - (time.time() - start)
+        while verdict is None:
+            now = time.monotonic()
+            timeout_remaining = run_timeout - (now - start)
             if timeout_remaining <= 0:
-                raise subprocess.TimeoutExpired(run_cmd, run_timeout)
-
-            for key, _ in sel.select(timeout_remaining):
-                line = key.fileobj.readline()
-                if not line:
-                    break
-                output += line
-                if expected_output and expected_output in output:
-                    try:
-                        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                    except ProcessLookupError:
-                        pass
-                    return output
-    except subprocess.TimeoutExpired:
+                verdict = "timeout"
+            elif hang_timeout and now - last_output >= hang_timeout:
+                verdict = "hung"
+            elif cancel_event and cancel_event.is_set():
+                verdict = "cancelled"
+            elif sel.select(min(timeout_remaining, 0.1)):
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                now = time.monotonic()
+                max_gap = max(max_gap, now - last_output)
+                last_output = now
+                # Empty once every process writing to the pipe has exited
+                verdict = matcher.feed(data) if data else matcher.finish() or "exited"
+            elif process.poll() is not None and not sel.select(0):
+                # Exited, but something it started still holds the pipe open
+                verdict = matcher.finish() or "exited"
+    finally:
+        sel.close()
+        kill_process_group(process)
         try:
-            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-            time.sleep(0.01)
-        except ProcessLookupError:
-            pass
-        output += f"\nProcess killed after {run_timeout} seconds timeout"
+            process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process, signal.SIGKILL)
+            process.wait()
+        process.stdout.close()
 
-    return output
+    duration = time.monotonic() - start
+    max_gap = max(max_gap, start + duration - last_output)
+    output = matcher.output
+    if verdict == "timeout":
+        output += f"\nProcess killed after {run_timeout} seconds timeout"
+    elif verdict == "hung":
+        output += f"\nProcess killed after {hang_timeout} seconds without output (hung)"
+    elif verdict == "cancelled":
+        output += "\nProcess cancelled"
+    elif verdict == "failed":
+        output += f"\nProcess stopped: output matched failure pattern {matcher.pattern!r}"
+    return CommandResult(
+        verdict,
+        output,
+        matcher.pattern,
+        process.returncode,
+        round(duration, 3),
+        round(max_gap, 3),
+        run_timeout,
+        hang_timeout,
+    )
@@ -0,0 +1,205 @@
+import asyncio
+import concurrent.futures
+import email.utils
+import random
+import threading
+import time
+
+import httpx
+import openai
+
+from utils.metrics import metrics
+
+
+class TokenBucket:
+    """Request rate limiter shared by every caller. A server-provided Retry-After pauses the whole bucket."""
+
+    def __init__(self, requests_per_minute, capacity=None):
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity or max(1, requests_per_minute // 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def get_retry_after(error):
+    """Seconds the server asked us to wait before retrying, or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def count_usage(completion):
+    usage = getattr(completion, "usage", None)
+    if usage:
+        metrics.count(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+class AsyncLLMClient:
+    """OpenAI client with a shared HTTP connection pool, an in-flight request limit, token bucket rate limiting
+    and jittered exponential backoff on 429/5xx/connection errors.
+
+    All requests run on one background event loop so the pool and limits are shared between threads (e.g. parallel
+    candidates) and between callers running their own event loops. Use run_sync to call from synchronous code.
+    """
+
+    RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+    # Seconds between checks of a run_sync cancel_event
+    CANCEL_POLL_INTERVAL = 0.1
+
+    def __init__(self, max_in_flight, requests_per_minute, max_retries, base_delay=1.0, max_delay=60.0):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(requests_per_minute)
+        self.loop = None
+        self.client = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="llm-client", daemon=True).start()
+            return self.loop
+
+    def run_sync(self, coro, cancel_event=None):
+        """Run coro on the background loop and wait for its result. If cancel_event is set first, coro is cancelled
+        (aborting its request) and concurrent.futures.CancelledError is raised."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+        if cancel_event is None:
+            return future.result()
+        while True:
+            try:
+                return future.result(timeout=self.CANCEL_POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if cancel_event.is_set():
+                    future.cancel()
+                    raise concurrent.futures.CancelledError() from None
+
+    async def dispatch(self, coro):
+        loop = self.get_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def get_client(self):
+        # Only ever called on the background loop
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+            self.client = openai.AsyncOpenAI(http_client=openai.DefaultAsyncHttpxClient(limits=limits), max_retries=0)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self.client
+
+    def is_retryable(self, error):
+        if isinstance(error, openai.APIConnectionError):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code in self.RETRYABLE_STATUS_CODES
+
+    async def request(self, make_request):
+        client = self.get_client()
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            with metrics.span("llm_request", attempt=attempt + 1) as span:
+                try:
+                    async with self.semaphore:
+                        return await make_request(client)
+                except openai.APIError as e:
+                    if attempt == self.max_retries or not self.is_retryable(e):
+                        raise
+                    span.set(outcome="retried", error=e.__class__.__name__)
+                    retry_after = get_retry_after(e)
+                    if retry_after is not None:
+                        self.bucket.pause(retry_after)
+                        delay = retry_after + random.uniform(0, self.base_delay)
+                    else:
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+                    print(f"\nLLM request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def complete(self, model, prompt):
+        async def make_request(client):
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "user", "content": prompt},
+                ],
+                stream=False,
+            )
+            count_usage(completion)
+            return completion.choices[0].message.content
+
+        return await self.dispatch(self.request(make_request))
+
+    async def parse(self, model, prompt, response_format):
+        async def make_request(client):
+            completion = await client.beta.chat.completions.parse(
+                model=model,
+                messages=[
+                    {"role": "user", "content": prompt},
+                ],
+                response_format=response_format,
+            )
+            count_usage(completion)
+            return completion.choices[0].message.content
+
+        return await self.dispatch(self.request(make_request))
+
+    async def stream_parse(self, model, prompt, response_format, make_handler):
+        """Stream a structured response, feeding each content delta to a fresh handler per attempt.
+
+        Returns the full content and the handler. An exception raised by the handler aborts the request.
+        """
+
+        async def make_request(client):
+            handler = make_handler()
+            async with client.beta.chat.completions.stream(
+                model=model,
+                messages=[
+                    {"role": "user", "content": prompt},
+                ],
+                response_format=response_format,
+                stream_options={"include_usage": True},
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content.delta":
+                        handler.feed(event.delta)
+                completion = await stream.get_final_completion()
+            count_usage(completion)
+            return completion.choices[0].message.content, handler
+
+        return await self.dispatch(self.request(make_request))
@@ -1,19 +1,183 @@
 import atexit
 import os
+import queue
 import re
 import json
 import shutil
+import threading
 import time
 
-from config import CODE_PATH, CARGO_PATH
+from utils.artifacts import ArtifactStore
+from utils.metrics import metrics
+from config import CODE_PATH, CARGO_PATH, CRATE_PATH, LOG_PATH
+
+
+class LogWriter:
+    """Single background thread that owns every log file (and puts versions into the run's ArtifactStore, if given),
+    so logging never blocks the optimization loop or the LLM event loop on compression or disk.
+
+    Appended files stay open until their directory is synced. Buffers are flushed once FLUSH_BYTES have been
+    written or FLUSH_INTERVAL seconds have passed, and only sync() (at strategy boundaries and exit) fsyncs. A record
+    that fails is reported and skipped, and the first failure is raised again by the next sync().
+    """
+
+    FLUSH_INTERVAL = 0.5
+    FLUSH_BYTES = 64 * 1024
+    MAX_BATCH = 256
+
+    def __init__(self, artifacts=None):
+        self.artifacts = artifacts
+        self.queue = queue.Queue()
+        self.handles = {}
+        # Whole files written since the last sync, which still need an fsync
+        self.unsynced = set()
+        self.pending_bytes = 0
+        # (name, exception) of the first record that failed since the last sync()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def append(self, path, text):
+        self.queue.put(("append", path, text))
+
+    def write(self, path, text):
+        self.queue.put(("write", path, text))
+
+    def replace(self, path, text):
+        """Write path atomically, through a temporary file renamed over it."""
+        self.queue.put(("replace", path, text))
+
+    def store(self, name, content):
+        """Put content (text, or (text, parent text, edits) for a delta) into the artifact store. name is only used
+        in error messages."""
+        self.queue.put(("store", name, content))
+
+    def sync(self, directory=None, wait=False):
+        """Flush and fsync everything written so far, closing the files under directory (all files if None). Raises
+        RuntimeError if a record failed since the last sync, so lost logs or checkpoints don't go unnoticed."""
+        done = threading.Event()
+        self.queue.put(("sync", directory, done))
+        if wait:
+            done.wait()
+        error, self.error = self.error, None
+        if error:
+            name, e = error
+            raise RuntimeError(f"Log writer failed on {name}: {e}") from e
+
+    def close(self):
+        if self.thread.is_alive():
+            try:
+                self.sync(wait=True)
+            except RuntimeError:
+                # Already reported when it happened, and the remaining records still have to be written
+                pass
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.FLUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is None:
+                    return
+                try:
+                    self.handle(*record)
+                except Exception as e:
+                    print(f"\nFailed to write log {record[1]}: {type(e).__name__}: {e}")
+                    if self.error is None:
+                        self.error = (record[1], e)
+
+            if self.pending_bytes >= self.FLUSH_BYTES or time.monotonic() - last_flush >= self.FLUSH_INTERVAL:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"\nFailed to flush logs: {type(e).__name__}: {e}")
+                    if self.error is None:
+                        self.error = ("flush", e)
+                last_flush = time.monotonic()
+
+    def handle(self, kind, path, payload):
+        if kind == "append":
+            if path not in self.handles:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.handles[path] = open(path, "a", encoding="utf-8")
+            self.handles[path].write(payload)
+            self.pending_bytes += len(payload)
+        elif kind == "store":
+            if isinstance(payload, tuple):
+                self.artifacts.put(*payload)
+            else:
+                self.artifacts.put(payload)
+        elif kind == "sync":
+            try:
+                self.flush()
+                for handle_path in list(self.handles):
+                    handle = self.handles[handle_path]
+                    os.fsync(handle.fileno())
+                    if path is None or handle_path.startswith(os.path.join(path, "")):
+                        handle.close()
+                        del self.handles[handle_path]
+                for unsynced_path in self.unsynced:
+                    fd = os.open(unsynced_path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            finally:
+                self.unsynced.clear()
+                payload.set()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            target = path + ".tmp" if kind == "replace" else path
+            with open(target, "w", encoding="utf-8") as f:
+                f.write(payload)
+            if kind == "replace":
+                os.replace(target, path)
+            self.unsynced.add(path)
+
+    def flush(self):
+        for handle in self.handles.values():
+            handle.flush()
+        self.pending_bytes = 0
 
 
 class Logger:
-    def __init__(self):
-        self.initial_path = CODE_PATH
+    def __init__(self, resume=None, code_path=CODE_PATH, log_path=None):
+        """resume is the name of an earlier run directory (e.g. "run003") to continue from its checkpoint.
+
+        In crate mode every file gets its own logger with its own log_path. Those loggers prefix what they print
+        with the file's path and leave the metrics trace to the crate runner.
+        """
+        self.initial_path = code_path
         self.initial_toml_path = CARGO_PATH
         self.start_time = time.time()
         self.best_unsafe_lines = None
+        self.resumed = resume is not None
+        self.nested = log_path is not None
+        self.label = f"[{os.path.relpath(code_path, CRATE_PATH)}] " if self.nested else ""
+
+        self.logger_path = log_path or LOG_PATH
+        self.logger_original_path = os.path.join(self.logger_path, "original.rs")
+        self.logger_original_toml_path = os.path.join(self.logger_path, "original.toml")
+
+        if resume:
+            if not os.path.exists(os.path.join(self.logger_path, resume, "checkpoint.json")):
+                raise FileNotFoundError(f"No checkpoint found for {resume} in {self.logger_path}")
+            # A run that crashed without reverting leaves its last candidate in place
+            shutil.copy(self.logger_original_path, self.initial_path)
+            if CARGO_PATH:
+                shutil.copy(self.logger_original_toml_path, self.initial_toml_path)
+
         with open(self.initial_path, "r", encoding="utf-8") as f:
             self.initial_code = f.read()
         if CARGO_PATH:
@@ -22,10 +186,6 @@ class Logger:
         else:
             self.initial_toml = None
 
-        self.logger_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "log"))
-        self.logger_original_path = os.path.join(self.logger_path, "original.rs")
-        self.logger_original_toml_path = os.path.join(self.logger_path, "original.toml")
-
         create_log = False
         if os.path.exists(self.logger_path):
             if (
@@ -43,25 +203,39 @@ class Logger:
 
         if create_log:
             print("Creating new log folder")
-            os.makedirs(self.logger_path)
+            os.makedirs(self.logger_path, exist_ok=True)
             with open(self.logger_original_path, "w", encoding="utf-8") as f:
                 f.write(self.initial_code)
             if CARGO_PATH:
                 with open(self.logger_original_toml_path, "w", encoding="utf-8") as f:
                     f.write(self.initial_toml)
 
-        run_dirs = [d for d in os.listdir(self.logger_path) if re.fullmatch(r"run\d{3}", d)]
-        next_run = f"{(max(map(lambda d: int(d[3:]), run_dirs), default=0) + 1):03d}"
-        self.run_dir = os.path.join(self.logger_path, f"run{next_run}")
+        # Shared by every run in this log folder, so unchanged versions are stored once across runs
+        self.artifacts = ArtifactStore(os.path.join(self.logger_path, "artifacts"))
+
+        if resume:
+            self.run_dir = os.path.join(self.logger_path, resume)
+        else:
+            run_dirs = [d for d in os.listdir(self.logger_path) if re.fullmatch(r"run\d{3}", d)]
+            next_run = f"{(max(map(lambda d: int(d[3:]), run_dirs), default=0) + 1):03d}"
+            self.run_dir = os.path.join(self.logger_path, f"run{next_run}")
+            os.makedirs(self.run_dir)
         print("Logs for this run can be found in ", self.run_dir)
-        os.makedirs(self.run_dir)
         self.strategy_num = "000"
+        self.writer = LogWriter(self.artifacts)
+        if not self.nested:
+            metrics.open_trace(os.path.join(self.run_dir, "trace.jsonl"))
 
         atexit.register(self.cleanup)
 
     def cleanup(self):
-        with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(f"\nResult: {self.initial_unsafe_lines} unsafe lines -> {self.best_unsafe_lines if self.best_unsafe_lines else self.initial_unsafe_lines} unsafe lines in {int((time.time() - self.start_time) / 60)}:{int((time.time() - self.start_time) % 60):02d}\n")
+        self.log_to_run(f"\nResult: {self.initial_unsafe_lines} unsafe lines -> {self.best_unsafe_lines if self.best_unsafe_lines else self.initial_unsafe_lines} unsafe lines in {int((time.time() - self.start_time) / 60)}:{int((time.time() - self.start_time) % 60):02d}")
+        if not self.nested:
+            self.log_to_run(f"\nTiming by phase (seconds):\n{metrics.format_summary()}")
+            self.writer.write(os.path.join(self.run_dir, "metrics.json"), json.dumps(metrics.summary(), indent=4))
+        self.writer.close()
+        if not self.nested:
+            metrics.close()
 
         shutil.copy(self.logger_original_path, self.initial_path)
         if CARGO_PATH:
@@ -77,85 +251,130 @@ class Logger:
 
     def begin_run(self, initial_unsafe_lines):
         self.initial_unsafe_lines = initial_unsafe_lines
-        with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(f"Initial unsafe lines: {initial_unsafe_lines}\n")
+        self.log_to_run(f"Initial unsafe lines: {initial_unsafe_lines}")
+
+    def save_checkpoint(self, best_code, best_toml, sync=False, **state):
+        """Atomically replace the run's checkpoint with the best code so far and the given loop state, on the writer
+        thread. Only with sync (at strategy boundaries) is it fsynced right away, otherwise with the next sync."""
+        self.writer.store("best_code", best_code)
+        if best_toml is not None:
+            self.writer.store("best_toml", best_toml)
+        checkpoint = {
+            "best_code": ArtifactStore.key(best_code),
+            "best_toml": ArtifactStore.key(best_toml) if best_toml is not None else None,
+            "strategy_num": self.strategy_num,
+            "elapsed": time.time() - self.start_time,
+            "initial_unsafe_lines": self.initial_unsafe_lines,
+            "best_unsafe_lines": self.best_unsafe_lines,
+            **state,
+        }
+        self.writer.replace(os.path.join(self.run_dir, "checkpoint.json"), json.dumps(checkpoint, indent=4))
+        if sync:
+            self.writer.sync()
+
+    def load_checkpoint(self):
+        """Read the checkpoint of the resumed run, restoring the logger's own state. best_code and best_toml are
+        returned as text."""
+        with open(os.path.join(self.run_dir, "checkpoint.json"), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        checkpoint["best_code"] = self.artifacts.get(checkpoint["best_code"])
+        if checkpoint["best_toml"] is not None:
+            checkpoint["best_toml"] = self.artifacts.get(checkpoint["best_toml"])
+        self.strategy_num = checkpoint["strategy_num"]
+        self.start_time = time.time() - checkpoint["elapsed"]
+        self.initial_unsafe_lines = checkpoint["initial_unsafe_lines"]
+        self.best_unsafe_lines = checkpoint["best_unsafe_lines"]
+        return checkpoint
+
+    def resume_strategy(self, strategy_num, prompt, num_prompts):
+        """Continue logging to the folder of a strategy that was interrupted after num_prompts prompts."""
+        self.most_recent_prompt = prompt
+        self.strategy_num = strategy_num
+        self.strategy_dir = os.path.join(self.run_dir, f"strategy{self.strategy_num}")
+        os.makedirs(self.strategy_dir, exist_ok=True)
+        self.prompt_num = f"{num_prompts:03d}"
+        self.log_to_run(f"\nResumed strategy {int(strategy_num)} after {num_prompts} prompts")
 
     def log_strategy(self, prompt):
         self.most_recent_prompt = prompt
         self.strategy_num = f"{(int(self.strategy_num) + 1):03d}"
         self.strategy_dir = os.path.join(self.run_dir, f"strategy{self.strategy_num}")
-        os.makedirs(self.strategy_dir)
+        # May exist already if the run was interrupted while this strategy was being generated
+        os.makedirs(self.strategy_dir, exist_ok=True)
         self.prompt_num = "000"
 
-        with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(("\n" if int(self.strategy_num) > 1 else "") + f"Strategy {int(self.strategy_num)}: {prompt}\n")
+        self.log_to_run(("\n" if int(self.strategy_num) > 1 else "") + f"Strategy {int(self.strategy_num)}: {prompt}")
 
     def log_strategy_result(self, result, unsafe_lines):
         self.best_unsafe_lines = unsafe_lines
 
-        with open(os.path.join(self.strategy_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(
-                f"\n{result}\n"
-            )
-        print(result)
+        self.writer.append(os.path.join(self.strategy_dir, "summary.log"), f"\n{result}\n")
+        print(self.label + result)
 
         log_message = f"Final prompt: {self.most_recent_prompt}\n{result}\n{unsafe_lines} unsafe lines remaining\n"
-        with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(log_message + "\n")
+        self.log_to_run(log_message)
         self.log_verbose(log_message)
+        # The strategy is over: close its files and make the run so far durable, without waiting for the disk
+        self.writer.sync(self.strategy_dir)
 
     def log_prompt(self, prompt):
         self.most_recent_prompt = prompt
         self.prompt_num = f"{(int(self.prompt_num) + 1):03d}"
 
         log_message = f"Prompt {int(self.prompt_num)}: {prompt}"
-        with open(os.path.join(self.strategy_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(("\n" if int(self.prompt_num) > 1 else "") + log_message + "\n")
-        print(log_message)
+        self.writer.append(
+            os.path.join(self.strategy_dir, "summary.log"), ("\n" if int(self.prompt_num) > 1 else "") + log_message + "\n"
+        )
+        print(self.label + log_message)
         self.log_verbose(log_message)
 
-    def log_generated_code(self, replacements, new_code, new_toml, attempt_num, time_taken):
-        with open(os.path.join(self.strategy_dir, f"replacements{self.prompt_num}.json"), "w") as f:
-            json.dump(json.loads(replacements), f, indent=4)
-        with open(os.path.join(self.strategy_dir, f"code{self.prompt_num}.rs"), "w") as f:
-            f.write(new_code)
+    def log_artifacts(self, files):
+        """Store files in the artifact store and list them in the strategy's artifacts.jsonl. files maps each file
+        name to its text, or to (text, parent text, edits) to store it as a delta. Keys are content hashes, so only
+        hashing happens here and the writer thread does the rest, before the listing is appended."""
+        keys = {}
+        for name, content in files.items():
+            keys[name] = ArtifactStore.key(content[0] if isinstance(content, tuple) else content)
+            self.writer.store(name, content)
+        self.writer.append(
+            os.path.join(self.strategy_dir, "artifacts.jsonl"), json.dumps({"prompt": self.prompt_num, "files": keys}) + "\n"
+        )
+
+    def log_generated_code(
+        self, replacements, new_code, new_toml, attempt_num, time_taken, base_code=None, base_toml=None, code_edits=None
+    ):
+        """Record the accepted patch of this prompt. Given the code it was applied to (and the edits, if known), the
+        new code is stored as a delta against it rather than as a full copy."""
+        files = {
+            f"replacements{self.prompt_num}.json": replacements,
+            f"code{self.prompt_num}.rs": (new_code, base_code, code_edits) if base_code is not None else new_code,
+        }
         if CARGO_PATH:
-            with open(os.path.join(self.strategy_dir, f"toml{self.prompt_num}.toml"), "w") as f:
-                f.write(new_toml)
-
-        with open(os.path.join(self.strategy_dir, "summary.log"), "a", encoding="utf-8") as f:
-            log_message = f"Successful generation in {attempt_num} attempt{'s' if attempt_num != 1 else ''} ({time_taken:.2f}s)"
-            f.write(log_message + "\n")
-            self.log_verbose(log_message)
-    
-    def log_generation_attempt(self, result, generation_attempt):
-        generation_attempts_dir = os.path.join(self.strategy_dir, "generation_attempts")
-        if not os.path.exists(generation_attempts_dir):
-            os.makedirs(generation_attempts_dir)
+            files[f"toml{self.prompt_num}.toml"] = (new_toml, base_toml) if base_toml is not None else new_toml
+        self.log_artifacts(files)
+
+        log_message = f"Successful generation in {attempt_num} attempt{'s' if attempt_num != 1 else ''} ({time_taken:.2f}s)"
+        self.writer.append(os.path.join(self.strategy_dir, "summary.log"), log_message + "\n")
+        self.log_verbose(log_message)
 
-        with open(os.path.join(generation_attempts_dir, f"{self.prompt_num}-{generation_attempt}.json"), "w") as f:
-            json.dump(json.loads(result), f, indent=4)
+    def log_generation_attempt(self, result, generation_attempt):
+        self.log_artifacts({f"generation_attempts/{self.prompt_num}-{generation_attempt}.json": result})
 
     def log_status(self, status, time_taken=None):
         log_message = status + (f" ({time_taken:.2f}s)" if time_taken else "")
 
-        with open(os.path.join(self.strategy_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(log_message + "\n")
-        print(log_message)
+        self.writer.append(os.path.join(self.strategy_dir, "summary.log"), log_message + "\n")
+        print(self.label + log_message)
         self.log_verbose(log_message)
 
     def log_verbose(self, status):
-        with open(os.path.join(self.strategy_dir, "verbose_summary.log"), "a", encoding="utf-8") as f:
-            f.write(status + "\n")
+        self.writer.append(os.path.join(self.strategy_dir, "verbose_summary.log"), status + "\n")
 
     def update_best_code(self, new_code, new_toml):
-        with open(os.path.join(self.run_dir, "best.rs"), "w", encoding="utf-8") as f:
-            f.write(new_code)
+        self.writer.write(os.path.join(self.run_dir, "best.rs"), new_code)
         if CARGO_PATH:
-            with open(os.path.join(self.run_dir, "best.toml"), "w", encoding="utf-8") as f:
-                f.write(new_toml)
-        print("Updated best code")
+            self.writer.write(os.path.join(self.run_dir, "best.toml"), new_toml)
+        print(self.label + "Updated best code")
 
     def log_to_run(self, message):
-        with open(os.path.join(self.run_dir, "summary.log"), "a", encoding="utf-8") as f:
-            f.write(message + "\n")
+        self.writer.append(os.path.join(self.run_dir, "summary.log"), message + "\n")
@@ -0,0 +1,152 @@
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Span that new spans are nested under. Copied into LLM requests by run_coroutine_threadsafe, and into candidate
+# threads explicitly, so token counts end up on the phase that caused them
+current_span = contextvars.ContextVar("current_span", default=None)
+
+# Upper bounds in seconds of the duration histogram buckets, plus one unbounded bucket
+HISTOGRAM_BUCKETS = (0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+PERCENTILES = (50, 90, 99)
+
+
+class Span:
+    def __init__(self, span_id, name, parent, attrs):
+        self.id = span_id
+        self.name = name
+        self.parent = parent
+        self.attrs = {"outcome": "ok", **attrs}
+        self.counts = {}
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def histogram(values):
+    buckets = Counter()
+    for value in values:
+        bucket = next((f"<={bound}s" for bound in HISTOGRAM_BUCKETS if value <= bound), f">{HISTOGRAM_BUCKETS[-1]}s")
+        buckets[bucket] += 1
+    labels = [f"<={bound}s" for bound in HISTOGRAM_BUCKETS] + [f">{HISTOGRAM_BUCKETS[-1]}s"]
+    return {label: buckets[label] for label in labels if buckets[label]}
+
+
+class Metrics:
+    """In-process registry of timed spans, one per phase execution (strategy generation, code generation, apply,
+    build, test, unsafe count, analyses, LLM requests).
+
+    Every finished span is appended to a JSONL trace (if one is open) with its parent, duration, outcome, attributes
+    and counts such as tokens, and its duration, outcome and counts are aggregated per span name for summary().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.durations = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+        self.counts = defaultdict(Counter)
+        self.trace = None
+
+    def open_trace(self, path):
+        self.trace = open(path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.trace:
+                self.trace.close()
+                self.trace = None
+
+    def new_span(self, name, parent, attrs):
+        with self.lock:
+            span_id = self.next_id
+            self.next_id += 1
+        return Span(span_id, name, parent, attrs)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = self.new_span(name, current_span.get(), attrs)
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(outcome="error", error=e.__class__.__name__)
+            raise
+        finally:
+            current_span.reset(token)
+            self.finish(span, time.perf_counter() - start)
+
+    def record(self, name, duration, **attrs):
+        """Record a phase that was timed by the caller, e.g. one spread over many small steps."""
+        self.finish(self.new_span(name, current_span.get(), attrs), duration)
+
+    def count(self, **counts):
+        """Add counts (e.g. tokens) to the current span and every span it is nested in."""
+        with self.lock:
+            span = current_span.get()
+            while span:
+                for key, value in counts.items():
+                    span.counts[key] = span.counts.get(key, 0) + value
+                span = span.parent
+
+    def finish(self, span, duration):
+        span.duration = duration
+        with self.lock:
+            self.durations[span.name].append(duration)
+            self.outcomes[span.name][str(span.attrs["outcome"])] += 1
+            self.counts[span.name].update(span.counts)
+            if self.trace:
+                record = {
+                    "id": span.id,
+                    "parent": span.parent.id if span.parent else None,
+                    "name": span.name,
+                    "start": round(span.start, 6),
+                    "duration": round(duration, 6),
+                    **span.attrs,
+                    **span.counts,
+                }
+                self.trace.write(json.dumps(record, default=str) + "\n")
+                if span.parent is None:
+                    self.trace.flush()
+
+    def summary(self):
+        """Per span name: count, total/mean/max duration, percentiles, histogram, outcomes and summed counts."""
+        with self.lock:
+            summary = {}
+            for name, durations in self.durations.items():
+                durations = sorted(durations)
+                summary[name] = {
+                    "count": len(durations),
+                    "total": round(sum(durations), 3),
+                    "mean": round(sum(durations) / len(durations), 3),
+                    **{f"p{p}": round(percentile(durations, p), 3) for p in PERCENTILES},
+                    "max": round(durations[-1], 3),
+                    "histogram": histogram(durations),
+                    "outcomes": dict(self.outcomes[name]),
+                    **dict(self.counts[name]),
+                }
+            return summary
+
+    def format_summary(self):
+        lines = [f"{'Phase':<30}{'count':>7}{'total':>10}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]["total"]):
+            lines.append(
+                f"{name:<30}{stats['count']:>7}{stats['total']:>10.2f}{stats['mean']:>9.2f}"
+                + "".join(f"{stats[key]:>9.2f}" for key in ("p50", "p90", "p99", "max"))
+            )
+        return "\n".join(lines)
+
+
+metrics = Metrics()
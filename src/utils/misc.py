@@ -1,161 +1,135 @@
 import json
+import re
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+from utils.fuzzy import get_fuzzy_index
+from utils.unsafe_counter import UnsafeCounter
 
 
 def count_unsafe(rust_code: str, debug: bool = False) -> tuple[int, int]:
-    def remove_comments(code: str) -> str:
-        """Remove all comments from the code."""
-        lines = code.split("\n")
-        result = []
-        in_multiline = False
-
-        for line in lines:
-            # Handle multi-line comments
-            if "/*" in line:
-                in_multiline = True
-                line = line.split("/*")[0]
-            if "*/" in line:
-                in_multiline = False
-                line = line.split("*/")[1]
-            if in_multiline:
-                continue
-
-            # Handle single-line comments
-            if "//" in line:
-                line = line.split("//")[0]
-
-            result.append(line)
-
-        return "\n".join(result)
-
-    # Remove all comments first
-    rust_code = remove_comments(rust_code)
-
-    lines = rust_code.split("\n")
-    num_unsafe_blocks = 0
-    num_unsafe_lines = 0
-    in_unsafe_block = False
-    found_unsafe = False
-    bracket_depth = 0
-
-    def is_code_line(line: str) -> bool:
-        """Check if a line contains actual code (not just brackets/whitespace)."""
-        # Strip whitespace and check if line is empty
-        stripped = line.strip()
-        if not stripped:
-            return False
-
-        # Check if line only contains brackets, parentheses, commas, etc.
-        only_symbols = all(c in "{}()[],;" for c in stripped)
-        return not only_symbols
-
-    def count_code_in_line(line: str) -> bool:
-        """Count if there's code in a line, even if it has braces."""
-        # Remove braces to check remaining content
-        cleaned = line.replace("{", "").replace("}", "").strip()
-        return bool(cleaned) and not all(c in "()[],;" for c in cleaned)
-
-    for i, line in enumerate(lines):
-        # Count opening and closing braces to track nesting
-        if in_unsafe_block:
-            bracket_depth += line.count("{")
-            bracket_depth -= line.count("}")
-
-        # Check for start of unsafe block - only if we're not already in an unsafe block
-        if "unsafe" in line and not in_unsafe_block:
-            found_unsafe = True
-            # Count the unsafe line itself
-            if count_code_in_line(line.replace("unsafe", "").strip()):
-                if debug:
-                    print(f"Unsafe line {i+1}: {line}")
-                num_unsafe_lines += 1
-
-            if "{" in line:
-                in_unsafe_block = True
-                num_unsafe_blocks += 1
-                found_unsafe = False
-                bracket_depth += line.count("{")
-            # Check for additional code on same line as opening brace
-
-        # Check if opening brace is on next line after unsafe - only if we're not already in an unsafe block
-        elif found_unsafe and "{" in line and not in_unsafe_block:
-            in_unsafe_block = True
-            num_unsafe_blocks += 1
-            found_unsafe = False
-            bracket_depth += line.count("{")
-            # Check for code on same line as opening brace
-            if count_code_in_line(line):
-                if debug:
-                    print(f"Unsafe line {i+1}: {line}")
-                num_unsafe_lines += 1
-        # Check for end of unsafe block - only if we're at the outermost level
-        elif in_unsafe_block and "}" in line and bracket_depth == 0:
-            # Check for code on same line as closing brace
-            if count_code_in_line(line):
-                if debug:
-                    print(f"Unsafe line {i+1}: {line}")
-                num_unsafe_lines += 1
-            in_unsafe_block = False
-        # Count code lines inside unsafe block
-        elif in_unsafe_block and is_code_line(line):
-            if debug:
-                print(f"Unsafe line {i+1}: {line}")
-            num_unsafe_lines += 1
-
-    return num_unsafe_lines, num_unsafe_blocks
-
-
-def apply_changes(current_code: str, changes: list) -> str:
-    def normalize_whitespace(code: str) -> str:
-        # Remove all whitespace including newlines
-        return "".join(code.split())
-
-    def find_normalized_substring(haystack: str, needle: str) -> tuple[int, int]:
-        """Find the start and end positions of a normalized substring in the original string."""
-        normalized_haystack = normalize_whitespace(haystack)
-        normalized_needle = normalize_whitespace(needle)
-
-        if normalized_needle not in normalized_haystack:
-            return -1, -1
-
-        # Find position in normalized string
-        norm_pos = normalized_haystack.find(normalized_needle)
-
-        # Convert back to original string positions
-        orig_start = 0
-        norm_count = 0
-
-        # Find the start position
-        for i, c in enumerate(haystack):
-            if not c.isspace():
-                if norm_count == norm_pos:
-                    orig_start = i
-                    break
-                norm_count += 1
-
-        # Find the end position
-        orig_end = orig_start
-        norm_count = norm_pos
-        for i in range(orig_start, len(haystack)):
-            if not haystack[i].isspace():
-                norm_count += 1
-                if norm_count == norm_pos + len(normalized_needle):
-                    orig_end = i + 1
-                    break
-
-        return orig_start, orig_end
-
-    for replacement in changes:
-        start_pos, end_pos = find_normalized_substring(current_code, replacement["original"])
-
-        if start_pos == -1:
-            raise ValueError(
-                f"Replacement string not found in code (after whitespace normalization): {replacement['original']}"
-            )
-
-        # Replace the actual text with the new text
-        current_code = current_code[:start_pos] + replacement["new"] + current_code[end_pos:]
-
-    return current_code
+    counter = UnsafeCounter(rust_code)
+    if debug:
+        lines = rust_code.split("\n")
+        for line_num in counter.unsafe_lines:
+            print(f"Unsafe line {line_num}: {lines[line_num - 1]}")
+    return counter.num_unsafe_lines, counter.num_unsafe_blocks
+
+
+NON_WHITESPACE = re.compile(r"\S+")
+# The offset map of a PatchEngine has one entry per block of this many characters of the code
+MAP_BLOCK_SIZE = 1024
+
+
+def normalize_whitespace(code: str) -> str:
+    # Remove all whitespace including newlines
+    return "".join(NON_WHITESPACE.findall(code))
+
+
+class PatchError(ValueError):
+    """Raised when one or more replacements can't be applied. failures holds (index, replacement, reason) for each."""
+
+    def __init__(self, failures: list):
+        self.failures = failures
+        super().__init__(
+            "\n".join(f"{reason}: {replacement['original']}" for _, replacement, reason in failures)
+        )
+
+
+class PatchEngine:
+    """Whitespace-insensitive replacement of strings in one version of a file.
+
+    The whitespace-free text and a map from its offsets back to the original (one entry per MAP_BLOCK_SIZE
+    characters, so a lookup scans at most one block) are built once with string methods, so locating each
+    replacement is a single substring search.
+    Every replacement is matched against the original code; a replacement fails if its original isn't found,
+    is found more than once, or overlaps another replacement. With a fuzzy_threshold, an original that isn't found
+    is applied at its best unique near-match scoring at least that similarity instead, recorded in fuzzy_matches.
+    """
+
+    def __init__(self, code: str, fuzzy_threshold: float | None = None):
+        self.code = code
+        self.fuzzy_threshold = fuzzy_threshold
+        self.fuzzy_matches = []
+        blocks = [
+            "".join(code[start : start + MAP_BLOCK_SIZE].split()) for start in range(0, len(code), MAP_BLOCK_SIZE)
+        ]
+        # Offset in the whitespace-free text of each block's first non-whitespace character
+        self.block_norm_starts = array("q", accumulate(map(len, blocks), initial=0))
+        self.normalized = "".join(blocks)
+        self.edits = []
+
+    def to_original(self, norm_pos: int) -> int:
+        # The last block starting at or before norm_pos, since blocks of only whitespace start where the next one does
+        block = bisect_right(self.block_norm_starts, norm_pos) - 1
+        remaining = norm_pos - self.block_norm_starts[block]
+        block_start = block * MAP_BLOCK_SIZE
+        for match in NON_WHITESPACE.finditer(self.code, block_start, block_start + MAP_BLOCK_SIZE):
+            if remaining < match.end() - match.start():
+                return match.start() + remaining
+            remaining -= match.end() - match.start()
+        raise ValueError(f"Offset {norm_pos} is past the end of the whitespace-free text")
+
+    def locate(self, original: str) -> tuple[int, int, str | None, float | None]:
+        """Return (start, end, None, similarity) for the span of the code matching original, where similarity is
+        None unless it is only a near-match, or (-1, -1, reason, None)."""
+        needle = normalize_whitespace(original)
+        if not needle:
+            return -1, -1, "Replacement string is empty (after whitespace normalization)", None
+        norm_pos = self.normalized.find(needle)
+        if norm_pos == -1:
+            match = get_fuzzy_index(self.code).find(original, self.fuzzy_threshold) if self.fuzzy_threshold else None
+            if match is None:
+                return -1, -1, "Replacement string not found in code (after whitespace normalization)", None
+            return match[0], match[1], None, match[2]
+        if self.normalized.find(needle, norm_pos + 1) != -1:
+            count = self.normalized.count(needle)
+            reason = f"Replacement string not unique in code (found {count} times after whitespace normalization)"
+            return -1, -1, reason, None
+        return self.to_original(norm_pos), self.to_original(norm_pos + len(needle) - 1) + 1, None, None
+
+    def add(self, replacement: dict) -> str | None:
+        """Locate a replacement and queue it. Returns the reason it can't be applied, or None."""
+        start, end, reason, similarity = self.locate(replacement["original"])
+        if reason:
+            return reason
+        index = bisect_right(self.edits, (start, end))
+        for neighbor in self.edits[max(index - 1, 0) : index + 1]:
+            if neighbor[0] < end and start < neighbor[1]:
+                return f"Replacement overlaps another replacement ({self.code[neighbor[0] : neighbor[1]]!r})"
+        self.edits.insert(index, (start, end, replacement["new"]))
+        if similarity is not None:
+            self.fuzzy_matches.append((replacement["original"], self.code[start:end], similarity))
+        return None
+
+    def apply(self) -> str:
+        pieces = []
+        pos = 0
+        for start, end, new in self.edits:
+            pieces.append(self.code[pos:start])
+            pieces.append(new)
+            pos = end
+        pieces.append(self.code[pos:])
+        return "".join(pieces)
+
+
+def patch_code(current_code: str, changes: list, fuzzy_threshold: float | None = None) -> PatchEngine:
+    """Locate every change, returning the engine holding the edits. Raises PatchError listing every replacement
+    that couldn't be applied."""
+    engine = PatchEngine(current_code, fuzzy_threshold)
+    failures = []
+    for index, replacement in enumerate(changes):
+        reason = engine.add(replacement)
+        if reason:
+            failures.append((index, replacement, reason))
+    if failures:
+        raise PatchError(failures)
+    return engine
+
+
+def apply_changes(current_code: str, changes: list, fuzzy_threshold: float | None = None) -> str:
+    return patch_code(current_code, changes, fuzzy_threshold).apply()
 
 
 if __name__ == "__main__":
@@ -2,26 +2,61 @@ import json
 from dotenv import load_dotenv
 import openai
 import os
+import time
 from pydantic import BaseModel
 
-from utils.misc import apply_changes
-from config import CARGO_PATH
+from utils.cache import ResponseCache
+from utils.context import get_omitted_note, select_context
+from utils.diff import get_code_changes
+from utils.llm_client import AsyncLLMClient
+from utils.metrics import metrics
+from utils.misc import PatchError, patch_code
+from utils.patch_stream import StreamingPatcher
+from config import (
+    CARGO_PATH,
+    CODE_PATH,
+    FUZZY_MATCH_THRESHOLD,
+    STREAM_PATCHES,
+    STREAM_PATCH_MAX_FAILURES,
+    LLM_CACHE_MODE,
+    LLM_CACHE_MAX_SIZE_MB,
+    LLM_CACHE_MAX_AGE_DAYS,
+    LLM_MAX_IN_FLIGHT,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_MAX_RETRIES,
+)
+
+MODEL = "gpt-4o"
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI()
+llm = AsyncLLMClient(LLM_MAX_IN_FLIGHT, LLM_REQUESTS_PER_MINUTE, LLM_MAX_RETRIES)
+cache = ResponseCache(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cache", "llm")),
+    LLM_CACHE_MODE,
+    LLM_CACHE_MAX_SIZE_MB,
+    LLM_CACHE_MAX_AGE_DAYS,
+)
 
 
-def call_openai_api(prompt):
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "user", "content": prompt},
-        ],
-        stream=False,
-    )
+def record_run(run_dir, resumed=False):
+    """Keep the run's LLM responses in run_dir, replaying the interrupted run's first if it is being resumed."""
+    cache.record_run(os.path.join(run_dir, "llm_responses"), resumed)
+
+
+async def call_openai_api_async(prompt, sample=0):
+    key = cache.key(MODEL, prompt, None, sample)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = await llm.complete(MODEL, prompt)
+    cache.put(key, result)
+    return result
 
-    return completion.choices[0].message.content
+
+def call_openai_api(prompt, sample=0):
+    return llm.run_sync(call_openai_api_async(prompt, sample))
 
 
 class Replacement(BaseModel):
@@ -37,16 +72,86 @@ class ReplacementListWithCargo(BaseModel):
     cargo_replacements: list[Replacement]
 
 
-def call_openai_api_for_patch(prompt):
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o",
-        messages=[
-            {"role": "user", "content": prompt},
-        ],
-        response_format=(ReplacementListWithCargo if CARGO_PATH else ReplacementList),
+async def call_openai_api_for_patch_async(prompt, sample=0):
+    response_format = ReplacementListWithCargo if CARGO_PATH else ReplacementList
+    key = cache.key(MODEL, prompt, response_format.model_json_schema(), sample)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = await llm.parse(MODEL, prompt, response_format)
+    cache.put(key, result)
+    return result
+
+
+def call_openai_api_for_patch(prompt, sample=0):
+    return llm.run_sync(call_openai_api_for_patch_async(prompt, sample))
+
+
+class StrategyList(BaseModel):
+    strategies: list[str]
+
+
+async def call_openai_api_for_strategies_async(prompt, sample=0):
+    """Request a StrategyList, returning the strategies."""
+    key = cache.key(MODEL, prompt, StrategyList.model_json_schema(), sample)
+    result = cache.get(key)
+    if result is None:
+        result = await llm.parse(MODEL, prompt, StrategyList)
+        cache.put(key, result)
+    return json.loads(result)["strategies"]
+
+
+def call_openai_api_for_strategies(prompt, sample=0):
+    return llm.run_sync(call_openai_api_for_strategies_async(prompt, sample))
+
+
+async def call_openai_api_for_patch_streaming_async(prompt, current_code, current_toml, logger, sample=0):
+    """Stream a patch, locating each replacement as soon as it arrives. Returns (result, new_code, new_toml, edits).
+
+    Raises PatchError listing the replacements that can't be applied once the response is complete, or cancels the
+    request as soon as STREAM_PATCH_MAX_FAILURES of them failed, after logging the response up to that point as
+    generation attempt sample.
+    """
+    response_format = ReplacementListWithCargo if CARGO_PATH else ReplacementList
+    key = cache.key(MODEL, prompt, response_format.model_json_schema(), sample)
+    cached = cache.get(key)
+    if cached is not None:
+        try:
+            return apply_patch(cached, current_code, current_toml, logger)
+        except PatchError:
+            logger.log_generation_attempt(cached, sample)
+            raise
+
+    patchers = []
+
+    def make_patcher():
+        patchers.append(
+            StreamingPatcher(current_code, current_toml, FUZZY_MATCH_THRESHOLD, STREAM_PATCH_MAX_FAILURES)
+        )
+        return patchers[-1]
+
+    try:
+        result, patcher = await llm.stream_parse(MODEL, prompt, response_format, make_patcher)
+    except PatchError:
+        logger.log_generation_attempt(patchers[-1].text, sample)
+        raise
+    cache.put(key, result)
+    try:
+        patcher.check()
+    except PatchError:
+        logger.log_generation_attempt(result, sample)
+        raise
+    start = time.perf_counter()
+    new_code, new_toml = patcher.new_code, patcher.new_toml
+    metrics.record(
+        "apply", patcher.apply_time + time.perf_counter() - start, replacements=patcher.num_applied, streamed=True
     )
+    log_fuzzy_matches(patcher.code_engine, logger)
+    if patcher.toml_engine:
+        log_fuzzy_matches(patcher.toml_engine, logger, "Cargo.toml")
+    return result, new_code, new_toml, patcher.code_engine.edits
 
-    return completion.choices[0].message.content
 
 def get_task_modification_requirements(original_task_description):
     requirements = f"""For the new task description, you must follow these guidelines:
@@ -59,7 +164,7 @@ def get_task_modification_requirements(original_task_description):
         requirements += "\n- You are only modifying the code, so don't try anything that would require adding new packages. You can't edit the Cargo.toml file."
     return requirements
 
-def generate_code(task_description, current_code, current_toml, generation_attempt, logger):
+def get_code_generation_prompt(task_description, current_code, current_toml):
     cargo_pre_instructions = "\nHere is the Cargo.toml file:\n" + current_toml if current_toml else ""
     cargo_format_instructions = """    ],
     "cargo_replacements": [
@@ -69,9 +174,11 @@ def generate_code(task_description, current_code, current_toml, generation_attem
         }}
     ]"""
 
+    code_context = select_context(current_code, task_description)
     prompt = f""" 
 You are a software engineering assistant. You are given some code and a task description on how to modify it.
-{current_code}
+{code_context}
+{get_omitted_note(current_code, code_context)}
 
 
 Here is the task description:
@@ -106,18 +213,56 @@ Ensure:
 - Newlines should be preserved.
 - Make absolutely sure you don't leave any dangling delimiters. Preserve the net delimiter count from the original to the new (if there's one extra {{ in original, there should be one extra {{ in new, etc.)
 """
-    result = call_openai_api_for_patch(prompt)
-    logger.log_generation_attempt(result, generation_attempt)
+    return prompt
+
+
+def log_fuzzy_matches(engine, logger, file_name="code"):
+    for original, matched, similarity in engine.fuzzy_matches:
+        logger.log_verbose(
+            f"Replacement not found verbatim in {file_name}, applied at near-match with similarity {similarity:.3f}:\n"
+            f"Original:\n{original}\nMatched:\n{matched}"
+        )
+
+
+def apply_patch(result, current_code, current_toml, logger):
     result_json = json.loads(result)
-    new_code = apply_changes(current_code, result_json["replacements"])
-    if CARGO_PATH:
-        new_toml = apply_changes(current_toml, result_json["cargo_replacements"])
-    else:
-        new_toml = None
-    return result, new_code, new_toml
+    with metrics.span("apply", replacements=len(result_json["replacements"])):
+        engine = patch_code(current_code, result_json["replacements"], FUZZY_MATCH_THRESHOLD)
+        toml_engine = None
+        if CARGO_PATH:
+            toml_engine = patch_code(current_toml, result_json["cargo_replacements"], FUZZY_MATCH_THRESHOLD)
+        new_code = engine.apply()
+        new_toml = toml_engine.apply() if toml_engine else None
+    log_fuzzy_matches(engine, logger)
+    if toml_engine:
+        log_fuzzy_matches(toml_engine, logger, "Cargo.toml")
+    return result, new_code, new_toml, engine.edits
+
+
+def generate_code(task_description, current_code, current_toml, generation_attempt, logger, cancel_event=None):
+    return llm.run_sync(
+        generate_code_async(task_description, current_code, current_toml, generation_attempt, logger), cancel_event
+    )
 
 
-def generate_code_generation_failure_analysis(task_description, current_code, num_attempts, original_task_description):
+async def generate_code_async(task_description, current_code, current_toml, generation_attempt, logger):
+    prompt = get_code_generation_prompt(task_description, current_code, current_toml)
+    if STREAM_PATCHES:
+        patch = await call_openai_api_for_patch_streaming_async(
+            prompt, current_code, current_toml, logger, sample=generation_attempt
+        )
+        logger.log_generation_attempt(patch[0], generation_attempt)
+        return patch
+
+    result = await call_openai_api_for_patch_async(prompt, sample=generation_attempt)
+    logger.log_generation_attempt(result, generation_attempt)
+    return apply_patch(result, current_code, current_toml, logger)
+
+
+def get_code_generation_failure_analysis_prompt(
+    task_description, current_code, num_attempts, original_task_description
+):
+    code_context = select_context(current_code, task_description)
     prompt = f"""
 You are a software engineering assistant. You were given some code and a task description on how to modify it.
 
@@ -125,29 +270,55 @@ Here was the task description:
 {task_description}
 
 Here was the code you generated:
-{current_code}
+{code_context}
+{get_omitted_note(current_code, code_context)}
 
 Using this information, you tried {num_attempts} times to generate code in a patch format that would modify the original code to generate code that would produce the expected output. All attempts failed.
 Based on this information, modify the task description to make it easier to generate code that will produce the expected output, maintaining the original strategy.
 {get_task_modification_requirements(original_task_description)}
 """
 
-    return call_openai_api(prompt)
+    return prompt
+
+
+def generate_code_generation_failure_analysis(task_description, current_code, num_attempts, original_task_description):
+    return call_openai_api(
+        get_code_generation_failure_analysis_prompt(
+            task_description,
+            current_code,
+            num_attempts,
+            original_task_description,
+        )
+    )
+
 
+async def generate_code_generation_failure_analysis_async(
+    task_description, current_code, num_attempts, original_task_description
+):
+    return await call_openai_api_async(
+        get_code_generation_failure_analysis_prompt(
+            task_description,
+            current_code,
+            num_attempts,
+            original_task_description,
+        )
+    )
 
-def generate_build_analysis(task_description, new_code, build_output, original_task_description, original_code):
 
+def get_build_analysis_prompt(
+    task_description, new_code, build_output, original_task_description, original_code, code_path=CODE_PATH
+):
+
+    code_changes = get_code_changes(
+        original_code, new_code, build_output, "Here was the new code you generated:", code_path, task_description
+    )
     prompt = f"""
 You are a software engineering assistant. You were given some code and a task description on how to modify it.
 
 Here was the task description:
 {task_description}
 
-Here was the original code:
-{original_code}
-
-Here was the new code you generated:
-{new_code}
+{code_changes}
 
 The stderr from compiling the code was:
 {build_output}
@@ -159,10 +330,40 @@ If you think it didn't work, return "bad: " plus a new task description that wil
 {get_task_modification_requirements(original_task_description)}
 """
 
-    return call_openai_api(prompt)
+    return prompt
 
 
-def generate_test_analysis(task_description, original_code, new_code, run_output, original_task_description):
+def generate_build_analysis(
+    task_description, new_code, build_output, original_task_description, original_code, code_path=CODE_PATH
+):
+    return call_openai_api(
+        get_build_analysis_prompt(
+            task_description,
+            new_code,
+            build_output,
+            original_task_description,
+            original_code,
+            code_path,
+        )
+    )
+
+
+async def generate_build_analysis_async(
+    task_description, new_code, build_output, original_task_description, original_code, code_path=CODE_PATH
+):
+    return await call_openai_api_async(
+        get_build_analysis_prompt(
+            task_description,
+            new_code,
+            build_output,
+            original_task_description,
+            original_code,
+            code_path,
+        )
+    )
+
+
+def get_test_analysis_prompt(task_description, original_code, new_code, run_output, original_task_description):
 
     prompt = f"""
 You are a software engineering assistant. You were given some code and a task description on how to modify it.
@@ -170,11 +371,7 @@ You are a software engineering assistant. You were given some code and a task de
 Here was the task description:
 {task_description}
 
-Here was the original code:
-{original_code}
-
-Here was the code you generated:
-{new_code}
+{get_code_changes(original_code, new_code, query=task_description)}
 
 The program was compiled successfully, however the output from running the program did not include the expected output.
 {run_output}
@@ -183,10 +380,36 @@ Based on this information, make a new, better task description that will modify
 {get_task_modification_requirements(original_task_description)}
 """
 
-    return call_openai_api(prompt)
+    return prompt
 
 
-def generate_code_safety_analysis(
+def generate_test_analysis(task_description, original_code, new_code, run_output, original_task_description):
+    return call_openai_api(
+        get_test_analysis_prompt(
+            task_description,
+            original_code,
+            new_code,
+            run_output,
+            original_task_description,
+        )
+    )
+
+
+async def generate_test_analysis_async(
+    task_description, original_code, new_code, run_output, original_task_description
+):
+    return await call_openai_api_async(
+        get_test_analysis_prompt(
+            task_description,
+            original_code,
+            new_code,
+            run_output,
+            original_task_description,
+        )
+    )
+
+
+def get_code_safety_analysis_prompt(
     task_description, original_code, new_code, num_old_unsafe_lines, num_new_unsafe_lines, original_task_description
 ):
 
@@ -196,11 +419,7 @@ You are a software engineering assistant. You were given some code and a task de
 Here was the task description:
 {task_description}
 
-Here was the original code:
-{original_code}
-
-Here was the code you generated:
-{new_code}
+{get_code_changes(original_code, new_code, query=task_description)}
 
 The program compiled and ran successfully, preserving the original functionality.
 
@@ -212,4 +431,34 @@ If you think it is possible, return "good: " plus a new task description that wi
 {get_task_modification_requirements(original_task_description)}
 """
 
-    return call_openai_api(prompt)
+    return prompt
+
+
+def generate_code_safety_analysis(
+    task_description, original_code, new_code, num_old_unsafe_lines, num_new_unsafe_lines, original_task_description
+):
+    return call_openai_api(
+        get_code_safety_analysis_prompt(
+            task_description,
+            original_code,
+            new_code,
+            num_old_unsafe_lines,
+            num_new_unsafe_lines,
+            original_task_description,
+        )
+    )
+
+
+async def generate_code_safety_analysis_async(
+    task_description, original_code, new_code, num_old_unsafe_lines, num_new_unsafe_lines, original_task_description
+):
+    return await call_openai_api_async(
+        get_code_safety_analysis_prompt(
+            task_description,
+            original_code,
+            new_code,
+            num_old_unsafe_lines,
+            num_new_unsafe_lines,
+            original_task_description,
+        )
+    )
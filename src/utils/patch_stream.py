@@ -0,0 +1,107 @@
+import json
+import time
+
+from utils.misc import PatchEngine, PatchError
+
+
+class StreamingPatcher:
+    """Applies the replacements of a streamed ReplacementList/ReplacementListWithCargo response as they arrive.
+
+    feed() scans each new chunk of JSON text once, tracking nesting depth and string state. As soon as an element of
+    the "replacements" (or "cargo_replacements") array is complete it is located in the code (or Cargo.toml).
+    Replacements that can't be applied are collected, and check() raises PatchError listing all of them once the
+    response is complete. Once there are max_failures of them, feed() raises it while the rest is still streaming.
+    """
+
+    def __init__(self, current_code, current_toml, fuzzy_threshold=None, max_failures=None):
+        self.engines = {
+            "replacements": PatchEngine(current_code, fuzzy_threshold),
+            "cargo_replacements": PatchEngine(current_toml, fuzzy_threshold) if current_toml is not None else None,
+        }
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.last_key = None
+        self.array_key = None
+        self.element_start = 0
+        self.num_applied = 0
+        self.max_failures = max_failures
+        # (index, replacement, reason) of each replacement that couldn't be applied
+        self.failures = []
+        # Time spent locating replacements, spread over the stream
+        self.apply_time = 0.0
+
+    @property
+    def new_code(self):
+        return self.engines["replacements"].apply()
+
+    @property
+    def new_toml(self):
+        engine = self.engines["cargo_replacements"]
+        return engine.apply() if engine else None
+
+    @property
+    def code_engine(self):
+        return self.engines["replacements"]
+
+    @property
+    def toml_engine(self):
+        return self.engines["cargo_replacements"]
+
+    def feed(self, delta):
+        self.text += delta
+        for i in range(self.pos, len(self.text)):
+            c = self.text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = json.loads(self.text[self.string_start : i + 1])
+                continue
+
+            if c == '"':
+                self.in_string = True
+                self.string_start = i
+            elif c in "{[":
+                self.depth += 1
+                if c == "[" and self.depth == 2:
+                    self.array_key = self.last_key
+                elif c == "{" and self.depth == 3:
+                    self.element_start = i
+            elif c in "}]":
+                if c == "}" and self.depth == 3:
+                    self.apply(self.array_key, json.loads(self.text[self.element_start : i + 1]))
+                self.depth -= 1
+        self.pos = len(self.text)
+
+    def apply(self, key, replacement):
+        engine = self.engines.get(key)
+        if engine is None:
+            return
+        start = time.perf_counter()
+        reason = engine.add(replacement)
+        self.apply_time += time.perf_counter() - start
+        if not reason:
+            self.num_applied += 1
+            return
+        self.failures.append((self.num_applied + len(self.failures), replacement, reason))
+        if self.max_failures is not None and len(self.failures) >= self.max_failures:
+            index, replacement, reason = self.failures[-1]
+            reason += (
+                f" (generation aborted after {len(self.failures)} failed and {self.num_applied} applied replacements, "
+                f"{len(self.text)} characters)"
+            )
+            self.failures[-1] = (index, replacement, reason)
+            raise PatchError(self.failures)
+
+    def check(self):
+        """Raise PatchError for the replacements that couldn't be applied, if any."""
+        if self.failures:
+            raise PatchError(self.failures)
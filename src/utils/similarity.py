@@ -0,0 +1,57 @@
+import math
+import re
+from collections import Counter
+
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+STOPWORDS = frozenset(
+    """a an and are as at be by for from if in into is it its of on or so that the their them then this to was
+    which with all any each it's should would will can this these those""".split()
+)
+
+
+def tokenize(text):
+    return [word for word in (w.lower() for w in WORD.findall(text)) if word not in STOPWORDS]
+
+
+class StrategyIndex:
+    """TF-IDF index over strategy descriptions, for finding near-duplicates without a network call.
+
+    Document frequencies are updated as strategies are added, so words every strategy uses ("unsafe", "safer")
+    weigh less and less while the names of the functions and techniques they target dominate the similarity.
+    """
+
+    def __init__(self):
+        self.documents = []
+        self.term_counts = []
+        self.document_frequency = Counter()
+
+    def add(self, text):
+        terms = Counter(tokenize(text))
+        self.documents.append(text)
+        self.term_counts.append(terms)
+        self.document_frequency.update(terms.keys())
+
+    def vector(self, terms):
+        num_documents = len(self.documents)
+        vector = {
+            term: (1 + math.log(count)) * (math.log((1 + num_documents) / (1 + self.document_frequency[term])) + 1)
+            for term, count in terms.items()
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+    def similarity(self, a, b):
+        """Cosine similarity of two texts, weighted by this index's document frequencies."""
+        a_vector, b_vector = self.vector(Counter(tokenize(a))), self.vector(Counter(tokenize(b)))
+        return sum(weight * b_vector.get(term, 0.0) for term, weight in a_vector.items())
+
+    def most_similar(self, text):
+        """(similarity, index) of the indexed strategy most similar to text, or (0.0, None) if there is none."""
+        query = self.vector(Counter(tokenize(text)))
+        best = (0.0, None)
+        for index, terms in enumerate(self.term_counts):
+            document = self.vector(terms)
+            score = sum(weight * document.get(term, 0.0) for term, weight in query.items())
+            if score > best[0]:
+                best = (score, index)
+        return best
@@ -1,6 +1,18 @@
+import asyncio
+import heapq
+import threading
 from enum import Enum, auto
-from utils.openai import call_openai_api
+from utils.openai import call_openai_api_for_strategies_async, llm
+from utils.context import IDENTIFIER, OMITTED, get_code_index, select_context
 from utils.logger import Logger
+from utils.metrics import metrics
+from utils.similarity import StrategyIndex
+from config import (
+    STRATEGY_BATCH_SIZE,
+    STRATEGY_MAX_EMPTY_BATCHES,
+    STRATEGY_DUPLICATE_THRESHOLD,
+    FAILED_STRATEGY_HISTORY,
+)
 
 
 class StrategyStatus(Enum):
@@ -9,6 +21,11 @@ class StrategyStatus(Enum):
     CODE_SAFETY_DETERIORATED = auto()
     CODE_SAFETY_UNCHANGED = auto()
     FAILED_TOO_LONG = auto()
+    # Improved the code on its own, but couldn't be merged with the changes to other files (crate mode)
+    MERGE_CONFLICT = auto()
+
+
+FAILED = (StrategyStatus.FAILED_TOO_LONG, StrategyStatus.CODE_SAFETY_DETERIORATED, StrategyStatus.CODE_SAFETY_UNCHANGED)
 
 
 class Strategy:
@@ -18,64 +35,215 @@ class Strategy:
 
 
 class Strategizer:
+    """Generates strategies STRATEGY_BATCH_SIZE at a time and hands them out best first.
+
+    Queued strategies are scored by the number of unsafe lines in the items they name, discounted by their overlap
+    with strategies that already failed, and rescored whenever the code changes. Strategies that only named items
+    which no longer contain unsafe code are dropped, and so are near-duplicates (by TF-IDF similarity) of failed or
+    queued strategies.
+    """
+
     def __init__(self, logger: Logger):
         self.logger = logger
         self.strategies: list[Strategy] = []
+        # Failed strategies, in the order of self.failed_strategies()
+        self.failed_index = StrategyIndex()
+        # Heap of (-score, batch order, prompt, unsafe lines targeted) of strategies not handed out yet
+        self.queue = []
+        self.queue_code = None
+        self.num_queued = 0
+        self.num_batches = 0
+        # Batches in a row that contained no strategy
+        self.num_empty_batches = 0
+        self.lock = threading.Lock()
+        # Future of the batch being generated on the LLM client's event loop
+        self.next_batch = None
 
     def generate_strategy(self, current_code, current_toml):
+        """Hand out the best queued strategy, waiting for a batch if the queue is empty. Safe to call from several
+        threads. Raises RuntimeError once STRATEGY_MAX_EMPTY_BATCHES batches in a row contained no strategy."""
         success_count = sum(1 for strategy in self.strategies if strategy.result == StrategyStatus.SUCCESS)
         if success_count != len(self.strategies):
             print("\n", self.get_failed_strategies())
 
+        while True:
+            with self.lock:
+                if current_code != self.queue_code:
+                    self.rescore(current_code)
+                if self.queue:
+                    strategy = heapq.heappop(self.queue)[2]
+                    # Request the next batch while this strategy runs
+                    if not self.queue and self.next_batch is None:
+                        self.request_batch(current_code, current_toml)
+                    break
+                if self.next_batch is None:
+                    self.request_batch(current_code, current_toml)
+                next_batch = self.next_batch
+            try:
+                batch = next_batch.result()
+                with self.lock:
+                    if self.next_batch is next_batch:
+                        self.next_batch = None
+                        prompts = [prompt for prompt in map(str.strip, batch) if prompt]
+                        if not prompts:
+                            self.num_empty_batches += 1
+                            self.logger.log_to_run(f"Strategy batch {self.num_batches} contained no strategies")
+                            if self.num_empty_batches >= STRATEGY_MAX_EMPTY_BATCHES:
+                                raise RuntimeError(f"{self.num_empty_batches} strategy batches in a row were empty")
+                            continue
+                        self.num_empty_batches = 0
+                        if not self.add_batch(prompts, current_code):
+                            # Every strategy was a repeat: run the first one anyway rather than asking forever
+                            self.push(prompts[0], current_code)
+            finally:
+                # If the batch failed, drop it so that the next call requests a new one instead of raising again
+                with self.lock:
+                    if self.next_batch is next_batch:
+                        self.next_batch = None
+
+        self.logger.log_strategy(strategy)
+        return strategy
+
+    def request_batch(self, current_code, current_toml):
+        self.num_batches += 1
+        planned = [entry[2] for entry in self.queue]
+        self.next_batch = asyncio.run_coroutine_threadsafe(
+            self.generate_batch(current_code, current_toml, planned, self.get_failed_strategies(), self.num_batches),
+            llm.get_loop(),
+        )
+
+    async def generate_batch(self, current_code, current_toml, planned, failed_strategies, batch_num):
         if current_toml:
             toml_message = f"Here is the current Cargo.toml file:\n{current_toml}"
         else:
             toml_message = ""
+        planned_message = (
+            "These strategies are already planned, so don't repeat them:\n" + "".join(f"• {p}\n" for p in planned)
+            if planned
+            else ""
+        )
 
+        # Only unsafe code can be made safer, so the bodies of safe functions are omitted. Selecting them is CPU work,
+        # so it runs in a thread rather than holding up the other requests on the event loop
+        code_context = await asyncio.to_thread(select_context, current_code)
         prompt = f"""
 You are a software engineering assistant. Your goal is to make a rust file safer, as defined by the number of unsafe lines in the code.
 
-Here is the current code:
-{current_code}
+Here is the current code{f" (bodies of safe functions are shown as {OMITTED})" if code_context != current_code else ""}:
+{code_context}
 
 {toml_message}
 
-{self.get_failed_strategies()}
-
+{failed_strategies}
+{planned_message}
 You may not use other files in the same codebase unless you KNOW e.g. you've seen proof that that code exists.
 
-Based on the current code, generate a description of a modification strategy that would make the code safer.
-The strategy should be 1-2 sentences, and should only change an isolated amount of the code, instead of making sweeping changes.
+Based on the current code, generate descriptions of {STRATEGY_BATCH_SIZE} distinct modification strategies that would make the code safer, most promising first.
+Each strategy should be 1-2 sentences, and should only change an isolated amount of the code, instead of making sweeping changes.
 {"You may not change the Cargo.toml file, so don't try to add any dependencies." if not current_toml else ""}
-The strategy should be a single isolated strategy, such as "change this struct to use generic types to isolate the unsafe code (and its uses)" or "change this function to use the rust standard library instead of a c library (and everything that calls it)".
-Make sure the strategy makes the code SAFER, not just more idiomatic/cleaner/faster. Make sure you include removing the "unsafe" keyword if it will no longer be needed.
-Do not explain your reasoning. Just return the strategy.
+Each strategy should be a single isolated strategy, such as "change this struct to use generic types to isolate the unsafe code (and its uses)" or "change this function to use the rust standard library instead of a c library (and everything that calls it)".
+Name the functions, structs and impls each strategy changes.
+Make sure each strategy makes the code SAFER, not just more idiomatic/cleaner/faster. Make sure you include removing the "unsafe" keyword if it will no longer be needed.
+Do not explain your reasoning. Just return the strategies.
 """
-        strategy = call_openai_api(prompt)
-        # strategy = "The current init_nic() function constructs an E1000Nic with placeholder values (zeros, None, empty vectors) and then gradually mutates it through multiple initialization calls, which breaks Rust's RAII principle by allowing partially-initialized state. To fix this, we need to redesign construction so that a fully valid E1000Nic is created in one step using a new() constructor. This means gathering all the required runtime information—such as PCI memory mappings, interrupt vectors, DMA regions, EEPROM presence, MAC address, and RX/TX descriptors—before instantiating the struct. Each field should be initialized with its real value, not a placeholder, and any setup that interacts with hardware (e.g., writing registers, allocating memory) should either happen before construction or be embedded into field-building helper functions. By doing this, we eliminate the risk of using the NIC in an invalid state, ensure safe construction logic, and align with idiomatic Rust by having E1000Nic::new(pci) return a fully working, ready-to-use network device."
-        self.logger.log_strategy(strategy)
-        return strategy
+        with metrics.span("strategy_batch", batch=batch_num):
+            return await call_openai_api_for_strategies_async(prompt, sample=batch_num)
+
+    def score(self, prompt, code):
+        """(score, unsafe lines targeted) of a strategy for code."""
+        targeted = get_code_index(code).count_unsafe_lines(set(IDENTIFIER.findall(prompt)))
+        overlap, _ = self.failed_index.most_similar(prompt)
+        # Strategies that don't name anything still rank among themselves by overlap
+        return (targeted + 1) * (1 - overlap), targeted
+
+    def push(self, prompt, code):
+        score, targeted = self.score(prompt, code)
+        heapq.heappush(self.queue, (-score, self.num_queued, prompt, targeted))
+        self.num_queued += 1
+
+    def find_duplicate(self, prompt):
+        """A failed or queued strategy that prompt is a near-duplicate of, or None."""
+        similarity, index = self.failed_index.most_similar(prompt)
+        if similarity >= STRATEGY_DUPLICATE_THRESHOLD:
+            return self.failed_index.documents[index]
+        tried = {s.prompt.strip().lower() for s in self.strategies}
+        if prompt.lower() in tried:
+            return prompt
+        for entry in self.queue:
+            if self.failed_index.similarity(prompt, entry[2]) >= STRATEGY_DUPLICATE_THRESHOLD:
+                return entry[2]
+        return None
+
+    def add_batch(self, batch, code):
+        """Queue the new strategies of a batch, returning how many there were."""
+        num_added = 0
+        for prompt in map(str.strip, batch):
+            if not prompt:
+                continue
+            duplicate = self.find_duplicate(prompt)
+            if duplicate:
+                self.logger.log_to_run(f"Skipped near-duplicate strategy: {prompt}\n  (similar to: {duplicate})")
+                continue
+            self.push(prompt, code)
+            num_added += 1
+        return num_added
+
+    def rescore(self, code):
+        queue = self.queue
+        self.queue = []
+        self.queue_code = code
+        for _, order, prompt, targeted in queue:
+            score, new_targeted = self.score(prompt, code)
+            if targeted and not new_targeted:
+                continue
+            heapq.heappush(self.queue, (-score, order, prompt, new_targeted))
+
+    def failed_strategies(self):
+        return [strategy for strategy in self.strategies if strategy.result in FAILED]
 
     def get_failed_strategies(self):
+        """Prompt section listing failed strategies. Near-duplicates are merged and only the
+        FAILED_STRATEGY_HISTORY most recent groups are listed, so the section stays bounded on long runs."""
         success_count = sum(1 for strategy in self.strategies if strategy.result == StrategyStatus.SUCCESS)
         if success_count == len(self.strategies):
             return ""
+
+        # [latest strategy, number of strategies] per group of near-duplicates, oldest group first
+        groups = []
+        for strategy in self.failed_strategies():
+            group = next(
+                (
+                    group
+                    for group in reversed(groups)
+                    if self.failed_index.similarity(strategy.prompt, group[0].prompt) >= STRATEGY_DUPLICATE_THRESHOLD
+                ),
+                None,
+            )
+            if group:
+                groups.remove(group)
+                groups.append([strategy, group[1] + 1])
+            else:
+                groups.append([strategy, 1])
+
         text = f"\nOut of the {len(self.strategies)} strategies you have tried so far, the following ones did not make the code safer:\n"
-        for strategy in self.strategies:
+        if len(groups) > FAILED_STRATEGY_HISTORY:
+            text += f"• ({len(groups) - FAILED_STRATEGY_HISTORY} older failed strategies are not shown)\n"
+        for strategy, count in groups[-FAILED_STRATEGY_HISTORY:]:
+            repeats = f" (tried {count} similar strategies)" if count > 1 else ""
             match strategy.result:
                 case StrategyStatus.FAILED_TOO_LONG:
-                    text += f"• This strategy took too long to generate a positive safety result, and thus timed out: {strategy.prompt}\n"
+                    text += f"• This strategy took too long to generate a positive safety result, and thus timed out{repeats}: {strategy.prompt}\n"
                 case StrategyStatus.CODE_SAFETY_DETERIORATED:
-                    text += f"• This strategy made the code less safe: {strategy.prompt}\n"
+                    text += f"• This strategy made the code less safe{repeats}: {strategy.prompt}\n"
                 case StrategyStatus.CODE_SAFETY_UNCHANGED:
-                    text += f"• This strategy made no changes to the code safety: {strategy.prompt}\n"
-                case _:
-                    pass
+                    text += f"• This strategy made no changes to the code safety{repeats}: {strategy.prompt}\n"
         return text + "\nDo not repeat these strategies unless you have a good reason to do so.\n"
 
     def add_strategy(self, strategy_prompt, result, attempts, time_taken, initial_unsafe_lines):
         strategy = Strategy(strategy_prompt, result)
         self.strategies.append(strategy)
+        if result in FAILED:
+            self.failed_index.add(strategy_prompt)
 
         log_message = ""
         match result:
@@ -87,10 +255,21 @@ Do not explain your reasoning. Just return the strategy.
                 log_message = "code safety unchanged"
             case StrategyStatus.FAILED_TOO_LONG:
                 log_message = "failed to generate a successful implementation in time"
+            case StrategyStatus.MERGE_CONFLICT:
+                log_message = "code safety improved, but the change conflicted with other files"
             case _:
                 log_message = "unknown error"
         self.logger.log_strategy_result(f"Result: {log_message} in {attempts} attempt{'s' if attempts != 1 else ''} and {time_taken:.2f}s", initial_unsafe_lines)
 
+    def get_state(self):
+        return [{"prompt": strategy.prompt, "result": strategy.result.name} for strategy in self.strategies]
+
+    def restore(self, state):
+        self.strategies = [Strategy(strategy["prompt"], StrategyStatus[strategy["result"]]) for strategy in state]
+        self.failed_index = StrategyIndex()
+        for strategy in self.failed_strategies():
+            self.failed_index.add(strategy.prompt)
+
     def should_quit(self):
         consecutive_failures = 0
         for strategy in reversed(self.strategies):
@@ -0,0 +1,60 @@
+from utils.unsafe_counter import (
+    OPEN_BRACE,
+    CLOSE_BRACE,
+    OPEN_PAREN,
+    CLOSE_PAREN,
+    OPEN_BRACKET,
+    CLOSE_BRACKET,
+    STRING,
+)
+
+OPENERS = {OPEN_BRACE: "{", OPEN_PAREN: "(", OPEN_BRACKET: "["}
+CLOSERS = {CLOSE_BRACE: ("}", OPEN_BRACE), CLOSE_PAREN: (")", OPEN_PAREN), CLOSE_BRACKET: ("]", OPEN_BRACKET)}
+# Later errors are mostly consequences of the first ones
+MAX_ERRORS = 5
+
+
+def location(counter, path, offset):
+    line = counter.line_of(offset)
+    return f"{path}:{line + 1}:{offset - counter.line_starts[line] + 1}"
+
+
+def check_delimiters(counter, path):
+    """Diagnostics for the unbalanced delimiters and unterminated strings in the code of an UnsafeCounter, in
+    rustc's format (so error locations are picked up like compiler errors), or "" if there are none."""
+    kinds, starts, ends, code = counter.kinds, counter.starts, counter.ends, counter.code
+    errors = []
+    stack = []
+    for index, kind in enumerate(kinds):
+        if kind in OPENERS:
+            stack.append(index)
+        elif kind in CLOSERS:
+            text, opener = CLOSERS[kind]
+            if stack and kinds[stack[-1]] == opener:
+                stack.pop()
+                continue
+            # Resynchronize at the nearest matching opener, if there is one, as rustc does
+            match = next((i for i in range(len(stack) - 1, -1, -1) if kinds[stack[i]] == opener), None)
+            if match is None:
+                errors.append(
+                    f"error: unexpected closing delimiter: `{text}`\n --> {location(counter, path, starts[index])}"
+                )
+                continue
+            unclosed = stack[-1]
+            errors.append(
+                f"error: mismatched closing delimiter: `{text}`\n --> {location(counter, path, starts[index])}\n"
+                f"  = note: unclosed delimiter `{OPENERS[kinds[unclosed]]}` "
+                f"at {location(counter, path, starts[unclosed])}"
+            )
+            del stack[match:]
+        elif kind == STRING and ends[index] == len(code) and not code.endswith(("\"", "'", "#")):
+            # The lexer runs unterminated strings to the end of the file
+            errors.append(f"error: unterminated string\n --> {location(counter, path, starts[index])}")
+    for index in reversed(stack):
+        errors.append(
+            f"error: this file contains an unclosed delimiter `{OPENERS[kinds[index]]}`\n"
+            f" --> {location(counter, path, starts[index])}"
+        )
+    if len(errors) > MAX_ERRORS:
+        errors = errors[:MAX_ERRORS] + [f"({len(errors) - MAX_ERRORS} more delimiter errors are not shown)"]
+    return "\n\n".join(errors)
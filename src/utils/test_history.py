@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+
+from utils.metrics import percentile
+from config import (
+    TEST_TIMEOUT,
+    ADAPTIVE_TEST_TIMEOUT,
+    TEST_TIMEOUT_PERCENTILE,
+    TEST_TIMEOUT_FACTOR,
+    TEST_TIMEOUT_MIN,
+    TEST_TIMEOUT_MIN_SAMPLES,
+    TEST_TIME_HISTORY,
+)
+
+
+class TestHistory:
+    """Wall times and longest output silences of a target's passing test runs, kept in a JSON file across runs,
+    from which its test timeout and hang timeout are derived."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.runs = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.runs = []
+
+    def limits(self):
+        """(timeout, hang timeout or None, basis), where basis explains how they were chosen."""
+        with self.lock:
+            runs = list(self.runs)
+        if not ADAPTIVE_TEST_TIMEOUT:
+            return TEST_TIMEOUT, None, f"fixed TEST_TIMEOUT of {TEST_TIMEOUT}s"
+        if len(runs) < TEST_TIMEOUT_MIN_SAMPLES:
+            return TEST_TIMEOUT, None, f"TEST_TIMEOUT of {TEST_TIMEOUT}s, {len(runs)}/{TEST_TIMEOUT_MIN_SAMPLES} passing runs recorded"
+
+        durations = sorted(run["duration"] for run in runs)
+        gaps = sorted(run["max_gap"] for run in runs)
+        duration = percentile(durations, TEST_TIMEOUT_PERCENTILE)
+        gap = percentile(gaps, TEST_TIMEOUT_PERCENTILE)
+        timeout = min(TEST_TIMEOUT, max(TEST_TIMEOUT_MIN, round(duration * TEST_TIMEOUT_FACTOR, 2)))
+        hang_timeout = max(TEST_TIMEOUT_MIN, round(gap * TEST_TIMEOUT_FACTOR, 2))
+        basis = (
+            f"{TEST_TIMEOUT_FACTOR}x the p{TEST_TIMEOUT_PERCENTILE} of {len(runs)} passing runs: "
+            f"{duration:.2f}s wall time, {gap:.2f}s without output"
+        )
+        # No point watching for silence longer than the run itself may take
+        return timeout, hang_timeout if hang_timeout < timeout else None, basis
+
+    def record(self, result):
+        """Add a passing CommandResult, keeping the TEST_TIME_HISTORY most recent runs."""
+        with self.lock:
+            self.runs.append({"duration": result.duration, "max_gap": result.max_gap})
+            self.runs = self.runs[-TEST_TIME_HISTORY:]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.runs, f)
+            os.replace(tmp_path, self.path)
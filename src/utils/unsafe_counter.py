@@ -0,0 +1,477 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+
+# Whitespace is skipped as part of the next token, and identifiers and punctuation (most tokens) are tried first. An
+# identifier followed by #, " or ' may be a raw identifier or the prefix of a string or char, so those fall through to
+# the full alternatives below
+TOKEN_PATTERN = re.compile(
+    r"""
+    \s*(?:
+      (?P<ident>[A-Za-z_]\w*)(?![\w\#"'])
+    | (?P<punct>[^\s\w/"'])
+    | (?P<comment>//[^\n]*)
+    | (?P<block_comment>/\*)
+    | (?P<raw_string>[bc]?r(?P<hashes>\#*)")
+    | (?P<string>[bc]?"(?:[^"\\]|\\[\s\S])*(?:"|\\?\Z))
+    | (?P<char>b?'(?:[^'\\\n]|\\(?:u\{[0-9a-fA-F_]{1,6}\}|x[0-9a-fA-F]{2}|[^\n]))')
+    | (?P<lifetime>'(?:r\#)?[A-Za-z_]\w*)
+    | (?P<raw_ident>(?:r\#)?[A-Za-z_]\w*)
+    | (?P<number>\d\w*(?:\.\d\w*)?)
+    | (?P<other>\S)
+    )
+    """,
+    re.VERBOSE,
+)
+(
+    IDENT_GROUP,
+    PUNCT_GROUP,
+    COMMENT_GROUP,
+    BLOCK_COMMENT_GROUP,
+    RAW_STRING_GROUP,
+    STRING_GROUP,
+    CHAR_GROUP,
+    RAW_IDENT_GROUP,
+) = (
+    TOKEN_PATTERN.groupindex[name]
+    for name in ("ident", "punct", "comment", "block_comment", "raw_string", "string", "char", "raw_ident")
+)
+BLOCK_COMMENT_DELIMITERS = re.compile(r"/\*|\*/")
+NEWLINE = re.compile(r"\n")
+# Unterminated strings and comments run to the end of the file, so no token's extent depends on more than this many
+# characters after it (the longest case is a char literal like '\u{10FFFF}' lexed as separate tokens until it closes)
+MAX_TOKEN_LOOKAHEAD = 16
+
+# Token kinds, stored one byte per token
+OTHER, OPEN_BRACE, CLOSE_BRACE, OPEN_PAREN, CLOSE_PAREN, OPEN_BRACKET, CLOSE_BRACKET, SEMICOLON, COMMA = range(9)
+UNSAFE, FN, IMPL, TRAIT, EXTERN, AUTO, IDENT, STRING = range(9, 17)
+
+PUNCT_KINDS = {
+    "{": OPEN_BRACE,
+    "}": CLOSE_BRACE,
+    "(": OPEN_PAREN,
+    ")": CLOSE_PAREN,
+    "[": OPEN_BRACKET,
+    "]": CLOSE_BRACKET,
+    ";": SEMICOLON,
+    ",": COMMA,
+}
+KEYWORD_KINDS = {"unsafe": UNSAFE, "fn": FN, "impl": IMPL, "trait": TRAIT, "extern": EXTERN, "auto": AUTO}
+# Delimiters, separators and the unsafe keyword itself don't make a line count as code
+INSIGNIFICANT = frozenset(range(OPEN_BRACE, UNSAFE + 1))
+STRUCTURAL = re.compile(rb"[\x01-\x07\x09]")
+
+
+def skip_block_comment(code, pos):
+    """Return the end of a (possibly nested) block comment whose opening /* ends at pos."""
+    depth = 1
+    while depth:
+        match = BLOCK_COMMENT_DELIMITERS.search(code, pos)
+        if not match:
+            return len(code)
+        depth += 1 if match.group() == "/*" else -1
+        pos = match.end()
+    return pos
+
+
+def lex(code, pos=0):
+    """Yield (start, end, kind) for every token that isn't whitespace or a comment, starting at pos.
+
+    The lexer is stateless between tokens, so lexing from any token boundary produces the same tokens as lexing
+    from the start of the file.
+    """
+    match = TOKEN_PATTERN.match
+    length = len(code)
+    while True:
+        m = match(code, pos)
+        if m is None:
+            # Only whitespace is left
+            return
+        group = m.lastindex
+        end = pos = m.end()
+        if group == IDENT_GROUP or group == RAW_IDENT_GROUP:
+            start = m.start(group)
+            yield start, end, KEYWORD_KINDS.get(code[start:end], IDENT)
+        elif group == PUNCT_GROUP:
+            yield end - 1, end, PUNCT_KINDS.get(code[end - 1], OTHER)
+        elif group == COMMENT_GROUP:
+            continue
+        elif group == BLOCK_COMMENT_GROUP:
+            pos = skip_block_comment(code, end)
+        elif group == RAW_STRING_GROUP:
+            terminator = '"' + m.group("hashes")
+            close = code.find(terminator, end)
+            pos = length if close == -1 else close + len(terminator)
+            yield m.start(group), pos, STRING
+        else:
+            yield m.start(group), end, STRING if group == STRING_GROUP or group == CHAR_GROUP else OTHER
+
+
+class UnsafeItem:
+    __slots__ = (
+        "kind",
+        "first_token",
+        "body_token",
+        "last_token",
+        "start",
+        "end",
+        "start_line",
+        "end_line",
+        "num_lines",
+        "outermost",
+    )
+
+    def __init__(self, kind, first_token):
+        self.kind = kind
+        self.first_token = first_token
+        self.body_token = None
+        self.last_token = None
+        self.start = None
+        self.end = None
+        self.start_line = None
+        self.end_line = None
+        self.num_lines = 0
+        self.outermost = False
+
+    def shifted(self, token_delta, offset_delta, line_delta):
+        """Copy of this item for code in which everything before it changed length by the given deltas."""
+        item = UnsafeItem(self.kind, self.first_token + token_delta)
+        item.body_token = None if self.body_token is None else self.body_token + token_delta
+        item.last_token = self.last_token + token_delta
+        item.start = self.start + offset_delta
+        item.end = self.end + offset_delta
+        item.start_line = self.start_line + line_delta
+        item.end_line = self.end_line + line_delta
+        item.num_lines = self.num_lines
+        item.outermost = self.outermost
+        return item
+
+    def __repr__(self):
+        return f"UnsafeItem({self.kind}, lines {self.start_line}-{self.end_line}, {self.num_lines} unsafe lines)"
+
+
+class UnsafeCounter:
+    """Counts lines of unsafe Rust code from a token stream.
+
+    An unsafe item (unsafe block, unsafe fn, unsafe impl/trait or unsafe extern block) spans from the unsafe
+    keyword to the matching closing brace, or to the semicolon of a bodiless declaration. A line is unsafe if it is
+    the line of the unsafe keyword or overlaps the item's body, and contains code other than delimiters, commas,
+    semicolons and the unsafe keyword. Lines of a multi-line signature between the two are not counted.
+
+    with_edits/with_code return a counter for a modified version of the code, re-lexing only from the token
+    boundary before each edit until the token stream lines up with the old one again. Items are then only searched
+    for between the top-level boundaries (see scan) around the re-lexed tokens, and the rest are shifted over.
+    """
+
+    def __init__(self, code, tokens=None, line_starts=None, base=None):
+        self.code = code
+        if tokens is None:
+            self.starts, self.ends, self.kinds = array("q"), array("q"), bytearray()
+            for start, end, kind in lex(code):
+                self.starts.append(start)
+                self.ends.append(end)
+                self.kinds.append(kind)
+        else:
+            self.starts, self.ends, self.kinds = tokens
+        if line_starts is None:
+            line_starts = array("q", [0])
+            line_starts.extend(m.end() for m in NEWLINE.finditer(code))
+        self.line_starts = line_starts
+        if base is None:
+            self.analyze()
+        else:
+            self.reanalyze(*base)
+
+    def line_of(self, offset):
+        """0-based line containing offset."""
+        return bisect_right(self.line_starts, offset) - 1
+
+    def kind_at(self, index):
+        return self.kinds[index] if index < len(self.kinds) else None
+
+    def classify(self, index):
+        """The kind of unsafe item introduced by the unsafe keyword at token index, or None (e.g. fn pointer types)."""
+        next_kind = self.kind_at(index + 1)
+        if next_kind == OPEN_BRACE:
+            return "block"
+        if next_kind == FN:
+            return "fn" if self.kind_at(index + 2) == IDENT else None
+        if next_kind == EXTERN:
+            index += 2
+            if self.kind_at(index) == STRING:
+                index += 1
+            if self.kind_at(index) == OPEN_BRACE:
+                return "extern"
+            if self.kind_at(index) == FN and self.kind_at(index + 1) == IDENT:
+                return "fn"
+            return None
+        if next_kind == IMPL:
+            return "impl"
+        if next_kind == TRAIT or (next_kind == AUTO and self.kind_at(index + 2) == TRAIT):
+            return "trait"
+        return None
+
+    def ends_line(self, index):
+        """Whether a line break follows token index before the next token."""
+        return index + 1 >= len(self.starts) or self.code.find("\n", self.ends[index], self.starts[index + 1]) != -1
+
+    def scan(self, begin, resume=None, old=None, token_delta=0):
+        """(items, boundaries, end) for the tokens from begin on, which must not be inside any delimiter or item.
+
+        Boundaries are tokens after which nothing is open or pending and a new line starts, so the items on either
+        side of one don't share tokens or lines. If old is given, the scan ends at the first boundary from token
+        resume on that was a boundary of old token_delta tokens earlier: from there on, both scans see the same
+        tokens in the same state, and end is that boundary. Otherwise end is None.
+        """
+        kinds = self.kinds
+        items = []
+        boundaries = array("q")
+        stack = []
+        pending = None
+        pending_depth = 0
+        # An item abandoned while pending runs to the end of the file, so there are no boundaries after it
+        abandoned = False
+
+        for match in STRUCTURAL.finditer(kinds, begin):
+            index = match.start()
+            kind = kinds[index]
+            if kind == UNSAFE:
+                item_kind = self.classify(index)
+                if item_kind:
+                    abandoned = abandoned or pending is not None
+                    pending = UnsafeItem(item_kind, index)
+                    pending_depth = len(stack)
+                    items.append(pending)
+                continue
+            elif kind in (OPEN_BRACE, OPEN_PAREN, OPEN_BRACKET):
+                if pending and kind == OPEN_BRACE and len(stack) == pending_depth:
+                    pending.body_token = index
+                    stack.append(pending)
+                    pending = None
+                else:
+                    stack.append(None)
+                continue
+            elif kind == SEMICOLON:
+                if pending and len(stack) == pending_depth:
+                    pending.last_token = index
+                    pending = None
+            else:
+                if pending and len(stack) == pending_depth:
+                    pending.last_token = index - 1
+                    pending = None
+                if stack:
+                    item = stack.pop()
+                    if item:
+                        item.last_token = index
+            if not stack and pending is None and not abandoned and self.ends_line(index):
+                boundaries.append(index)
+                if old is not None and index >= resume:
+                    old_index = index - token_delta
+                    position = bisect_left(old.boundaries, old_index)
+                    if position < len(old.boundaries) and old.boundaries[position] == old_index:
+                        return items, boundaries, index
+        return items, boundaries, None
+
+    def place(self, items):
+        """Fill in the offsets and (0-based) lines of newly scanned items, and mark the outermost ones."""
+        last_token = len(self.kinds) - 1
+        outer_end = -1
+        for item in items:
+            if item.last_token is None:
+                item.last_token = last_token
+            item.start = self.starts[item.first_token]
+            item.end = self.ends[item.last_token]
+            item.start_line = self.line_of(item.start)
+            item.end_line = self.line_of(item.end - 1)
+            # Items are in order of their unsafe keyword, so anything starting before the previous outermost item
+            # ends is nested inside it
+            if item.start >= outer_end:
+                item.outermost = True
+                outer_end = item.end
+
+    def item_lines(self, items):
+        """1-based unsafe lines of the outermost of items (which have 0-based lines)."""
+        lines = set()
+        for item in items:
+            if not item.outermost:
+                continue
+            if item.body_token is None:
+                lines.update(self.significant_lines(item.start_line, item.start_line))
+                continue
+            body_line = self.line_of(self.starts[item.body_token])
+            if body_line > item.start_line:
+                lines.update(self.significant_lines(item.start_line, item.start_line))
+            lines.update(self.significant_lines(body_line, item.end_line))
+        return {line + 1 for line in lines}
+
+    def finish(self, items):
+        """Make the lines of newly placed items 1-based and count their unsafe lines."""
+        unsafe_lines = self.unsafe_lines
+        for item in items:
+            item.start_line += 1
+            item.end_line += 1
+            item.num_lines = bisect_right(unsafe_lines, item.end_line) - bisect_left(unsafe_lines, item.start_line)
+
+    def analyze(self):
+        items, self.boundaries, _ = self.scan(0)
+        self.place(items)
+        self.items = items
+        # 1-based, to match the line numbers editors and compilers show
+        self.unsafe_lines = sorted(self.item_lines(items))
+        self.num_unsafe_lines = len(self.unsafe_lines)
+        self.num_unsafe_blocks = sum(item.outermost for item in items)
+        self.finish(items)
+
+    def reanalyze(self, old, first, old_tail, tail):
+        """Analyze by reusing the items of old, a counter for the same code except that tokens first..old_tail-1 of
+        old were replaced by tokens first..tail-1 of this one."""
+        # Restart at the last boundary whose next token is untouched too, so the line break after it still is
+        position = bisect_left(old.boundaries, first - 1) - 1
+        begin_boundary = old.boundaries[position] if position >= 0 else None
+        begin = begin_boundary + 1 if begin_boundary is not None else 0
+        token_delta = tail - old_tail
+        items, boundaries, end = self.scan(begin, tail, old, token_delta)
+        self.place(items)
+
+        # Everything up to the boundary is unchanged, everything after the resync point just moved
+        resynced = end is not None
+        old_end = end - token_delta if resynced else len(old.kinds) - 1
+        offset_delta = len(self.code) - len(old.code)
+        line_delta = len(self.line_starts) - len(old.line_starts)
+        first_line = old.line_of(old.ends[begin_boundary] - 1) + 1 if begin_boundary is not None else 0
+        old_last_line = old.line_of(old.ends[old_end] - 1) if resynced else len(old.line_starts)
+
+        before = bisect_right(old.items, begin - 1, key=lambda item: item.first_token)
+        after = bisect_right(old.items, old_end, key=lambda item: item.first_token) if resynced else len(old.items)
+        tail_items = [item.shifted(token_delta, offset_delta, line_delta) for item in old.items[after:]]
+        self.items = old.items[:before] + items + tail_items
+
+        old_boundaries = old.boundaries
+        self.boundaries = (
+            old_boundaries[: position + 1]
+            + boundaries
+            + array("q", (index + token_delta for index in old_boundaries[bisect_right(old_boundaries, old_end) :]))
+        )
+
+        old_lines = old.unsafe_lines
+        self.unsafe_lines = (
+            old_lines[: bisect_right(old_lines, first_line)]
+            + sorted(self.item_lines(items))
+            + [line + line_delta for line in old_lines[bisect_right(old_lines, old_last_line + 1) :]]
+        )
+        self.num_unsafe_lines = len(self.unsafe_lines)
+        self.num_unsafe_blocks = (
+            old.num_unsafe_blocks
+            - sum(item.outermost for item in old.items[before:after])
+            + sum(item.outermost for item in items)
+        )
+        self.finish(items)
+
+    def significant_lines(self, start_line, end_line):
+        """0-based lines in [start_line, end_line] that contain code."""
+        line_starts = self.line_starts
+        range_start = line_starts[start_line]
+        range_end = line_starts[end_line + 1] if end_line + 1 < len(line_starts) else len(self.code)
+        # Tokens ending after the range starts, to include a multi-line string covering its first lines
+        first = bisect_right(self.ends, range_start)
+        last = bisect_left(self.starts, range_end, first)
+        kinds = self.kinds[first:last]
+        starts = self.starts[first:last]
+        # bisect_right gives 1-based lines
+        lines = set(
+            map(
+                bisect_right,
+                repeat(line_starts),
+                [start for start, kind in zip(starts, kinds) if kind not in INSIGNIFICANT],
+            )
+        )
+        index = kinds.find(STRING)
+        while index != -1:
+            line = bisect_right(line_starts, starts[index])
+            last_line = bisect_right(line_starts, self.ends[first + index] - 1)
+            lines.update(range(line, last_line + 1))
+            index = kinds.find(STRING, index + 1)
+        return {line - 1 for line in lines if start_line < line <= end_line + 1}
+
+    def with_edits(self, edits):
+        """Counter for the code with edits applied. edits is a list of non-overlapping (start, end, new_text)
+        replacements in this counter's coordinates."""
+        code = self.code
+        starts, ends, kinds = self.starts, self.ends, self.kinds
+        line_starts = self.line_starts
+        # Tokens first..len-tail-1 of the result replace tokens first..len-tail-1 of this counter
+        first_changed = tail = len(starts)
+        # Apply from the end of the file so earlier offsets stay valid
+        for start, end, new_text in sorted(edits, reverse=True):
+            new_code = code[:start] + new_text + code[end:]
+            delta = len(new_text) - (end - start)
+            new_end = start + len(new_text)
+
+            # Restart lexing at the end of the last token that is too far before the edit to be affected by it
+            first = bisect_right(ends, start - MAX_TOKEN_LOOKAHEAD)
+            relex_from = ends[first - 1] if first > 0 else 0
+            new_starts, new_ends, new_kinds = array("q"), array("q"), bytearray()
+            resume = len(starts)
+            for token_start, token_end, kind in lex(new_code, relex_from):
+                if token_start >= new_end:
+                    # Once a token starts where an old token started, the rest of the stream is unchanged
+                    old_index = bisect_left(starts, token_start - delta, first)
+                    if old_index < len(starts) and starts[old_index] == token_start - delta:
+                        resume = old_index
+                        break
+                new_starts.append(token_start)
+                new_ends.append(token_end)
+                new_kinds.append(kind)
+
+            first_changed = min(first_changed, first)
+            tail = min(tail, len(starts) - resume)
+            starts = starts[:first] + new_starts + shift(starts[resume:], delta)
+            ends = ends[:first] + new_ends + shift(ends[resume:], delta)
+            kinds = kinds[:first] + new_kinds + kinds[resume:]
+
+            first_line = bisect_right(line_starts, start)
+            resume_line = bisect_right(line_starts, end)
+            new_lines = array("q", (start + m.end() for m in NEWLINE.finditer(new_text)))
+            line_starts = line_starts[:first_line] + new_lines + shift(line_starts[resume_line:], delta)
+            code = new_code
+
+        if code == self.code:
+            return self
+        base = (self, first_changed, len(self.starts) - tail, len(starts) - tail)
+        return UnsafeCounter(code, (starts, ends, kinds), line_starts, base)
+
+    def with_code(self, new_code):
+        """Counter for new_code, re-lexing only the region between the common prefix and suffix."""
+        old_code = self.code
+        if new_code == old_code:
+            return self
+        prefix = common_prefix_length(old_code, new_code)
+        suffix = common_suffix_length(old_code, new_code, min(len(old_code), len(new_code)) - prefix)
+        return self.with_edits([(prefix, len(old_code) - suffix, new_code[prefix : len(new_code) - suffix])])
+
+
+def shift(offsets, delta):
+    return array("q", (offset + delta for offset in offsets)) if delta else offsets
+
+
+def common_prefix_length(a, b):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def common_suffix_length(a, b, limit):
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid :] == b[len(b) - mid :]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
@@ -0,0 +1,372 @@
+import filecmp
+import hashlib
+import os
+import queue
+import re
+import shutil
+import threading
+
+from utils.cache import BuildCache
+from utils.io import CommandResult, compile_pattern, pattern_list, run_build_command, run_command_with_timeout
+from utils.metrics import metrics
+from utils.syntax import check_delimiters
+from utils.test_history import TestHistory
+from utils.unsafe_counter import UnsafeCounter
+from config import *
+
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cache"))
+# Files and directories that are never copied into a scratch workspace
+SYNC_IGNORE = {"target", ".git"}
+
+build_cache = BuildCache(
+    os.path.join(CACHE_DIR, "build"),
+    "on" if BUILD_CACHE else "off",
+    BUILD_CACHE_MAX_SIZE_MB,
+    BUILD_CACHE_MAX_AGE_DAYS,
+)
+
+# Passing test times are kept per target and test command, since a different command may take a different time
+test_history = TestHistory(
+    os.path.join(
+        CACHE_DIR,
+        "test_times",
+        f"{TARGET}-{hashlib.sha256(repr((CRATE_PATH, TEST_CMD, TEST_EXPECTED_OUTPUT)).encode()).hexdigest()[:12]}.json",
+    )
+)
+
+
+class Workspace:
+    """A place where candidate code can be written, built and tested.
+
+    With no root, the workspace is the target crate itself and the configured commands are used as-is.
+    Otherwise it is a scratch copy of CRATE_PATH under root with its own CARGO_TARGET_DIR, and every
+    reference to CRATE_PATH in the configured paths and commands is redirected to the copy. An existing copy is
+    synced rather than recreated, so its target directory (and the compiled dependencies in it) survives.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        if root is None:
+            self.env = None
+            self.code_path = CODE_PATH
+            self.cargo_path = CARGO_PATH
+            self.build_cmd = BUILD_CMD
+            self.check_cmd = CHECK_CMD
+            self.test_cmd = TEST_CMD
+            return
+
+        sync_tree(os.path.expanduser(CRATE_PATH), root)
+        self.env = dict(os.environ, CARGO_TARGET_DIR=os.path.join(root, "target"))
+        self.code_path = self.localize_path(CODE_PATH)
+        self.cargo_path = self.localize_path(CARGO_PATH) if CARGO_PATH else None
+        self.build_cmd = self.localize_cmd(BUILD_CMD)
+        self.check_cmd = self.localize_cmd(CHECK_CMD) if CHECK_CMD else None
+        self.test_cmd = self.localize_cmd(TEST_CMD)
+
+    def localize_path(self, path):
+        if self.root is None:
+            return path
+        return os.path.join(self.root, os.path.relpath(os.path.expanduser(path), os.path.expanduser(CRATE_PATH)))
+
+    def localize_cmd(self, cmd):
+        crate_path = os.path.normpath(CRATE_PATH)
+        return re.sub(r"(?:\./)?" + re.escape(crate_path) + r"(?=/|\s|$)", lambda _: self.root, cmd)
+
+    def write(self, code, toml, code_path=None):
+        """Write code to code_path (CODE_PATH by default) and toml to Cargo.toml."""
+        write_if_changed(self.code_path if code_path is None else self.localize_path(code_path), code)
+        if self.cargo_path:
+            write_if_changed(self.cargo_path, toml)
+
+    def write_files(self, files):
+        """Write {path in CRATE_PATH: text} into the workspace."""
+        for path, text in files.items():
+            write_if_changed(self.localize_path(path), text)
+
+    def build(self, cancel_event=None):
+        return run_build_command(self.build_cmd, self.env, cancel_event)
+
+    def check(self, cancel_event=None):
+        return run_build_command(self.check_cmd, self.env, cancel_event)
+
+    def test(self, cancel_event=None):
+        """Run the test with the timeouts derived from test_history, and record its time if it passed."""
+        timeout, hang_timeout, basis = test_history.limits()
+        result = run_command_with_timeout(
+            self.test_cmd,
+            timeout,
+            TEST_EXPECTED_OUTPUT,
+            self.env,
+            cancel_event,
+            TEST_FAILURE_PATTERNS,
+            TEST_OUTPUT_LIMIT,
+            hang_timeout,
+        )
+        result.timeout_basis = basis
+        if result.passed:
+            test_history.record(result)
+        return result
+
+
+class WorkspacePool:
+    """Persistent, pre-warmed scratch workspaces that candidates are dispatched to.
+
+    Workers live under src/cache/workspaces/<target>-<crate> and are reused across attempts and runs, so each keeps
+    its compiled dependencies and a candidate only recompiles the crate itself. Targets sharing a crate (as in a
+    batch) have workers of their own. start() syncs every worker with CRATE_PATH and
+    builds it once in the background; acquire() blocks until a warm worker is free.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.free = queue.Queue()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        crate_id = hashlib.sha256(os.path.abspath(os.path.expanduser(CRATE_PATH)).encode()).hexdigest()[:12]
+        root = os.path.join(CACHE_DIR, "workspaces", f"{TARGET}-{crate_id}")
+        for i in range(self.size):
+            worker_root = os.path.join(root, f"worker{i}")
+            threading.Thread(target=self.warm_up, args=(worker_root,), name=f"warm-up-{i}", daemon=True).start()
+
+    def warm_up(self, root):
+        try:
+            workspace = Workspace(root)
+        except OSError as e:
+            # Handed to whoever acquires this worker, instead of leaving them waiting forever
+            self.free.put(e)
+            return
+        returncode, _ = workspace.build()
+        if returncode != 0:
+            print(f"\nWarm-up build failed in {root}, the first candidate built there will compile from scratch")
+        self.free.put(workspace)
+
+    def acquire(self):
+        self.start()
+        workspace = self.free.get()
+        if isinstance(workspace, Exception):
+            self.free.put(workspace)
+            raise workspace
+        return workspace
+
+    def release(self, workspace):
+        self.free.put(workspace)
+
+
+def sync_tree(src, dst):
+    """Make dst a copy of src without touching files whose content already matches, so their mtimes (and cargo's
+    fingerprints) stay valid. Files in dst that no longer exist in src are removed."""
+    os.makedirs(dst, exist_ok=True)
+    src_names = {name for name in os.listdir(src) if name not in SYNC_IGNORE}
+    for name in os.listdir(dst):
+        if name not in src_names and name not in SYNC_IGNORE:
+            path = os.path.join(dst, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    for name in src_names:
+        src_path, dst_path = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.islink(src_path):
+            if not os.path.islink(dst_path) or os.readlink(dst_path) != os.readlink(src_path):
+                if os.path.lexists(dst_path):
+                    os.remove(dst_path)
+                os.symlink(os.readlink(src_path), dst_path)
+        elif os.path.isdir(src_path):
+            sync_tree(src_path, dst_path)
+        elif not os.path.isfile(dst_path) or not filecmp.cmp(src_path, dst_path, shallow=False):
+            # copyfile rather than copy2: the copy has to look newer than the last build
+            shutil.copyfile(src_path, dst_path)
+            shutil.copymode(src_path, dst_path)
+
+
+def write_if_changed(path, content):
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == content:
+                return
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+class Candidate:
+    """A generated patch together with the results of building and testing it, computed lazily.
+
+    Results are shared through build_cache, so byte-identical candidates skip straight to the earlier verdict.
+    A cached successful build is only reused when its test output is cached too, since the test needs the
+    build artifacts in the workspace.
+
+    Building goes through cheaper tiers first: the delimiters of the new code are checked in-process, then the crate
+    is type checked with CHECK_CMD, and the first tier to fail (build_tier) provides the build result.
+
+    In crate mode a candidate is a new version of code_path, built together with the accepted code of the other files
+    (other_files) as of crate version crate_version. Its Cargo.toml then includes the accepted Cargo.toml, base_toml.
+    """
+
+    def __init__(
+        self,
+        replacements,
+        new_code,
+        new_toml,
+        code_edits,
+        generation_attempt,
+        code_path=None,
+        other_files=None,
+        crate_version=None,
+        base_toml=None,
+    ):
+        self.replacements = replacements
+        self.new_code = new_code
+        self.new_toml = new_toml
+        # (start, end, new) edits that turn the base code into new_code
+        self.code_edits = code_edits
+        self.generation_attempt = generation_attempt
+        self.code_path = code_path
+        self.other_files = other_files or {}
+        self.crate_version = crate_version
+        self.base_toml = base_toml
+        self.workspace = None
+        self.build_result = None
+        self.test_result = None
+        self.unsafe_counter = None
+        # The rest of the crate is part of the key in crate mode only, so single-file runs keep their cached results
+        crate = (code_path, other_files) if other_files is not None else ()
+        self.check_key = build_cache.key(new_code, new_toml, CHECK_CMD, *crate)
+        self.build_key = build_cache.key(new_code, new_toml, BUILD_CMD, *crate)
+        self.test_key = build_cache.key(
+            new_code, new_toml, BUILD_CMD, TEST_CMD, TEST_EXPECTED_OUTPUT, TEST_FAILURE_PATTERNS, *crate
+        )
+        self.build_tier = None
+        self.build_cached = False
+        self.test_cached = False
+
+    def build(self, cancel_event=None, base_counter=None):
+        """(return code, stderr) of the first validation tier that fails: the delimiter check, CHECK_CMD or
+        BUILD_CMD. base_counter is the counter of the code the candidate was generated from, if known."""
+        if self.build_result is None:
+            self.build_result = self.check_syntax(base_counter)
+        if self.build_result is None:
+            cached = build_cache.get(self.build_key)
+            # A cached build result makes the type check pointless, whichever way it went
+            if not (cached and (cached[0] != 0 or build_cache.get(self.test_key) is not None)):
+                self.build_result = self.check(cancel_event)
+        if self.build_result is None:
+            self.build_tier = "build"
+            with metrics.span("build") as span:
+                cached = build_cache.get(self.build_key)
+                if cached and (cached[0] != 0 or build_cache.get(self.test_key) is not None):
+                    self.build_result = tuple(cached)
+                    self.build_cached = True
+                else:
+                    self.build_result = self.workspace.build(cancel_event)
+                    if not (cancel_event and cancel_event.is_set()):
+                        build_cache.put(self.build_key, list(self.build_result))
+                if cancel_event and cancel_event.is_set():
+                    span.set(outcome="cancelled")
+                elif self.build_result[0] != 0:
+                    span.set(outcome="failed")
+                span.set(cached=self.build_cached)
+        return self.build_result
+
+    def check_syntax(self, base_counter=None):
+        """The delimiter errors of the new code as a failed build result, or None if there are none."""
+        if not SYNTAX_CHECK:
+            return None
+        self.count_unsafe(base_counter)
+        with metrics.span("syntax_check") as span:
+            path = os.path.relpath(os.path.expanduser(self.code_path or CODE_PATH), os.path.expanduser(CRATE_PATH))
+            errors = check_delimiters(self.unsafe_counter, path)
+            if not errors:
+                return None
+            span.set(outcome="failed")
+        self.build_tier = "syntax check"
+        return 1, errors
+
+    def check(self, cancel_event=None):
+        """The result of CHECK_CMD if it failed, or None if it passed (or there is none)."""
+        if not CHECK_CMD:
+            return None
+        with metrics.span("check") as span:
+            cached = build_cache.get(self.check_key)
+            if cached:
+                result = tuple(cached)
+            else:
+                result = self.workspace.check(cancel_event)
+                if not (cancel_event and cancel_event.is_set()):
+                    build_cache.put(self.check_key, list(result))
+            if cancel_event and cancel_event.is_set():
+                span.set(outcome="cancelled")
+            elif result[0] != 0:
+                span.set(outcome="failed")
+            span.set(cached=bool(cached))
+        if result[0] == 0:
+            return None
+        self.build_tier = "type check"
+        self.build_cached = bool(cached)
+        return result
+
+    def test(self, cancel_event=None):
+        """The CommandResult of the test."""
+        if self.test_result is None:
+            with metrics.span("test") as span:
+                cached = build_cache.get(self.test_key)
+                if cached is not None:
+                    self.test_result = CommandResult.from_json(cached)
+                    self.test_cached = True
+                else:
+                    if self.build_cached:
+                        # The test output was evicted after the build was skipped, so the artifacts have to be rebuilt
+                        self.workspace.build(cancel_event)
+                    self.test_result = self.workspace.test(cancel_event)
+                    if self.test_result_cacheable():
+                        build_cache.put(self.test_key, self.test_result.to_json())
+                    span.set(
+                        timeout=self.test_result.timeout,
+                        hang_timeout=self.test_result.hang_timeout,
+                        timeout_basis=self.test_result.timeout_basis,
+                    )
+                verdict = self.test_result.verdict
+                span.set(outcome={"passed": "ok", "exited": "failed"}.get(verdict, verdict), cached=self.test_cached)
+        return self.test_result
+
+    def test_result_cacheable(self):
+        """Whether the test result is the code's doing: a pass, or a failure pattern other than the harness's. A
+        timeout or a test exiting without the expected output may be the machine's fault, so they aren't kept."""
+        result = self.test_result
+        if result.verdict == "failed":
+            harness = {compile_pattern(pattern)[1] for pattern in pattern_list(TEST_HARNESS_FAILURE_PATTERNS)}
+            return result.pattern not in harness
+        return result.verdict == "passed"
+
+    def count_unsafe(self, base_counter=None):
+        """Unsafe lines in the new code, re-lexing only the edited regions of base_counter's code if given."""
+        if self.unsafe_counter is None:
+            with metrics.span("count_unsafe", incremental=base_counter is not None) as span:
+                if base_counter:
+                    self.unsafe_counter = base_counter.with_edits(self.code_edits)
+                    if self.unsafe_counter.code != self.new_code:
+                        self.unsafe_counter = base_counter.with_code(self.new_code)
+                else:
+                    self.unsafe_counter = UnsafeCounter(self.new_code)
+                span.set(unsafe_lines=self.unsafe_counter.num_unsafe_lines)
+        return self.unsafe_counter.num_unsafe_lines
+
+    def evaluate(self, workspace, base_counter, cancel_event=None):
+        """Write, build, test and count this candidate in workspace. Returns whether it would be accepted, i.e.
+        whether it has fewer unsafe lines than the code base_counter was built from."""
+        self.workspace = workspace
+        workspace.write_files(self.other_files)
+        workspace.write(self.new_code, self.new_toml, self.code_path)
+        returncode, _ = self.build(cancel_event, base_counter)
+        if returncode != 0 or (cancel_event and cancel_event.is_set()):
+            return False
+        if not self.test(cancel_event).passed:
+            return False
+        return self.count_unsafe(base_counter) < base_counter.num_unsafe_lines